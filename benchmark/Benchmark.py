@@ -0,0 +1,272 @@
+# Benchmarks the library synchronization, the bulk download and the DRM removal against MockKoboServer, so performance
+# changes can be measured without a Kobo account.
+#
+# Usage:
+#   python benchmark/Benchmark.py --books 10000 --downloads 200 --jobs 8
+#   python benchmark/Benchmark.py --json results.json
+#   python benchmark/Benchmark.py --baseline results.json   Fails if a phase got slower than the tolerance allows.
+
+import os
+import sys
+
+sys.path.insert( 0, os.path.join( os.path.dirname( os.path.dirname( os.path.abspath( __file__ ) ) ), "kobo-book-downloader" ) )
+
+from Commands import Commands
+from Globals import Globals
+from Kobo import Kobo, KoboSession
+from KoboDrmRemover import KoboDrmRemover
+from MockKoboServer import MockKoboServer
+from RunReport import RunReport
+from Settings import Settings
+
+from typing import Callable, List, Optional
+import argparse
+import contextlib
+import json
+import logging
+import math
+import shutil
+import tempfile
+import time
+import zipfile
+
+try:
+	import resource
+except ImportError:
+	# Not available on Windows.
+	resource = None
+
+DeviceId = "benchmark-device"
+UserId = "benchmark-user"
+
+# Returns with the peak resident set size in megabytes. On Linux the peak is reset before each phase, elsewhere it is the
+# peak of the whole run so far.
+def GetPeakRss() -> Optional[ float ]:
+	if os.path.isfile( "/proc/self/status" ):
+		with open( "/proc/self/status" ) as f:
+			for line in f:
+				if line.startswith( "VmHWM:" ):
+					return int( line.split()[ 1 ] ) / 1024
+
+	if resource is None:
+		return None
+
+	peakRss = resource.getrusage( resource.RUSAGE_SELF ).ru_maxrss
+	return peakRss / ( 1024 * 1024 ) if sys.platform == "darwin" else peakRss / 1024
+
+def ResetPeakRss() -> None:
+	try:
+		with open( "/proc/self/clear_refs", "w" ) as f:
+			f.write( "5" )
+	except OSError:
+		pass
+
+def GetPercentile( sortedValues: List[ float ], percentile: float ) -> Optional[ float ]:
+	if len( sortedValues ) == 0:
+		return None
+
+	# Nearest rank: the smallest value that has at least the given percentage of the values at or below it.
+	index = min( len( sortedValues ) - 1, max( 0, math.ceil( percentile / 100 * len( sortedValues ) ) - 1 ) )
+	return sortedValues[ index ]
+
+def GetDirectorySize( path: str ) -> int:
+	return sum( os.path.getsize( os.path.join( path, fileName ) ) for fileName in os.listdir( path ) )
+
+class Benchmark:
+	def __init__( self, arguments: argparse.Namespace, workingDirectory: str ):
+		self.Arguments = arguments
+		self.WorkingDirectory = workingDirectory
+		self.Results = []
+		self.RequestLatencies = [] # type: List[ float ]
+
+	def __CollectLatency( self, r, *args, **kwargs ) -> None:
+		self.RequestLatencies.append( r.elapsed.total_seconds() )
+
+	def Initialize( self, serverUrl: str ) -> None:
+		logging.basicConfig()
+		Globals.Logger = logging.getLogger()
+
+		# The settings, the library and the cache go to the working directory instead of the user's configuration.
+		os.environ[ "XDG_CONFIG_HOME" ] = self.WorkingDirectory
+		Globals.Settings = Settings()
+		Globals.Settings.DeviceId = DeviceId
+		Globals.Settings.SerialNumber = "benchmark"
+		Globals.Settings.UserId = UserId
+		Globals.Settings.UserKey = "user-key"
+		Globals.Settings.AccessToken = "access"
+		Globals.Settings.RefreshToken = "refresh"
+		Globals.Settings.Save()
+
+		KoboSession.ApiUrl = serverUrl
+		Globals.Kobo = Kobo()
+		Globals.Kobo.Session.hooks[ "response" ].append( self.__CollectLatency )
+		Globals.Kobo.LoadInitializationSettings()
+
+	# Runs the phase with its output hidden. The latencies are the given ones, or the HTTP request latencies if None.
+	def RunPhase( self, name: str, function: Callable, itemCount: Callable[ [], int ], byteCount: Callable[ [], int ] = lambda: 0,
+		latencies: Optional[ Callable[ [], List[ float ] ] ] = None ) -> None:
+		print( "Running %s..." % name )
+		self.RequestLatencies = []
+		ResetPeakRss()
+
+		startTime = time.perf_counter()
+		with open( os.devnull, "w" ) as devNull, contextlib.redirect_stdout( devNull ):
+			function()
+		seconds = time.perf_counter() - startTime
+
+		requestCount = len( self.RequestLatencies )
+		sortedLatencies = sorted( self.RequestLatencies if latencies is None else latencies() )
+		items = itemCount()
+		megabytes = byteCount() / ( 1024 * 1024 )
+
+		def Milliseconds( value: Optional[ float ] ) -> Optional[ float ]:
+			return None if value is None else value * 1000
+
+		self.Results.append( {
+			"ItemCount": items,
+			"ItemsPerSecond": items / seconds,
+			"LatencyMaxMilliseconds": Milliseconds( sortedLatencies[ -1 ] if len( sortedLatencies ) > 0 else None ),
+			"LatencyP50Milliseconds": Milliseconds( GetPercentile( sortedLatencies, 50 ) ),
+			"LatencyP90Milliseconds": Milliseconds( GetPercentile( sortedLatencies, 90 ) ),
+			"LatencyP99Milliseconds": Milliseconds( GetPercentile( sortedLatencies, 99 ) ),
+			"Megabytes": megabytes,
+			"MegabytesPerSecond": megabytes / seconds,
+			"Name": name,
+			"PeakRssMegabytes": GetPeakRss(),
+			"RequestCount": requestCount,
+			"Seconds": seconds
+		} )
+
+	def Run( self ) -> None:
+		arguments = self.Arguments
+		downloadDirectory = os.path.join( self.WorkingDirectory, "books" )
+		encryptedDirectory = os.path.join( self.WorkingDirectory, "encrypted" )
+		decryptedDirectory = os.path.join( self.WorkingDirectory, "decrypted" )
+		for directory in [ downloadDirectory, encryptedDirectory, decryptedDirectory ]:
+			os.mkdir( directory )
+
+		def ListAfterFullSync() -> None:
+			Globals.Kobo.ResetLibrary()
+			Commands.ListBooks( True )
+
+		self.RunPhase( "list (full sync)", ListAfterFullSync, lambda: arguments.books )
+		self.RunPhase( "list (incremental sync)", lambda: Commands.ListBooks( True ), lambda: arguments.books )
+		self.RunPhase( "wishlist", Commands.ListWishListedBooks, lambda: arguments.wishlist )
+
+		# The latencies of the downloads come from the run report.
+		runReport = RunReport()
+		def GetAllWithReport() -> None:
+			Globals.Kobo.RunReport = runReport
+			try:
+				Commands.GetBookOrBooks( None, downloadDirectory, True, arguments.jobs, decryptWorkers = arguments.decrypt_workers )
+			finally:
+				Globals.Kobo.RunReport = None
+
+		self.RunPhase( "get --all", GetAllWithReport, lambda: len( os.listdir( downloadDirectory ) ), lambda: GetDirectorySize( downloadDirectory ),
+			lambda: [ book.TotalSeconds for book in runReport.Books ] )
+
+		# The first run on a new machine: the downloads overlap with the synchronization of the library.
+		def GetAllAfterFullSync() -> None:
+			shutil.rmtree( downloadDirectory )
+			os.mkdir( downloadDirectory )
+			Globals.Kobo.ResetLibrary()
+			Commands.GetBookOrBooks( None, downloadDirectory, True, arguments.jobs, decryptWorkers = arguments.decrypt_workers )
+
+		self.RunPhase( "get --all (full sync)", GetAllAfterFullSync, lambda: len( os.listdir( downloadDirectory ) ), lambda: GetDirectorySize( downloadDirectory ) )
+
+		self.RunPhase( "get --all --keep-encrypted", lambda: Commands.GetBookOrBooks( None, encryptedDirectory, True, arguments.jobs, keepEncrypted = True ),
+			lambda: len( os.listdir( encryptedDirectory ) ) // 2, lambda: GetDirectorySize( encryptedDirectory ) )
+
+		decryptLatencies = []
+		def Decrypt() -> None:
+			drmRemover = KoboDrmRemover.Get( DeviceId, UserId )
+			for fileName in sorted( os.listdir( encryptedDirectory ) ):
+				if not fileName.endswith( KoboDrmRemover.EncryptedBookExtension ):
+					continue
+
+				inputFilePath = os.path.join( encryptedDirectory, fileName )
+				startTime = time.perf_counter()
+				contentKeys = KoboDrmRemover.LoadContentKeys( inputFilePath )
+				drmRemover.RemoveDrm( inputFilePath, os.path.join( decryptedDirectory, fileName[ :-len( KoboDrmRemover.EncryptedBookExtension ) ] ), contentKeys )
+				decryptLatencies.append( time.perf_counter() - startTime )
+
+		self.RunPhase( "decrypt", Decrypt, lambda: len( decryptLatencies ), lambda: GetDirectorySize( decryptedDirectory ), lambda: decryptLatencies )
+
+		# Make sure that the benchmark measured working code.
+		for directory in [ downloadDirectory, decryptedDirectory ]:
+			for fileName in os.listdir( directory ):
+				with zipfile.ZipFile( os.path.join( directory, fileName ) ) as bookZip:
+					if bookZip.testzip() is not None:
+						raise Exception( "The book '%s' is damaged." % fileName )
+
+	def PrintResults( self ) -> None:
+		def Format( value: Optional[ float ], format: str ) -> str:
+			return "-" if value is None else format % value
+
+		print( "%-28s %9s %10s %9s %8s %8s %8s %8s %9s" % ( "Phase", "Seconds", "Items/s", "MB/s", "p50 ms", "p90 ms", "p99 ms", "max ms", "Peak RSS" ) )
+		for result in self.Results:
+			print( "%-28s %9.2f %10.1f %9.1f %8s %8s %8s %8s %9s" % ( result[ "Name" ], result[ "Seconds" ], result[ "ItemsPerSecond" ], result[ "MegabytesPerSecond" ],
+				Format( result[ "LatencyP50Milliseconds" ], "%.1f" ), Format( result[ "LatencyP90Milliseconds" ], "%.1f" ),
+				Format( result[ "LatencyP99Milliseconds" ], "%.1f" ), Format( result[ "LatencyMaxMilliseconds" ], "%.1f" ),
+				Format( result[ "PeakRssMegabytes" ], "%.0f MB" ) ) )
+
+	# Returns with the phases that have become slower than the tolerance allows.
+	def CompareWithBaseline( self, baselinePath: str, tolerance: float ) -> List[ str ]:
+		with open( baselinePath, "r" ) as f:
+			baseline = json.load( f )
+
+		baselineResults = { result[ "Name" ]: result for result in baseline[ "Results" ] }
+		regressions = []
+		for result in self.Results:
+			baselineResult = baselineResults.get( result[ "Name" ] )
+			if baselineResult is None:
+				continue
+
+			if result[ "ItemsPerSecond" ] < baselineResult[ "ItemsPerSecond" ] * ( 1 - tolerance ):
+				regressions.append( "%s: %.1f items/s instead of %.1f" % ( result[ "Name" ], result[ "ItemsPerSecond" ], baselineResult[ "ItemsPerSecond" ] ) )
+
+		return regressions
+
+def Main() -> None:
+	argumentParser = argparse.ArgumentParser( description = "Benchmark kobo-book-downloader against a local mock Kobo server." )
+	argumentParser.add_argument( "--books", default = 10000, type = int, help = "The number of books in the library" )
+	argumentParser.add_argument( "--downloads", default = 100, type = int, help = "The number of books get --all downloads, the rest are archived" )
+	argumentParser.add_argument( "--wishlist", default = 1000, type = int, help = "The number of books on the wish list" )
+	argumentParser.add_argument( "--page-size", default = 100, type = int, help = "The number of books on a library synchronization page" )
+	argumentParser.add_argument( "--chapters", default = 20, type = int, help = "The number of encrypted chapters in a book" )
+	argumentParser.add_argument( "--chapter-size", default = 1024 * 64, type = int, help = "The size of a chapter in bytes" )
+	argumentParser.add_argument( "--jobs", "-j", default = 4, type = int, help = "The number of books to download in parallel" )
+	argumentParser.add_argument( "--decrypt-workers", default = 0, type = int, help = "The number of processes removing the DRM in get --all" )
+	argumentParser.add_argument( "--json", default = "", help = "Save the results to this JSON file" )
+	argumentParser.add_argument( "--baseline", default = "", help = "Compare the results with this JSON file saved by --json" )
+	argumentParser.add_argument( "--tolerance", default = 0.2, type = float, help = "The allowed slowdown compared to the baseline (0.2 = 20%%)" )
+	arguments = argumentParser.parse_args()
+
+	serverProcess, serverUrl = MockKoboServer.Start( bookCount = arguments.books, downloadableBookCount = min( arguments.downloads, arguments.books ),
+		wishListSize = arguments.wishlist, deviceId = DeviceId, userId = UserId, chapterCount = arguments.chapters, chapterSize = arguments.chapter_size,
+		pageSize = arguments.page_size )
+
+	workingDirectory = tempfile.mkdtemp( prefix = "kobo-book-downloader-benchmark-" )
+	try:
+		benchmark = Benchmark( arguments, workingDirectory )
+		benchmark.Initialize( serverUrl )
+		benchmark.Run()
+	finally:
+		serverProcess.terminate()
+		shutil.rmtree( workingDirectory, ignore_errors = True )
+
+	print( "" )
+	benchmark.PrintResults()
+
+	if len( arguments.json ) > 0:
+		with open( arguments.json, "w" ) as f:
+			json.dump( { "Arguments": vars( arguments ), "Results": benchmark.Results }, f, indent = 4 )
+
+	if len( arguments.baseline ) > 0:
+		regressions = benchmark.CompareWithBaseline( arguments.baseline, arguments.tolerance )
+		if len( regressions ) > 0:
+			print( "\nRegressions:\n" + "\n".join( regressions ) )
+			sys.exit( 1 )
+
+if __name__ == "__main__":
+	Main()
@@ -0,0 +1,265 @@
+from Crypto.Cipher import AES
+from Crypto.Util import Padding
+
+from typing import Dict, List, Tuple
+import base64
+import binascii
+import hashlib
+import http.server
+import io
+import json
+import multiprocessing
+import random
+import re
+import sys
+import urllib.parse
+import uuid
+import zipfile
+
+# A synthetic library served by MockKoboServer. Everything is generated from the seed, so the benchmark can generate the
+# same books in its own process to check the results.
+#
+# The books are KDRM encrypted EPUBs with known content keys. Only a few different books (templates) are generated, the
+# entitlements refer to them in turn. Books from DownloadableBookCount on are archived, so get --all skips them.
+class MockLibrary:
+	def __init__( self, bookCount: int, downloadableBookCount: int, wishListSize: int, deviceId: str, userId: str, chapterCount: int = 20,
+		chapterSize: int = 1024 * 64, imageSize: int = 1024 * 256, templateCount: int = 4, pageSize: int = 100, seed: int = 0 ):
+		self.BookCount = bookCount
+		self.DownloadableBookCount = downloadableBookCount
+		self.WishListSize = wishListSize
+		self.PageSize = pageSize
+		self.Templates = [] # type: List[ Tuple[ bytes, Dict[ str, str ] ] ]
+
+		deviceIdUserIdKey = binascii.a2b_hex( hashlib.sha256( ( deviceId + userId ).encode() ).hexdigest()[ 32: ] )
+		keyAes = AES.new( deviceIdUserIdKey, AES.MODE_ECB )
+		randomGenerator = random.Random( seed )
+		for templateIndex in range( templateCount ):
+			self.Templates.append( MockLibrary.__MakeBook( randomGenerator, keyAes, templateIndex, chapterCount, chapterSize, imageSize ) )
+
+	@staticmethod
+	def __MakeBook( randomGenerator: random.Random, keyAes, templateIndex: int, chapterCount: int, chapterSize: int, imageSize: int ) -> Tuple[ bytes, Dict[ str, str ] ]:
+		words = [ "kobo", "book", "chapter", "page", "reader", "story", "night", "light", "river", "stone" ]
+		contentKeys = {}
+		output = io.BytesIO()
+
+		with zipfile.ZipFile( output, "w" ) as outputZip:
+			outputZip.writestr( zipfile.ZipInfo( "mimetype" ), "application/epub+zip" )
+			outputZip.writestr( "META-INF/container.xml", "<container><rootfiles><rootfile full-path=\"OEBPS/content.opf\"/></rootfiles></container>", zipfile.ZIP_DEFLATED )
+			outputZip.writestr( "OEBPS/content.opf", "<package><metadata><title>Book %d</title></metadata></package>" % templateIndex, zipfile.ZIP_DEFLATED )
+
+			for chapterIndex in range( chapterCount ):
+				text = " ".join( randomGenerator.choice( words ) for _ in range( chapterSize // 6 ) )
+				contents = ( "<html><body><p>%s</p></body></html>" % text ).encode()[ :chapterSize ]
+				contentKey = randomGenerator.randbytes( 16 )
+				encryptedContents = AES.new( contentKey, AES.MODE_ECB ).encrypt( Padding.pad( contents, AES.block_size, "pkcs7" ) )
+
+				fileName = "OEBPS/chapter%03d.xhtml" % chapterIndex
+				outputZip.writestr( fileName, encryptedContents, zipfile.ZIP_DEFLATED )
+				contentKeys[ fileName ] = base64.b64encode( keyAes.encrypt( contentKey ) ).decode()
+
+			outputZip.writestr( "OEBPS/cover.jpg", randomGenerator.randbytes( imageSize ), zipfile.ZIP_DEFLATED )
+
+		return output.getvalue(), contentKeys
+
+	@staticmethod
+	def GetRevisionId( bookIndex: int ) -> str:
+		return str( uuid.UUID( int = bookIndex + 1 ) )
+
+	@staticmethod
+	def GetBookIndex( revisionId: str ) -> int:
+		return uuid.UUID( revisionId ).int - 1
+
+	def GetBookMetadata( self, bookIndex: int ) -> dict:
+		revisionId = MockLibrary.GetRevisionId( bookIndex )
+		return {
+			"ContributorRoles": [ { "Name": "Author %d" % ( bookIndex % 997 ) } ],
+			"CrossRevisionId": revisionId,
+			"EntitlementId": revisionId,
+			"RevisionId": revisionId,
+			"Title": "Book %d" % bookIndex
+		}
+
+	def GetEntitlement( self, bookIndex: int ) -> dict:
+		revisionId = MockLibrary.GetRevisionId( bookIndex )
+		return {
+			"NewEntitlement": {
+				"BookEntitlement": {
+					"Accessibility": "Full",
+					"Id": revisionId,
+					"IsLocked": False,
+					"IsRemoved": bookIndex >= self.DownloadableBookCount,
+					"LastModified": "2024-01-01T00:00:00Z"
+				},
+				"BookMetadata": self.GetBookMetadata( bookIndex ),
+				"ReadingState": {
+					"EntitlementId": revisionId,
+					"StatusInfo": { "Status": "Finished" if bookIndex % 3 == 0 else "ReadyToRead" }
+				}
+			}
+		}
+
+	def GetWishListItem( self, itemIndex: int ) -> dict:
+		return {
+			"ProductMetadata": {
+				"Book": {
+					"ContributorRoles": [ { "Name": "Author %d" % ( itemIndex % 997 ), "Role": "Author" } ],
+					"ISBN": "%013d" % ( 9780000000000 + itemIndex ),
+					"Title": "Wished book %d" % itemIndex
+				}
+			}
+		}
+
+	def GetTemplateIndex( self, bookIndex: int ) -> int:
+		return bookIndex % len( self.Templates )
+
+class MockKoboRequestHandler( http.server.BaseHTTPRequestHandler ):
+	protocol_version = "HTTP/1.1"
+
+	def log_message( self, *args ) -> None:
+		pass
+
+	def __SendJson( self, jsonObject, headers: Dict[ str, str ] = {} ) -> None:
+		body = json.dumps( jsonObject ).encode()
+		self.send_response( 200 )
+		self.send_header( "Content-Type", "application/json" )
+		self.send_header( "Content-Length", str( len( body ) ) )
+		for name, value in headers.items():
+			self.send_header( name, value )
+		self.end_headers()
+		self.wfile.write( body )
+
+	def __SendError( self, statusCode: int ) -> None:
+		self.send_response( statusCode )
+		self.send_header( "Content-Length", "0" )
+		self.end_headers()
+
+	def __GetBaseUrl( self ) -> str:
+		return "http://%s:%d/" % self.server.server_address[ :2 ]
+
+	def __SendInitialization( self ) -> None:
+		baseUrl = self.__GetBaseUrl()
+		self.__SendJson( { "Resources": {
+			"book": baseUrl + "v1/products/books/{ProductId}",
+			"content_access_book": baseUrl + "v1/products/books/{ProductId}/access",
+			"library_sync": baseUrl + "v1/library/sync",
+			"user_wishlist": baseUrl + "v1/user/wishlist"
+		} } )
+
+	def __SendAuthentication( self ) -> None:
+		self.rfile.read( int( self.headers.get( "Content-Length", "0" ) ) )
+		self.__SendJson( { "AccessToken": "access-" + uuid.uuid4().hex, "RefreshToken": "refresh-" + uuid.uuid4().hex, "TokenType": "Bearer", "UserKey": "user-key" } )
+
+	# The synchronization token is the index of the next page, or "done" after the last page.
+	def __SendLibrarySyncPage( self ) -> None:
+		library = self.server.Library
+		syncToken = self.headers.get( "x-kobo-synctoken", "" )
+		if syncToken == "done":
+			self.__SendJson( [], { "x-kobo-synctoken": "done" } )
+			return
+
+		if not re.match( r"^\d*$", syncToken ):
+			self.__SendError( 400 )
+			return
+
+		pageIndex = int( syncToken ) if len( syncToken ) > 0 else 0
+		start = pageIndex * library.PageSize
+		end = min( start + library.PageSize, library.BookCount )
+		bookList = [ library.GetEntitlement( bookIndex ) for bookIndex in range( start, end ) ]
+
+		if end < library.BookCount:
+			self.__SendJson( bookList, { "x-kobo-sync": "continue", "x-kobo-synctoken": str( pageIndex + 1 ) } )
+		else:
+			self.__SendJson( bookList, { "x-kobo-synctoken": "done" } )
+
+	def __SendWishListPage( self, query: dict ) -> None:
+		library = self.server.Library
+		pageIndex = int( query.get( "PageIndex", [ "0" ] )[ 0 ] )
+		pageSize = int( query.get( "PageSize", [ "100" ] )[ 0 ] )
+		if pageSize > 500:
+			self.__SendError( 400 )
+			return
+
+		start = pageIndex * pageSize
+		end = min( start + pageSize, library.WishListSize )
+		items = [ library.GetWishListItem( itemIndex ) for itemIndex in range( start, end ) ]
+		self.__SendJson( { "Items": items, "TotalPageCount": max( 1, ( library.WishListSize + pageSize - 1 ) // pageSize ) } )
+
+	def __SendContentAccessBook( self, revisionId: str ) -> None:
+		library = self.server.Library
+		templateIndex = library.GetTemplateIndex( MockLibrary.GetBookIndex( revisionId ) )
+		_, contentKeys = library.Templates[ templateIndex ]
+		self.__SendJson( {
+			"ContentKeys": [ { "Name": name, "Value": value } for name, value in contentKeys.items() ],
+			"ContentUrls": [ { "DRMType": "KDRM", "DownloadUrl": self.__GetBaseUrl() + "download/%d?b=1" % templateIndex, "UrlFormat": "EPUB3" } ]
+		} )
+
+	def __SendBook( self, templateIndex: int ) -> None:
+		book, _ = self.server.Library.Templates[ templateIndex ]
+		start = 0
+		match = re.match( r"bytes=(\d+)-$", self.headers.get( "Range", "" ) )
+		if match is not None:
+			start = int( match.group( 1 ) )
+
+		self.send_response( 206 if match is not None else 200 )
+		self.send_header( "Accept-Ranges", "bytes" )
+		self.send_header( "Content-Length", str( len( book ) - start ) )
+		self.send_header( "Content-Type", "application/epub+zip" )
+		self.send_header( "ETag", "\"book-%d\"" % templateIndex )
+		if match is not None:
+			self.send_header( "Content-Range", "bytes %d-%d/%d" % ( start, len( book ) - 1, len( book ) ) )
+		self.end_headers()
+		self.wfile.write( book[ start: ] )
+
+	def do_GET( self ) -> None:
+		parsed = urllib.parse.urlparse( self.path )
+		query = urllib.parse.parse_qs( parsed.query )
+		path = parsed.path
+
+		if path == "/v1/initialization":
+			self.__SendInitialization()
+		elif path == "/v1/library/sync":
+			self.__SendLibrarySyncPage()
+		elif path == "/v1/user/wishlist":
+			self.__SendWishListPage( query )
+		elif re.match( r"^/v1/products/books/[^/]+/access$", path ):
+			self.__SendContentAccessBook( path.split( "/" )[ 4 ] )
+		elif re.match( r"^/v1/products/books/[^/]+$", path ):
+			self.__SendJson( self.server.Library.GetBookMetadata( MockLibrary.GetBookIndex( path.split( "/" )[ 4 ] ) ) )
+		elif re.match( r"^/download/\d+$", path ):
+			self.__SendBook( int( path.split( "/" )[ 2 ] ) )
+		else:
+			self.__SendError( 404 )
+
+	def do_POST( self ) -> None:
+		if self.path in [ "/v1/auth/device", "/v1/auth/refresh" ]:
+			self.__SendAuthentication()
+		else:
+			self.__SendError( 404 )
+
+class MockKoboServer( http.server.ThreadingHTTPServer ):
+	daemon_threads = True
+	request_queue_size = 128
+
+	def __init__( self, library: MockLibrary ):
+		super().__init__( ( "127.0.0.1", 0 ), MockKoboRequestHandler )
+		self.Library = library
+
+	# The client can close the connection early, for example when it doesn't need a prefetched page.
+	def handle_error( self, request, clientAddress ) -> None:
+		if not isinstance( sys.exc_info()[ 1 ], ConnectionError ):
+			super().handle_error( request, clientAddress )
+
+	# Runs the server in a separate process, so it doesn't compete with the benchmarked code for the GIL. Returns with the
+	# process and the URL of the server.
+	@staticmethod
+	def Start( **libraryArguments ) -> Tuple[ multiprocessing.Process, str ]:
+		portQueue = multiprocessing.Queue()
+		process = multiprocessing.Process( target = _RunServer, args = ( libraryArguments, portQueue ), daemon = True )
+		process.start()
+		port = portQueue.get( timeout = 60 )
+		return process, "http://127.0.0.1:%d/" % port
+
+def _RunServer( libraryArguments: dict, portQueue: multiprocessing.Queue ) -> None:
+	server = MockKoboServer( MockLibrary( **libraryArguments ) )
+	portQueue.put( server.server_address[ 1 ] )
+	server.serve_forever()
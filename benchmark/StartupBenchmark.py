@@ -0,0 +1,223 @@
+# Measures how fast the commands start, because the program is often run from scripts many times a day. For each command
+# it reports the time until the first output and until the exit, and the time spent importing modules (from python -X
+# importtime). The commands that need the Kobo API run against MockKoboServer.
+#
+# Usage:
+#   python benchmark/StartupBenchmark.py --runs 20
+#   python benchmark/StartupBenchmark.py --json startup.json
+#   python benchmark/StartupBenchmark.py --baseline startup.json   Fails if a command got slower than the tolerance allows.
+
+import os
+import sys
+
+ProgramPath = os.path.join( os.path.dirname( os.path.dirname( os.path.abspath( __file__ ) ) ), "kobo-book-downloader" )
+sys.path.insert( 0, ProgramPath )
+
+from Benchmark import DeviceId, UserId, GetPercentile
+from KoboDrmRemover import KoboDrmRemover
+from MockKoboServer import MockKoboServer
+from Settings import Settings
+
+from typing import List, Optional, Tuple
+import argparse
+import json
+import shutil
+import statistics
+import subprocess
+import tempfile
+import time
+
+# Runs the program with the API URL of the mock server. The Kobo module is imported by these commands anyway.
+MockApiWrapper = "import sys; sys.path.insert( 0, %r ); import Kobo; Kobo.KoboSession.ApiUrl = %r; import runpy; sys.argv[ 0 ] = %r; runpy.run_path( %r, run_name = '__main__' )"
+
+# The modules that are reported if a command imports them.
+HeavyModules = [ "requests", "Crypto" ]
+
+class StartupBenchmark:
+	def __init__( self, arguments: argparse.Namespace, workingDirectory: str, serverUrl: str ):
+		self.Arguments = arguments
+		self.WorkingDirectory = workingDirectory
+		self.ServerUrl = serverUrl
+		self.Environment = dict( os.environ, XDG_CONFIG_HOME = workingDirectory, PYTHONUNBUFFERED = "1" )
+		self.Results = []
+
+	def Initialize( self ) -> None:
+		# The settings, the library and the cache go to the working directory instead of the user's configuration.
+		os.environ[ "XDG_CONFIG_HOME" ] = self.WorkingDirectory
+		settings = Settings()
+		settings.DeviceId = DeviceId
+		settings.SerialNumber = "benchmark"
+		settings.UserId = UserId
+		settings.UserKey = "user-key"
+		settings.AccessToken = "access"
+		settings.RefreshToken = "refresh"
+		settings.Save()
+
+		# An already decrypted book, so decrypt has something to print without decrypting anything.
+		self.EncryptedDirectory = os.path.join( self.WorkingDirectory, "encrypted" )
+		self.DecryptedDirectory = os.path.join( self.WorkingDirectory, "decrypted" )
+		os.mkdir( self.EncryptedDirectory )
+		os.mkdir( self.DecryptedDirectory )
+		encryptedBookPath = os.path.join( self.EncryptedDirectory, "book.epub" + KoboDrmRemover.EncryptedBookExtension )
+		with open( encryptedBookPath, "wb" ):
+			pass
+		KoboDrmRemover.SaveContentKeys( encryptedBookPath, "book", {} )
+		with open( os.path.join( self.DecryptedDirectory, "book.epub" ), "wb" ):
+			pass
+
+	def __GetCommandLine( self, arguments: List[ str ], usesNetwork: bool, pythonOptions: List[ str ] ) -> List[ str ]:
+		if usesNetwork:
+			return [ sys.executable ] + pythonOptions + [ "-c", MockApiWrapper % ( ProgramPath, self.ServerUrl, ProgramPath, ProgramPath ) ] + arguments
+
+		return [ sys.executable ] + pythonOptions + [ ProgramPath ] + arguments
+
+	# Returns with the seconds until the first byte of the output and until the exit.
+	def __Run( self, arguments: List[ str ], usesNetwork: bool ) -> Tuple[ float, float ]:
+		startTime = time.perf_counter()
+		process = subprocess.Popen( self.__GetCommandLine( arguments, usesNetwork, [] ), stdin = subprocess.DEVNULL, stdout = subprocess.PIPE,
+			stderr = subprocess.PIPE, env = self.Environment )
+		process.stdout.read( 1 )
+		firstOutputSeconds = time.perf_counter() - startTime
+		_, errors = process.communicate()
+		exitSeconds = time.perf_counter() - startTime
+
+		if process.returncode != 0 or len( errors ) > 0:
+			raise Exception( "'%s' has failed: %s" % ( " ".join( arguments ), errors.decode( errors = "replace" ) ) )
+
+		return firstOutputSeconds, exitSeconds
+
+	# Returns with the seconds spent importing the modules and the names of the imported top level packages.
+	def __MeasureImports( self, arguments: List[ str ], usesNetwork: bool ) -> Tuple[ float, List[ str ] ]:
+		process = subprocess.run( self.__GetCommandLine( arguments, usesNetwork, [ "-X", "importtime" ] ), stdin = subprocess.DEVNULL,
+			stdout = subprocess.DEVNULL, stderr = subprocess.PIPE, env = self.Environment )
+
+		# The lines look like this: "import time:       529 |       3140 |   requests.utils". The nesting is in the indentation.
+		importMicroseconds = 0
+		packages = set()
+		for line in process.stderr.decode( errors = "replace" ).splitlines():
+			if not line.startswith( "import time:" ):
+				continue
+
+			columns = line[ len( "import time:" ): ].split( "|" )
+			if len( columns ) != 3 or not columns[ 1 ].strip().isdigit():
+				continue
+
+			name = columns[ 2 ].rstrip()
+			if not name.startswith( "  " ):
+				importMicroseconds += int( columns[ 1 ] )
+			packages.add( name.strip().split( "." )[ 0 ] )
+
+		return importMicroseconds / 1000000, sorted( packages )
+
+	def RunCommand( self, name: str, arguments: List[ str ], usesNetwork: bool = False ) -> None:
+		print( "Running %s..." % name )
+
+		# The first run warms up the file system cache and the library of the mock server.
+		self.__Run( arguments, usesNetwork )
+
+		firstOutputTimes = []
+		exitTimes = []
+		for _ in range( self.Arguments.runs ):
+			firstOutputSeconds, exitSeconds = self.__Run( arguments, usesNetwork )
+			firstOutputTimes.append( firstOutputSeconds )
+			exitTimes.append( exitSeconds )
+
+		importSeconds, packages = self.__MeasureImports( arguments, usesNetwork )
+
+		self.Results.append( {
+			"ExitMilliseconds": statistics.median( exitTimes ) * 1000,
+			"ExitP90Milliseconds": GetPercentile( sorted( exitTimes ), 90 ) * 1000,
+			"FirstOutputMilliseconds": statistics.median( firstOutputTimes ) * 1000,
+			"HeavyModules": [ module for module in HeavyModules if module in packages ],
+			"ImportMilliseconds": importSeconds * 1000,
+			"Name": name
+		} )
+
+	def Run( self ) -> None:
+		# The interpreter alone, as a reference.
+		pythonTimes = []
+		for _ in range( self.Arguments.runs ):
+			startTime = time.perf_counter()
+			subprocess.run( [ sys.executable, "-c", "pass" ], check = True )
+			pythonTimes.append( time.perf_counter() - startTime )
+
+		self.Results.append( {
+			"ExitMilliseconds": statistics.median( pythonTimes ) * 1000,
+			"ExitP90Milliseconds": GetPercentile( sorted( pythonTimes ), 90 ) * 1000,
+			"FirstOutputMilliseconds": None,
+			"HeavyModules": [],
+			"ImportMilliseconds": None,
+			"Name": "python -c pass"
+		} )
+
+		self.RunCommand( "usage", [] )
+		self.RunCommand( "get --help", [ "get", "--help" ] )
+		self.RunCommand( "info", [ "info" ] )
+		self.RunCommand( "decrypt", [ "decrypt", self.EncryptedDirectory, self.DecryptedDirectory ] )
+		self.RunCommand( "list", [ "list", "--all" ], usesNetwork = True )
+		self.RunCommand( "list --unsorted", [ "list", "--all", "--unsorted" ], usesNetwork = True )
+		self.RunCommand( "wishlist", [ "wishlist" ], usesNetwork = True )
+
+	def PrintResults( self ) -> None:
+		def Format( value: Optional[ float ], format: str ) -> str:
+			return "-" if value is None else format % value
+
+		print( "%-20s %16s %9s %12s %10s  %s" % ( "Command", "First output ms", "Exit ms", "Exit p90 ms", "Import ms", "Heavy modules" ) )
+		for result in self.Results:
+			print( "%-20s %16s %9.1f %12.1f %10s  %s" % ( result[ "Name" ], Format( result[ "FirstOutputMilliseconds" ], "%.1f" ), result[ "ExitMilliseconds" ],
+				result[ "ExitP90Milliseconds" ], Format( result[ "ImportMilliseconds" ], "%.1f" ), ", ".join( result[ "HeavyModules" ] ) or "-" ) )
+
+	# Returns with the commands that have become slower than the tolerance allows.
+	def CompareWithBaseline( self, baselinePath: str, tolerance: float ) -> List[ str ]:
+		with open( baselinePath, "r" ) as f:
+			baseline = json.load( f )
+
+		baselineResults = { result[ "Name" ]: result for result in baseline[ "Results" ] }
+		regressions = []
+		for result in self.Results:
+			baselineResult = baselineResults.get( result[ "Name" ] )
+			if baselineResult is None:
+				continue
+
+			if result[ "ExitMilliseconds" ] > baselineResult[ "ExitMilliseconds" ] * ( 1 + tolerance ):
+				regressions.append( "%s: %.1f ms instead of %.1f" % ( result[ "Name" ], result[ "ExitMilliseconds" ], baselineResult[ "ExitMilliseconds" ] ) )
+
+		return regressions
+
+def Main() -> None:
+	argumentParser = argparse.ArgumentParser( description = "Measure the startup time of the kobo-book-downloader commands." )
+	argumentParser.add_argument( "--runs", default = 10, type = int, help = "The number of times each command is run" )
+	argumentParser.add_argument( "--books", default = 1000, type = int, help = "The number of books in the library of the mock server" )
+	argumentParser.add_argument( "--wishlist", default = 100, type = int, help = "The number of books on the wish list of the mock server" )
+	argumentParser.add_argument( "--json", default = "", help = "Save the results to this JSON file" )
+	argumentParser.add_argument( "--baseline", default = "", help = "Compare the results with this JSON file saved by --json" )
+	argumentParser.add_argument( "--tolerance", default = 0.2, type = float, help = "The allowed slowdown compared to the baseline (0.2 = 20%%)" )
+	arguments = argumentParser.parse_args()
+
+	serverProcess, serverUrl = MockKoboServer.Start( bookCount = arguments.books, downloadableBookCount = arguments.books, wishListSize = arguments.wishlist,
+		deviceId = DeviceId, userId = UserId )
+
+	workingDirectory = tempfile.mkdtemp( prefix = "kobo-book-downloader-startup-" )
+	try:
+		benchmark = StartupBenchmark( arguments, workingDirectory, serverUrl )
+		benchmark.Initialize()
+		benchmark.Run()
+	finally:
+		serverProcess.terminate()
+		shutil.rmtree( workingDirectory, ignore_errors = True )
+
+	print( "" )
+	benchmark.PrintResults()
+
+	if len( arguments.json ) > 0:
+		with open( arguments.json, "w" ) as f:
+			json.dump( { "Arguments": vars( arguments ), "Results": benchmark.Results }, f, indent = 4 )
+
+	if len( arguments.baseline ) > 0:
+		regressions = benchmark.CompareWithBaseline( arguments.baseline, arguments.tolerance )
+		if len( regressions ) > 0:
+			print( "\nRegressions:\n" + "\n".join( regressions ) )
+			sys.exit( 1 )
+
+if __name__ == "__main__":
+	Main()
@@ -1,11 +1,21 @@
+from CompressionPolicy import CompressionPolicy
+from ContentAccessResolver import ContentAccessResolver
+from DecryptionPool import DecryptionPool
+from DownloadManifest import DownloadManifest
 from Globals import Globals
-from Kobo import Kobo, KoboException
+from KoboException import KoboException
+from KoboDrmRemover import KoboDrmRemover
+from RunReport import RunReport
 
 import colorama
 
+from typing import Callable, Iterable, Iterator, Optional, TextIO, Tuple
+import concurrent.futures
 import os
 
 class Commands:
+	QueuedBooksPerJob = 2 # get --all reads ahead in the library only this many books per parallel download.
+
 	# It wasn't possible to format the main help message to my liking, so using a custom one.
 	# This was the most annoying:
 	#
@@ -24,34 +34,46 @@ Usage:
   kobo-book-downloader [--help] command ...
 
 Commands:
+  decrypt  Remove the DRM from books downloaded with get --keep-encrypted
   get      Download book
   info     Show the location of the configuration file
   list     List your books
   pick     Download books using interactive selection
+  serve    Keep running and accept download, list and wishlist jobs over a local HTTP API
   wishlist List your wish listed books
 
 Optional arguments:
   -h, --help    Show this help message and exit
   --verbose     Print debugging information
+  --full-sync   Synchronize the whole library instead of only the changes since the last run
+  --no-cache    Don't use the cached book metadata and settings of the Kobo store
 
 Examples:
   kobo-book-downloader get /dir/book.epub 01234567-89ab-cdef-0123-456789abcdef   Download book
   kobo-book-downloader get /dir/ 01234567-89ab-cdef-0123-456789abcdef            Download book and name the file automatically
   kobo-book-downloader get /dir/ --all                                           Download all your books
+  kobo-book-downloader get /dir/ --all --jobs 4                                  Download all your books, four at a time
+  kobo-book-downloader get /dir/ --all --skip-downloaded                         Download your new and changed books only
+  kobo-book-downloader get /dir/ --all --jobs 8 --decrypt-workers 4              Download all your books and remove the DRM on four processes
+  kobo-book-downloader get /dir/ --all --keep-encrypted                          Download all your books without removing the DRM
+  kobo-book-downloader decrypt /dir/ /other-dir/                                 Remove the DRM from the books downloaded with --keep-encrypted
+  kobo-book-downloader get /dir/ --all --compression store-media                 Download all your books and don't compress the images in them
+  kobo-book-downloader get /dir/ --all --report report.json                      Download all your books and save the timings of each book
   kobo-book-downloader info                                                      Show the location of the program's configuration file
   kobo-book-downloader list                                                      List your unread books
   kobo-book-downloader list --all                                                List all your books
+  kobo-book-downloader list --unsorted                                           List your unread books as they arrive, without sorting them by title
+  kobo-book-downloader --full-sync list                                          List your unread books after synchronizing the whole library
   kobo-book-downloader list --help                                               Get additional help for the list command (it works for get and pick too)
   kobo-book-downloader pick /dir/                                                Interactively select unread books to download
   kobo-book-downloader pick /dir/ --all                                          Interactively select books to download
-  kobo-book-downloader wishlist                                                  List your wish listed books"""
+  kobo-book-downloader wishlist                                                  List your wish listed books
+  kobo-book-downloader serve --socket /tmp/kobo.sock --output-root /dir/         Accept jobs on a Unix socket (see the readme for the API)"""
 
 		print( usage )
 
 	@staticmethod
-	def __GetBookAuthor( book: dict ) -> str:
-		contributors = book.get( "ContributorRoles" )
-
+	def __GetBookAuthor( contributors: list ) -> str:
 		authors = []
 		for contributor in contributors:
 			role = contributor.get( "Role" )
@@ -78,143 +100,328 @@ Examples:
 		return result
 
 	@staticmethod
-	def __MakeFileNameForBook( book: dict ) -> str:
+	def __MakeFileNameForBook( title: str, contributors: list ) -> str:
+		return Commands.__MakeFileName( title, Commands.__GetBookAuthor( contributors ) )
+
+	@staticmethod
+	def __MakeFileName( title: str, author: str ) -> str:
 		fileName = ""
 
-		author = Commands.__GetBookAuthor( book )
 		if len( author ) > 0:
 			fileName = author + " - "
 
-		fileName += book[ "Title" ]
+		fileName += title
 		fileName = Commands.__SanitizeFileName( fileName )
 		fileName += ".epub"
 
 		return fileName
 
+	# The name of the file comes from the local copy of the library if the book is there. Otherwise the book info is
+	# requested, and the content access of the book is resolved meanwhile.
 	@staticmethod
-	def __IsBookArchived( newEntitlement: dict ) -> bool:
-		bookEntitlement = newEntitlement.get( "BookEntitlement" )
-		if bookEntitlement is None:
-			return False
+	def __GetBook( revisionId: str, outputPath: str, keepEncrypted: bool, output: Optional[ TextIO ] = None ) -> None:
+		resolver = ContentAccessResolver( Globals.Kobo, Globals.Kobo.DisplayProfile )
+		Globals.Kobo.ContentAccessResolver = resolver
+
+		try:
+			if os.path.isdir( outputPath ):
+				book = Globals.Kobo.GetLibraryBook( revisionId )
+				if book is None:
+					resolver.Resolve( revisionId )
+					bookInfo = Globals.Kobo.GetBookInfo( revisionId )
+					fileName = Commands.__MakeFileNameForBook( bookInfo[ "Title" ], bookInfo.get( "ContributorRoles", [] ) )
+				else:
+					fileName = Commands.__MakeFileNameForBook( book.Title, book.ContributorRoles )
+
+				outputPath = os.path.join( outputPath, fileName )
+			else:
+				parentPath = os.path.dirname( outputPath )
+				if not os.path.isdir( parentPath ):
+					raise KoboException( "The parent directory ('%s') of the output file must exist." % parentPath )
+
+			print( "Downloading book to '%s'." % outputPath, file = output )
+			Globals.Kobo.Download( revisionId, Globals.Kobo.DisplayProfile, outputPath, keepEncrypted )
+		finally:
+			Globals.Kobo.ContentAccessResolver = None
+			resolver.Close()
 
-		isRemoved = bookEntitlement.get( "IsRemoved" )
-		if isRemoved is None:
-			return False
+	@staticmethod
+	def __DownloadBook( revisionId: str, outputFilePath: str, lastModified: str, manifest: Optional[ DownloadManifest ], keepEncrypted: bool,
+		output: Optional[ TextIO ] = None ) -> None:
+		print( "Downloading book to '%s'." % outputFilePath, file = output )
+		outputFilePath = Globals.Kobo.Download( revisionId, Globals.Kobo.DisplayProfile, outputFilePath, keepEncrypted )
 
-		return isRemoved
+		if manifest is not None:
+			manifest.AddBook( revisionId, outputFilePath, lastModified )
 
+	# Calls the function with the items of each book on a pool of worker threads. The first item must identify the book. A
+	# failing book doesn't stop the others, the failures are reported together at the end.
+	#
+	# The books can come from a generator: the next book is taken only when there is room in the queue of the workers, so a
+	# slow producer doesn't delay the first books and a fast one doesn't fill the memory.
 	@staticmethod
-	def __GetBook( revisionId: str, outputPath: str ) -> None:
-		if os.path.isdir( outputPath ):
-			book = Globals.Kobo.GetBookInfo( revisionId )
-			fileName = Commands.__MakeFileNameForBook( book )
-			outputPath = os.path.join( outputPath, fileName )
-		else:
-			parentPath = os.path.dirname( outputPath )
-			if not os.path.isdir( parentPath ):
-				raise KoboException( "The parent directory ('%s') of the output file must exist." % parentPath )
+	def __ProcessBooks( function: Callable, books: Iterable[ tuple ], jobs: int, pastTenseVerb: str ) -> None:
+		failures = []
+		bookCount = 0
+
+		with concurrent.futures.ThreadPoolExecutor( max_workers = jobs ) as executor:
+			futureToBook = {}
 
-		print( "Downloading book to '%s'." % outputPath )
-		Globals.Kobo.Download( revisionId, Kobo.DisplayProfile, outputPath )
+			def OnBookProcessed( future: concurrent.futures.Future ) -> None:
+				book = futureToBook.pop( future )
+				exception = future.exception()
+				if exception is not None:
+					Globals.Logger.error( "Book '%s' could not be %s: %s" % ( book[ 0 ], pastTenseVerb, exception ) )
+					failures.append( book[ 0 ] )
 
+			try:
+				for book in books:
+					bookCount += 1
+					future = executor.submit( function, *book )
+					futureToBook[ future ] = book
+
+					if len( futureToBook ) >= jobs * Commands.QueuedBooksPerJob:
+						done, _ = concurrent.futures.wait( futureToBook, return_when = concurrent.futures.FIRST_COMPLETED )
+						for future in done:
+							OnBookProcessed( future )
+
+				for future in concurrent.futures.as_completed( list( futureToBook ) ):
+					OnBookProcessed( future )
+			except BaseException:
+				# Don't start the queued books if the user has interrupted us (or the producer has failed).
+				for future in futureToBook:
+					future.cancel()
+				raise
+
+		if len( failures ) > 0:
+			raise KoboException( "%d of %d books could not be %s: %s" % ( len( failures ), bookCount, pastTenseVerb, ", ".join( failures ) ) )
+
+	# The content access of the next books is resolved while the current ones are being downloaded, so their transfer can
+	# start right away.
 	@staticmethod
-	def __GetAllBooks( outputPath: str ) -> None:
-		if not os.path.isdir( outputPath ):
-			raise KoboException( "The output path must be a directory when downloading all books." )
+	def __DownloadBooks( books: Iterable[ Tuple[ str, str, str ] ], jobs: int, manifest: Optional[ DownloadManifest ], keepEncrypted: bool,
+		output: Optional[ TextIO ] = None ) -> None:
+		# The content access requests and the library synchronization share the connection pool with the downloads.
+		Globals.Kobo.Session.SetConcurrency( jobs + ContentAccessResolver.Concurrency + 1 )
 
-		bookList = Globals.Kobo.GetMyBookList()
+		def DownloadBook( revisionId: str, outputFilePath: str, lastModified: str ) -> None:
+			Commands.__DownloadBook( revisionId, outputFilePath, lastModified, manifest, keepEncrypted, output )
 
-		for entitlement in bookList:
-			newEntitlement = entitlement.get( "NewEntitlement" )
-			if newEntitlement is None:
-				continue
+		resolver = ContentAccessResolver( Globals.Kobo, Globals.Kobo.DisplayProfile )
+		Globals.Kobo.ContentAccessResolver = resolver
 
-			bookMetadata = newEntitlement.get( "BookMetadata" )
-			if bookMetadata is None:
-				continue
+		try:
+			Commands.__ProcessBooks( DownloadBook, resolver.ResolveAhead( books ), jobs, "downloaded" )
+		finally:
+			Globals.Kobo.ContentAccessResolver = None
+			resolver.Close()
 
-			fileName = Commands.__MakeFileNameForBook( bookMetadata )
-			outputFilePath = os.path.join( outputPath, fileName )
+			if manifest is not None:
+				manifest.Save()
+
+	# Yields the books to download while the library is being synchronized, so the downloads can start before the
+	# synchronization finishes.
+	@staticmethod
+	def __GetBooksToDownload( outputPath: str, manifest: Optional[ DownloadManifest ], keepEncrypted: bool, output: Optional[ TextIO ] = None ) -> Iterator[ Tuple[ str, str, str ] ]:
+		upToDateBookCount = 0
+
+		for book in Globals.Kobo.GetMyBooks():
+			# Skip saved previews and refunded books.
+			if book.IsPreview or book.IsLocked:
+				Globals.Logger.debug( "Skipping book '%s' because it is a preview or it has been refunded" % book.RevisionId )
+				continue
 
 			# Skip archived books.
-			if Commands.__IsBookArchived( newEntitlement ):
-				title = bookMetadata[ "Title" ]
-				author = Commands.__GetBookAuthor( bookMetadata )
+			if book.IsArchived:
+				title = book.Title
+				author = Commands.__GetBookAuthor( book.ContributorRoles )
 				if len( author ) > 0:
 					title += " by " + author
 
-				print( colorama.Fore.LIGHTYELLOW_EX + ( "Skipping archived book %s." % title ) + colorama.Fore.RESET )
+				print( colorama.Fore.LIGHTYELLOW_EX + ( "Skipping archived book %s." % title ) + colorama.Fore.RESET, file = output )
+				continue
+
+			fileName = Commands.__MakeFileNameForBook( book.Title, book.ContributorRoles )
+			outputFilePath = os.path.join( outputPath, fileName )
+
+			if ( manifest is not None ) and ( manifest.IsBookUpToDate( book.RevisionId, outputFilePath, book.LastModified ) or
+				( keepEncrypted and manifest.IsBookUpToDate( book.RevisionId, outputFilePath + KoboDrmRemover.EncryptedBookExtension, book.LastModified ) ) ):
+				Globals.Logger.debug( "Book '%s' is already downloaded to '%s'" % ( book.RevisionId, outputFilePath ) )
+				upToDateBookCount += 1
 				continue
 
-			print( "Downloading book to '%s'." % outputFilePath )
-			Globals.Kobo.Download( bookMetadata[ "RevisionId" ], Kobo.DisplayProfile, outputFilePath )
+			yield book.RevisionId, outputFilePath, book.LastModified
+
+		if upToDateBookCount > 0:
+			print( "Skipped %d already downloaded books." % upToDateBookCount, file = output )
+
+	@staticmethod
+	def __GetAllBooks( outputPath: str, jobs: int, skipDownloaded: bool, keepEncrypted: bool, output: Optional[ TextIO ] = None ) -> None:
+		if not os.path.isdir( outputPath ):
+			raise KoboException( "The output path must be a directory when downloading all books." )
+
+		manifest = DownloadManifest( outputPath ) if skipDownloaded else None
+		books = Commands.__GetBooksToDownload( outputPath, manifest, keepEncrypted, output )
+		Commands.__DownloadBooks( books, jobs, manifest, keepEncrypted, output )
 
+	# If reportPath is set then the timings of each book and the retry and token refresh counters are written to it as JSON
+	# (or as JSONL if it ends with .jsonl). The summary can be written as a Prometheus textfile too. The statistics are
+	# collected into runReport if it is given, so the progress of the downloads can be followed on it. The messages are
+	# printed to output, or to the standard output if it is not given.
 	@staticmethod
-	def GetBookOrBooks( revisionId: str, outputPath: str, getAll: bool ) -> None:
+	def GetBookOrBooks( revisionId: str, outputPath: str, getAll: bool, jobs: int = 1, skipDownloaded: bool = False, decryptWorkers: int = 0,
+		keepEncrypted: bool = False, compressionPolicy: Optional[ CompressionPolicy ] = None, reportPath: str = "", prometheusTextfilePath: str = "",
+		runReport: Optional[ RunReport ] = None, output: Optional[ TextIO ] = None ) -> None:
 		revisionIdIsSet = ( revisionId is not None ) and len( revisionId ) > 0
 
 		if getAll:
 			if revisionIdIsSet:
 				raise KoboException( "Got unexpected book identifier parameter ('%s')." % revisionId )
 
-			Commands.__GetAllBooks( outputPath )
+			if jobs < 1:
+				raise KoboException( "The number of parallel downloads must be at least 1." )
 		else:
 			if not revisionIdIsSet:
 				raise KoboException( "Missing book identifier parameter. Did you mean to use the --all parameter?" )
 
-			Commands.__GetBook( revisionId, outputPath )
+		if decryptWorkers < 0:
+			raise KoboException( "The number of decryption workers can't be negative." )
+
+		if decryptWorkers > 0:
+			Globals.Kobo.DecryptionPool = DecryptionPool( decryptWorkers, Globals.Settings.DeviceId, Globals.Settings.UserId )
+
+		if compressionPolicy is not None:
+			Globals.Kobo.CompressionPolicy = compressionPolicy
+
+		if ( runReport is None ) and ( len( reportPath ) > 0 or len( prometheusTextfilePath ) > 0 ):
+			runReport = RunReport()
+
+		Globals.Kobo.RunReport = runReport
+
+		try:
+			if getAll:
+				Commands.__GetAllBooks( outputPath, jobs, skipDownloaded, keepEncrypted, output )
+			else:
+				Commands.__GetBook( revisionId, outputPath, keepEncrypted, output )
+		finally:
+			if Globals.Kobo.DecryptionPool is not None:
+				Globals.Kobo.DecryptionPool.Close()
+				Globals.Kobo.DecryptionPool.PrintThroughput( output )
+				Globals.Kobo.DecryptionPool = None
+
+			# The report is written even if some books have failed, that's when it is the most useful.
+			if Globals.Kobo.RunReport is not None:
+				if len( reportPath ) > 0:
+					Globals.Kobo.RunReport.Write( reportPath )
+				if len( prometheusTextfilePath ) > 0:
+					Globals.Kobo.RunReport.WritePrometheusTextfile( prometheusTextfilePath )
+				Globals.Kobo.RunReport = None
 
 	@staticmethod
-	def __IsBookRead( newEntitlement: dict ) -> bool:
-		readingState = newEntitlement.get( "ReadingState" )
-		if readingState is None:
-			return False
+	def __DecryptBook( inputFilePath: str, outputFilePath: str, decryptionPool: Optional[ DecryptionPool ], compressionPolicy: CompressionPolicy ) -> None:
+		print( "Decrypting book to '%s'." % outputFilePath )
+
+		contentKeys = KoboDrmRemover.LoadContentKeys( inputFilePath )
+		temporaryOutputFilePath = outputFilePath + ".decrypting"
+
+		try:
+			if decryptionPool is None:
+				drmRemover = KoboDrmRemover.Get( Globals.Settings.DeviceId, Globals.Settings.UserId )
+				drmRemover.RemoveDrm( inputFilePath, temporaryOutputFilePath, contentKeys, compressionPolicy )
+			else:
+				decryptionPool.RemoveDrm( inputFilePath, temporaryOutputFilePath, contentKeys, compressionPolicy )
 
-		statusInfo = readingState.get( "StatusInfo" )
-		if statusInfo is None:
-			return False
+			os.replace( temporaryOutputFilePath, outputFilePath )
+		except:
+			if os.path.isfile( temporaryOutputFilePath ):
+				os.remove( temporaryOutputFilePath )
 
-		status = statusInfo.get( "Status" )
-		return status == "Finished"
+			raise
 
+	# Removes the DRM from the books downloaded with get --keep-encrypted. It doesn't use the network, only the device and
+	# user identifiers from the configuration file. Books that have already been decrypted are skipped.
 	@staticmethod
-	def __GetBookList( listAll: bool ) -> list:
-		bookList = Globals.Kobo.GetMyBookList()
-		rows = []
+	def DecryptBooks( inputPath: str, outputPath: str, decryptWorkers: int, compressionPolicy: CompressionPolicy ) -> None:
+		if not os.path.isdir( inputPath ):
+			raise KoboException( "The input path must be a directory." )
+
+		if not os.path.isdir( outputPath ):
+			raise KoboException( "The output path must be a directory." )
+
+		if decryptWorkers < 0:
+			raise KoboException( "The number of decryption workers can't be negative." )
+
+		if not Globals.Settings.IsLoggedIn():
+			raise KoboException( "Not logged in. Use the configuration file of the program that downloaded the books (see the info command)." )
+
+		books = []
+		upToDateBookCount = 0
+
+		for fileName in sorted( os.listdir( inputPath ) ):
+			if not fileName.endswith( KoboDrmRemover.EncryptedBookExtension ):
+				continue
 
-		for entitlement in bookList:
-			newEntitlement = entitlement.get( "NewEntitlement" )
-			if newEntitlement is None:
+			inputFilePath = os.path.join( inputPath, fileName )
+			if not os.path.isfile( inputFilePath + KoboDrmRemover.ContentKeysExtension ):
+				Globals.Logger.debug( "Skipping '%s' because its content keys are missing" % inputFilePath )
 				continue
 
-			bookEntitlement = newEntitlement.get( "BookEntitlement" )
-			if bookEntitlement is None:
+			outputFilePath = os.path.join( outputPath, fileName[ :-len( KoboDrmRemover.EncryptedBookExtension ) ] )
+			if os.path.isfile( outputFilePath ) and os.path.getmtime( outputFilePath ) >= os.path.getmtime( inputFilePath ):
+				upToDateBookCount += 1
 				continue
 
+			books.append( ( inputFilePath, outputFilePath ) )
+
+		if upToDateBookCount > 0:
+			print( "Skipping %d already decrypted books." % upToDateBookCount )
+
+		decryptionPool = None
+		if decryptWorkers > 0:
+			decryptionPool = DecryptionPool( decryptWorkers, Globals.Settings.DeviceId, Globals.Settings.UserId )
+
+		def DecryptBook( inputFilePath: str, outputFilePath: str ) -> None:
+			Commands.__DecryptBook( inputFilePath, outputFilePath, decryptionPool, compressionPolicy )
+
+		try:
+			Commands.__ProcessBooks( DecryptBook, books, max( 1, decryptWorkers ), "decrypted" )
+		finally:
+			if decryptionPool is not None:
+				decryptionPool.Close()
+				decryptionPool.PrintThroughput()
+
+	@staticmethod
+	def __GetBookRows( listAll: bool ) -> Iterator[ list ]:
+		for book in Globals.Kobo.GetMyBooks():
 			# Skip saved previews.
-			if bookEntitlement.get( "Accessibility" ) == "Preview":
+			if book.IsPreview:
 				continue
 
 			# Skip refunded books.
-			if bookEntitlement.get( "IsLocked" ):
+			if book.IsLocked:
 				continue
 
-			if ( not listAll ) and Commands.__IsBookRead( newEntitlement ):
+			if ( not listAll ) and book.IsRead:
 				continue
 
-			bookMetadata = newEntitlement[ "BookMetadata" ]
-			book = [ bookMetadata[ "RevisionId" ],
-				bookMetadata[ "Title" ],
-				Commands.__GetBookAuthor( bookMetadata ),
-				Commands.__IsBookArchived( newEntitlement ) ]
-			rows.append( book )
+			row = [ book.RevisionId,
+				book.Title,
+				Commands.__GetBookAuthor( book.ContributorRoles ),
+				book.IsArchived ]
+			yield row
 
+	# Returns the rows of the list command sorted by title. The columns are the revision identifier, the title, the author
+	# and whether the book is archived.
+	@staticmethod
+	def GetBookList( listAll: bool ) -> list:
+		rows = Commands.__GetBookRows( listAll )
 		rows = sorted( rows, key = lambda columns: columns[ 1 ].lower() )
 		return rows
 
+	# If sortRows is not set then the books are printed as soon as they arrive.
 	@staticmethod
-	def ListBooks( listAll: bool ) -> None:
-		rows = Commands.__GetBookList( listAll )
+	def ListBooks( listAll: bool, sortRows: bool = True ) -> None:
+		rows = Commands.GetBookList( listAll ) if sortRows else Commands.__GetBookRows( listAll )
 		for columns in rows:
 			revisionId = colorama.Style.DIM + columns[ 0 ] + colorama.Style.RESET_ALL
 			title = colorama.Style.BRIGHT + columns[ 1 ] + colorama.Style.RESET_ALL
@@ -269,8 +476,13 @@ Examples:
 
 		return rowsToDownload
 
+	# The rows already have the title and the author, so the book info doesn't have to be requested for the file names.
 	@staticmethod
 	def __DownloadPickedBooks( outputPath: str, rows: list ) -> None:
+		if not os.path.isdir( outputPath ):
+			raise KoboException( "The output path must be a directory when picking books." )
+
+		books = []
 		for columns in rows:
 			revisionId = columns[ 0 ]
 			title = columns[ 1 ]
@@ -283,17 +495,21 @@ Examples:
 
 				print( colorama.Fore.LIGHTYELLOW_EX + ( "Skipping archived book %s." % title ) + colorama.Fore.RESET )
 			else:
-				Commands.GetBookOrBooks( revisionId, outputPath, False )
+				outputFilePath = os.path.join( outputPath, Commands.__MakeFileName( title, author ) )
+				books.append( ( revisionId, outputFilePath, "" ) )
+
+		Commands.__DownloadBooks( books, 1, None, False )
 
 	@staticmethod
 	def PickBooks( outputPath: str, listAll: bool ) -> None:
-		rows = Commands.__GetBookList( listAll )
+		rows = Commands.GetBookList( listAll )
 		Commands.__ListBooksToPickFrom( rows )
 		rowsToDownload = Commands.__GetPickedBookRows( rows )
 		Commands.__DownloadPickedBooks( outputPath, rowsToDownload )
 
+	# Returns the wish listed books sorted by title. The columns are the title, the author and the ISBN.
 	@staticmethod
-	def ListWishListedBooks() -> None:
+	def GetWishList() -> list:
 		rows = []
 
 		wishList = Globals.Kobo.GetMyWishList()
@@ -306,21 +522,30 @@ Examples:
 			if book is None:
 				continue
 
-			title = colorama.Style.BRIGHT + book[ "Title" ] + colorama.Style.RESET_ALL
-			author = Commands.__GetBookAuthor( book )
-			isbn = book.get( "ISBN", "" )
+			rows.append( [ book[ "Title" ], Commands.__GetBookAuthor( book.get( "ContributorRoles", [] ) ), book.get( "ISBN", "" ) ] )
+
+		return sorted( rows, key = lambda columns: ( columns[ 0 ].lower(), columns[ 1 ].lower(), columns[ 2 ] ) )
 
-			row = title
+	@staticmethod
+	def ListWishListedBooks() -> None:
+		lines = []
+		for columns in Commands.GetWishList():
+			line = colorama.Style.BRIGHT + columns[ 0 ] + colorama.Style.RESET_ALL
+
+			author = columns[ 1 ]
 			if len( author ) > 0:
-				row += " by " + author
+				line += " by " + author
+
+			isbn = columns[ 2 ]
 			if len( isbn ) > 0:
-				row += " (ISBN: %s)" % isbn
+				line += " (ISBN: %s)" % isbn
 
-			rows.append( row )
+			lines.append( line )
 
-		rows = sorted( rows, key = lambda row: row.lower() )
-		print( "\n".join( rows ) )
+		print( "\n".join( lines ) )
 
 	@staticmethod
 	def Info():
 		print( "The configuration file is located at:\n%s" % Globals.Settings.SettingsFilePath )
+		print( "The local copy of the library is located at:\n%s" % Globals.Settings.LibraryFilePath )
+		print( "The metadata cache is located at:\n%s" % Globals.Settings.MetadataCacheFilePath )
@@ -0,0 +1,40 @@
+from typing import Optional, Tuple
+import os
+import zipfile
+
+# Decides how the entries of the DRM-free EPUBs are compressed.
+#
+# - Preserve: the entries that are copied unchanged keep the compression they had in the downloaded book. The decrypted
+#   entries are deflated: the compression of an encrypted entry is the compression of its ciphertext, which says
+#   nothing about the plaintext (and the ciphertext doesn't compress, so it is usually stored).
+# - StoreMedia: already compressed media (images, audio, video, WOFF fonts) are stored, the rest is deflated.
+# - Deflate: every entry is deflated.
+#
+# The mimetype entry is always stored, as the EPUB specification requires. Deflating uses the given compression level
+# (0-9), or zlib's default if it is not set.
+class CompressionPolicy:
+	Preserve = "preserve"
+	StoreMedia = "store-media"
+	Deflate = "deflate"
+	Modes = [ Preserve, StoreMedia, Deflate ]
+
+	MediaExtensions = [ ".gif", ".jpeg", ".jpg", ".m4a", ".mp3", ".mp4", ".png", ".webp", ".woff", ".woff2" ]
+
+	def __init__( self, mode: str = Preserve, level: Optional[ int ] = None ):
+		self.Mode = mode
+		self.Level = level
+
+	# Returns with the compression type and level. isDecrypted tells whether the entry is decrypted or copied unchanged.
+	def GetCompression( self, zipInfo: zipfile.ZipInfo, isDecrypted: bool ) -> Tuple[ int, Optional[ int ] ]:
+		if zipInfo.filename == "mimetype":
+			return zipfile.ZIP_STORED, None
+
+		if self.Mode == CompressionPolicy.Preserve and not isDecrypted:
+			return zipInfo.compress_type, self.Level
+
+		if self.Mode == CompressionPolicy.StoreMedia:
+			extension = os.path.splitext( zipInfo.filename )[ 1 ].lower()
+			if extension in CompressionPolicy.MediaExtensions:
+				return zipfile.ZIP_STORED, None
+
+		return zipfile.ZIP_DEFLATED, self.Level
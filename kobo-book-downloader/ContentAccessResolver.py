@@ -0,0 +1,62 @@
+from typing import Iterable, Iterator, TYPE_CHECKING
+import collections
+import concurrent.futures
+import threading
+
+if TYPE_CHECKING:
+	from Kobo import Kobo
+
+# Gets the content access information of the books (download URLs, DRM type and content keys) on a pool of threads, so it
+# is already there when the download of the book starts. Kobo.Download uses it if it is set as Kobo.ContentAccessResolver.
+class ContentAccessResolver:
+	Concurrency = 8
+	Lookahead = 16 # How many books ResolveAhead resolves before they are downloaded.
+
+	def __init__( self, kobo: "Kobo", displayProfile: str ):
+		self.Kobo = kobo
+		self.DisplayProfile = displayProfile
+		self.Executor = concurrent.futures.ThreadPoolExecutor( max_workers = ContentAccessResolver.Concurrency, thread_name_prefix = "ContentAccess" )
+		self.Lock = threading.Lock()
+		self.Futures = {} # type: dict[ str, concurrent.futures.Future ]
+
+	def __enter__( self ):
+		return self
+
+	def __exit__( self, *args ):
+		self.Close()
+
+	def Close( self ) -> None:
+		with self.Lock:
+			for future in self.Futures.values():
+				future.cancel()
+			self.Futures.clear()
+
+		self.Executor.shutdown()
+
+	# Starts getting the content access information of the book in the background.
+	def Resolve( self, productId: str ) -> None:
+		with self.Lock:
+			if productId not in self.Futures:
+				self.Futures[ productId ] = self.Executor.submit( self.Kobo.GetContentAccessBook, productId, self.DisplayProfile )
+
+	# Waits for the content access information of the book. It is requested now if Resolve hasn't been called for the book.
+	def Get( self, productId: str ) -> dict:
+		self.Resolve( productId )
+
+		with self.Lock:
+			future = self.Futures.pop( productId )
+
+		return future.result()
+
+	# Passes through the books, but the content access of the next Lookahead books is already being resolved when a book is
+	# returned. The first item of the books must be the product identifier.
+	def ResolveAhead( self, books: Iterable[ tuple ] ) -> Iterator[ tuple ]:
+		queuedBooks = collections.deque()
+		for book in books:
+			self.Resolve( book[ 0 ] )
+			queuedBooks.append( book )
+			if len( queuedBooks ) > ContentAccessResolver.Lookahead:
+				yield queuedBooks.popleft()
+
+		while len( queuedBooks ) > 0:
+			yield queuedBooks.popleft()
@@ -0,0 +1,99 @@
+from CompressionPolicy import CompressionPolicy
+from KoboDrmRemover import KoboDrmRemover
+
+from typing import Dict, Optional, TextIO, Tuple
+import concurrent.futures
+import os
+import threading
+import time
+
+# These run in the worker processes.
+
+def _RemoveDrm( deviceId: str, userId: str, inputPath: str, outputPath: str, contentKeys: Dict[ str, str ], compressionPolicy: CompressionPolicy ) -> Tuple[ int, float, float ]:
+	startTime = time.perf_counter()
+	drmRemover = KoboDrmRemover.Get( deviceId, userId )
+	decryptSeconds = drmRemover.RemoveDrm( inputPath, outputPath, contentKeys, compressionPolicy )
+	return os.getpid(), time.perf_counter() - startTime, decryptSeconds
+
+def _DecryptContents( deviceId: str, userId: str, contents: bytes, contentKeyBase64: str ) -> Tuple[ int, float, bytes ]:
+	startTime = time.perf_counter()
+	drmRemover = KoboDrmRemover.Get( deviceId, userId )
+	decryptedContents = drmRemover.DecryptContents( contents, contentKeyBase64 )
+	return os.getpid(), time.perf_counter() - startTime, decryptedContents
+
+# Removes the DRM on a pool of processes, so bulk downloads can use all the CPU cores. Normal books are decrypted by a
+# single worker each. The entries of big books are spread across the workers instead.
+#
+# The workers are started when the first book is submitted, from a download thread, while the other downloads, the
+# library synchronization and the token refresher are running. A forked worker could inherit a lock held by one of them
+# (the lock of KoboDrmRemover.Get or of a logging handler) and wait for it forever, so the workers are spawned instead.
+class DecryptionPool:
+	LargeBookSize = 1024 * 1024 * 64
+
+	def __init__( self, workerCount: int, deviceId: str, userId: str ):
+		self.DeviceId = deviceId
+		self.UserId = userId
+		# multiprocessing is imported only here, because Commands imports this module for every command.
+		import multiprocessing
+		self.Executor = concurrent.futures.ProcessPoolExecutor( max_workers = workerCount, mp_context = multiprocessing.get_context( "spawn" ) )
+		self.Lock = threading.Lock()
+		# Process identifier -> [ job count, bytes, seconds ]. A job is a whole book or an entry of a big book.
+		self.WorkerStatistics = {} # type: dict[ int, list ]
+
+	def __enter__( self ):
+		return self
+
+	def __exit__( self, *args ):
+		self.Close()
+
+	def Close( self ) -> None:
+		self.Executor.shutdown()
+
+	def __AddStatistics( self, processId: int, byteCount: int, seconds: float ) -> None:
+		with self.Lock:
+			statistics = self.WorkerStatistics.setdefault( processId, [ 0, 0, 0.0 ] )
+			statistics[ 0 ] += 1
+			statistics[ 1 ] += byteCount
+			statistics[ 2 ] += seconds
+
+	def __DecryptContentsInWorker( self, contents: bytes, contentKeyBase64: str ) -> concurrent.futures.Future:
+		byteCount = len( contents )
+		decryptedContents = concurrent.futures.Future()
+
+		def OnDone( future: concurrent.futures.Future ) -> None:
+			try:
+				processId, seconds, result = future.result()
+			except BaseException as e:
+				decryptedContents.set_exception( e )
+				return
+
+			self.__AddStatistics( processId, byteCount, seconds )
+			decryptedContents.set_result( result )
+
+		future = self.Executor.submit( _DecryptContents, self.DeviceId, self.UserId, contents, contentKeyBase64 )
+		future.add_done_callback( OnDone )
+		return decryptedContents
+
+	# Blocks until the book is decrypted. It can be called from several threads at the same time.
+	#
+	# Returns with the time spent decrypting and the time of the whole DRM removal, without the time the book was waiting
+	# for a free worker.
+	def RemoveDrm( self, inputPath: str, outputPath: str, contentKeys: Dict[ str, str ], compressionPolicy: CompressionPolicy ) -> Tuple[ float, float ]:
+		byteCount = os.path.getsize( inputPath )
+		if byteCount >= DecryptionPool.LargeBookSize:
+			startTime = time.perf_counter()
+			drmRemover = KoboDrmRemover.Get( self.DeviceId, self.UserId )
+			decryptSeconds = drmRemover.RemoveDrm( inputPath, outputPath, contentKeys, compressionPolicy, self.__DecryptContentsInWorker )
+			return decryptSeconds, time.perf_counter() - startTime
+
+		future = self.Executor.submit( _RemoveDrm, self.DeviceId, self.UserId, inputPath, outputPath, contentKeys, compressionPolicy )
+		processId, seconds, decryptSeconds = future.result()
+		self.__AddStatistics( processId, byteCount, seconds )
+		return decryptSeconds, seconds
+
+	def PrintThroughput( self, output: Optional[ TextIO ] = None ) -> None:
+		with self.Lock:
+			for processId, ( count, byteCount, seconds ) in sorted( self.WorkerStatistics.items() ):
+				megabytes = byteCount / ( 1024 * 1024 )
+				throughput = ( megabytes / seconds ) if seconds > 0 else 0
+				print( "Decryption worker %d: %d jobs, %.1f MB in %.1f s (%.1f MB/s)." % ( processId, count, megabytes, seconds, throughput ), file = output )
@@ -0,0 +1,78 @@
+import hashlib
+import json
+import os
+import threading
+import time
+
+# Remembers the books that have been downloaded into a directory, so they don't have to be downloaded again if they
+# haven't changed on Kobo since then.
+class DownloadManifest:
+	FileName = ".kobo-book-downloader-manifest.json"
+	SaveInterval = 10 # seconds
+
+	def __init__( self, directoryPath: str ):
+		self.FilePath = os.path.join( directoryPath, DownloadManifest.FileName )
+		self.Books = {} # type: dict[ str, dict ]
+		self.Lock = threading.Lock()
+		self.LastSaveTime = time.monotonic()
+
+		self.Load()
+
+	def Load( self ) -> None:
+		if not os.path.isfile( self.FilePath ):
+			return
+
+		with open( self.FilePath, "r" ) as f:
+			jsonObject = json.loads( f.read() )
+			self.Books = jsonObject.get( "Books", {} )
+
+	# The manifest is written to a temporary file first, so an interrupted run can't leave a corrupted manifest behind.
+	def Save( self ) -> None:
+		temporaryFilePath = self.FilePath + ".saving"
+		with open( temporaryFilePath, "w" ) as f:
+			jsonObject = { "Books": self.Books }
+			f.write( json.dumps( jsonObject, indent = 4 ) )
+
+		os.replace( temporaryFilePath, self.FilePath )
+		self.LastSaveTime = time.monotonic()
+
+	@staticmethod
+	def __GetFileHash( filePath: str ) -> str:
+		sha256 = hashlib.sha256()
+		with open( filePath, "rb" ) as f:
+			while True:
+				chunk = f.read( 1024 * 256 )
+				if len( chunk ) == 0:
+					break
+				sha256.update( chunk )
+
+		return sha256.hexdigest()
+
+	# Only the size of the file is checked, calculating its hash for every book on every run would defeat the purpose.
+	def IsBookUpToDate( self, revisionId: str, outputPath: str, lastModified: str ) -> bool:
+		book = self.Books.get( revisionId )
+		if book is None:
+			return False
+
+		if book[ "FileName" ] != os.path.basename( outputPath ) or book[ "LastModified" ] != lastModified:
+			return False
+
+		try:
+			return os.stat( outputPath ).st_size == book[ "Size" ]
+		except OSError:
+			return False
+
+	# Rewriting the whole manifest after each book would be slow for big libraries, so it is saved periodically only. The
+	# caller must call Save at the end.
+	def AddBook( self, revisionId: str, outputPath: str, lastModified: str ) -> None:
+		book = {
+			"FileName": os.path.basename( outputPath ),
+			"LastModified": lastModified,
+			"Sha256": DownloadManifest.__GetFileHash( outputPath ),
+			"Size": os.stat( outputPath ).st_size
+		}
+
+		with self.Lock:
+			self.Books[ revisionId ] = book
+			if time.monotonic() - self.LastSaveTime >= DownloadManifest.SaveInterval:
+				self.Save()
@@ -0,0 +1,463 @@
+from Commands import Commands
+from CompressionPolicy import CompressionPolicy
+from Globals import Globals
+from KoboException import KoboException
+from RunReport import RunReport
+
+from typing import Dict, Optional
+import collections
+import hmac
+import http.server
+import json
+import os
+import queue
+import re
+import secrets
+import socket
+import socketserver
+import stat
+import threading
+import time
+import traceback
+
+# The printed output of a job, without the colors. Only the last lines are kept.
+class JobOutput:
+	LineCount = 1000
+	AnsiEscapeRegex = re.compile( r"\x1b\[[0-9;]*[A-Za-z]" )
+
+	def __init__( self ):
+		self.Lock = threading.Lock()
+		self.Lines = collections.deque( maxlen = JobOutput.LineCount )
+		self.PartialLine = ""
+
+	# The downloading threads print too, so this is called from several threads.
+	def write( self, text: str ) -> int:
+		with self.Lock:
+			lines = ( self.PartialLine + JobOutput.AnsiEscapeRegex.sub( "", text ) ).split( "\n" )
+			self.PartialLine = lines.pop()
+			self.Lines.extend( lines )
+
+		return len( text )
+
+	def flush( self ) -> None:
+		pass
+
+	def GetLines( self ) -> list:
+		with self.Lock:
+			lines = list( self.Lines )
+			if len( self.PartialLine ) > 0:
+				lines.append( self.PartialLine )
+
+		return lines
+
+class Job:
+	Queued = "queued"
+	Running = "running"
+	Succeeded = "succeeded"
+	Failed = "failed"
+	Cancelled = "cancelled"
+
+	def __init__( self, jobId: int, command: str, parameters: dict ):
+		self.Id = jobId
+		self.Command = command
+		self.Parameters = parameters
+		self.State = Job.Queued
+		self.SubmitTime = time.time()
+		self.StartTime = None # type: float | None
+		self.EndTime = None # type: float | None
+		self.Output = JobOutput()
+		self.RunReport = None # type: RunReport | None
+		self.Result = None # type: list | None
+		self.Error = ""
+
+	def IsFinished( self ) -> bool:
+		return self.State in [ Job.Succeeded, Job.Failed, Job.Cancelled ]
+
+	# The output and the result are left out of the list of the jobs.
+	def ToJson( self, withDetails: bool ) -> dict:
+		jsonObject = {
+			"Command": self.Command,
+			"EndTime": self.EndTime,
+			"Error": self.Error,
+			"Id": self.Id,
+			"Parameters": self.Parameters,
+			"Progress": None if self.RunReport is None else self.RunReport.GetSummary(),
+			"StartTime": self.StartTime,
+			"State": self.State,
+			"SubmitTime": self.SubmitTime
+		}
+
+		if withDetails:
+			jsonObject[ "Output" ] = self.Output.GetLines()
+			jsonObject[ "Result" ] = self.Result
+
+		return jsonObject
+
+class JobRequestHandler( http.server.BaseHTTPRequestHandler ):
+	MaximumBodySize = 64 * 1024
+
+	# The client address is an empty string on a Unix socket, so the default implementation (that prints it) can't be used.
+	def log_message( self, format: str, *args ) -> None:
+		Globals.Logger.debug( "JobServer: " + ( format % args ) )
+
+	def __SendJson( self, statusCode: int, jsonObject, headers: Dict[ str, str ] = {} ) -> None:
+		body = json.dumps( jsonObject, indent = 4 ).encode()
+		self.send_response( statusCode )
+		self.send_header( "Content-Type", "application/json" )
+		self.send_header( "Content-Length", str( len( body ) ) )
+		for name, value in headers.items():
+			self.send_header( name, value )
+		self.end_headers()
+		self.wfile.write( body )
+
+	def __SendError( self, statusCode: int, message: str, headers: Dict[ str, str ] = {} ) -> None:
+		self.__SendJson( statusCode, { "Error": message }, headers )
+
+	# Web pages can send requests to 127.0.0.1 too. The Host header of a page that was loaded from another name (by DNS
+	# rebinding) is that name, and the pages don't know the token. On the Unix socket neither is checked, only the user can
+	# connect to it.
+	def __IsAllowed( self ) -> bool:
+		if self.server.AllowedHosts is not None and self.headers.get( "Host", "" ).lower() not in self.server.AllowedHosts:
+			self.__SendError( 403, "The Host header must be one of: %s." % ", ".join( self.server.AllowedHosts ) )
+			return False
+
+		if self.server.Token is not None:
+			authorization = self.headers.get( "Authorization", "" )
+			if not hmac.compare_digest( authorization.encode(), ( "Bearer " + self.server.Token ).encode() ):
+				self.__SendError( 401, "The token (Authorization: Bearer <token>) is missing or wrong.", { "WWW-Authenticate": "Bearer" } )
+				return False
+
+		return True
+
+	# Returns None if the path is not the path of a job.
+	def __GetJob( self ) -> Optional[ Job ]:
+		match = re.match( r"^/jobs/(\d+)$", self.path )
+		if match is None:
+			return None
+
+		return self.server.JobServer.GetJob( int( match.group( 1 ) ) )
+
+	def do_GET( self ) -> None:
+		if not self.__IsAllowed():
+			return
+
+		if self.path == "/jobs":
+			self.__SendJson( 200, self.server.JobServer.GetJobsJson() )
+			return
+
+		job = self.__GetJob()
+		if job is None:
+			self.__SendError( 404, "There is no such job." )
+		else:
+			self.__SendJson( 200, self.server.JobServer.GetJobJson( job, True ) )
+
+	def do_POST( self ) -> None:
+		if not self.__IsAllowed():
+			return
+
+		if self.path != "/jobs":
+			self.__SendError( 404, "Jobs can be submitted to /jobs." )
+			return
+
+		# Pages can only send text/plain, form and multipart bodies without asking (with a preflight request) first.
+		contentType = self.headers.get( "Content-Type", "" ).split( ";" )[ 0 ].strip().lower()
+		if contentType != "application/json":
+			self.__SendError( 415, "The Content-Type of the job must be application/json." )
+			self.close_connection = True
+			return
+
+		# The end of the body is not known without a valid length, so the connection can't be used for the next request.
+		try:
+			contentLength = int( self.headers.get( "Content-Length", "0" ) )
+		except ValueError:
+			contentLength = -1
+
+		if contentLength < 0:
+			self.__SendError( 400, "The Content-Length header must be a number that is not negative." )
+			self.close_connection = True
+			return
+
+		if contentLength > JobRequestHandler.MaximumBodySize:
+			self.__SendError( 413, "The job is too big." )
+			self.close_connection = True
+			return
+
+		try:
+			jobJson = json.loads( self.rfile.read( contentLength ) )
+			job = self.server.JobServer.Submit( jobJson )
+		except ( ValueError, KoboException ) as e:
+			self.__SendError( 400, str( e ) )
+			return
+
+		self.__SendJson( 202, self.server.JobServer.GetJobJson( job, False ), { "Location": "/jobs/%d" % job.Id } )
+
+	def do_DELETE( self ) -> None:
+		if not self.__IsAllowed():
+			return
+
+		job = self.__GetJob()
+		if job is None:
+			self.__SendError( 404, "There is no such job." )
+		elif not self.server.JobServer.Cancel( job ):
+			self.__SendError( 409, "Only queued jobs can be cancelled." )
+		else:
+			self.__SendJson( 200, self.server.JobServer.GetJobJson( job, False ) )
+
+class JobHttpServer( http.server.ThreadingHTTPServer ):
+	daemon_threads = True
+
+	def __init__( self, port: int, jobServer: "JobServer", token: str ):
+		super().__init__( ( "127.0.0.1", port ), JobRequestHandler )
+		self.JobServer = jobServer
+		self.Token = token # type: str | None
+		self.AllowedHosts = [ "127.0.0.1:%d" % self.server_address[ 1 ], "localhost:%d" % self.server_address[ 1 ] ] # type: list | None
+
+if hasattr( socketserver, "UnixStreamServer" ):
+	class JobUnixServer( socketserver.ThreadingMixIn, socketserver.UnixStreamServer ):
+		daemon_threads = True
+
+		def __init__( self, socketPath: str, jobServer: "JobServer" ):
+			# Only the user can connect to the socket. The mode is set by the umask, so there is no moment when others could.
+			oldUmask = os.umask( 0o177 )
+			try:
+				super().__init__( socketPath, JobRequestHandler )
+			finally:
+				os.umask( oldUmask )
+
+			self.JobServer = jobServer
+			self.Token = None # type: str | None
+			self.AllowedHosts = None # type: list | None
+
+# Keeps the Kobo session (with its pooled connections and tokens) alive and runs the jobs submitted through a local HTTP
+# API, so each download or listing doesn't have to start the program, initialize the API and open new connections.
+#
+# The API listens on a Unix socket or on 127.0.0.1. On 127.0.0.1 every request must have the token that is written to
+# TokenFilePath at the start. The books can only be downloaded into the output root.
+#
+# - POST /jobs with { "Command": "get", "OutputPath": "/dir/", "All": true, "Jobs": 4 } (or "list", "wishlist") queues a job.
+# - GET /jobs lists the jobs, GET /jobs/<id> returns the state, the progress, the printed output and the result of a job.
+# - DELETE /jobs/<id> cancels a queued job.
+#
+# The jobs run one at a time, because the options of the downloads are set on the shared Kobo instance.
+class JobServer:
+	FinishedJobCount = 100 # Only this many finished jobs are remembered.
+	ParameterTypeNames = { bool: "boolean", int: "number", str: "string" }
+
+	def __init__( self, outputRoot: str ):
+		self.OutputRoot = os.path.realpath( outputRoot )
+		self.TokenFilePath = os.path.join( os.path.dirname( Globals.Settings.SettingsFilePath ), "kobo-book-downloader-serve.token" )
+		self.Lock = threading.Lock()
+		self.Jobs = collections.OrderedDict() # type: collections.OrderedDict[ int, Job ]
+		self.NextJobId = 1
+		self.Queue = queue.Queue() # type: queue.Queue[ Job ]
+
+	def GetJob( self, jobId: int ) -> Optional[ Job ]:
+		with self.Lock:
+			return self.Jobs.get( jobId )
+
+	def GetJobJson( self, job: Job, withDetails: bool ) -> dict:
+		with self.Lock:
+			return job.ToJson( withDetails )
+
+	def GetJobsJson( self ) -> list:
+		with self.Lock:
+			return [ job.ToJson( False ) for job in self.Jobs.values() ]
+
+	@staticmethod
+	def __GetParameter( jobJson: dict, name: str, parameterType: type, default ):
+		value = jobJson.get( name, default )
+		# bool is a subclass of int, but it is not a valid number.
+		if ( not isinstance( value, parameterType ) ) or ( parameterType is int and isinstance( value, bool ) ):
+			raise KoboException( "The %s parameter must be a %s." % ( name, JobServer.ParameterTypeNames[ parameterType ] ) )
+
+		return value
+
+	# Returns the parameters of the command with their defaults.
+	@staticmethod
+	def __GetParameters( jobJson: dict ) -> dict:
+		command = jobJson.get( "Command" )
+		parameters = { "FullSync": JobServer.__GetParameter( jobJson, "FullSync", bool, False ) }
+
+		if command == "get":
+			parameters[ "OutputPath" ] = JobServer.__GetParameter( jobJson, "OutputPath", str, "" )
+			parameters[ "RevisionId" ] = JobServer.__GetParameter( jobJson, "RevisionId", str, "" )
+			parameters[ "All" ] = JobServer.__GetParameter( jobJson, "All", bool, False )
+			parameters[ "Jobs" ] = JobServer.__GetParameter( jobJson, "Jobs", int, 1 )
+			parameters[ "SkipDownloaded" ] = JobServer.__GetParameter( jobJson, "SkipDownloaded", bool, False )
+			parameters[ "DecryptWorkers" ] = JobServer.__GetParameter( jobJson, "DecryptWorkers", int, 0 )
+			parameters[ "KeepEncrypted" ] = JobServer.__GetParameter( jobJson, "KeepEncrypted", bool, False )
+			parameters[ "Compression" ] = JobServer.__GetParameter( jobJson, "Compression", str, CompressionPolicy.Preserve )
+			parameters[ "CompressionLevel" ] = jobJson.get( "CompressionLevel" )
+
+			if len( parameters[ "OutputPath" ] ) == 0:
+				raise KoboException( "The OutputPath parameter is missing." )
+
+			if parameters[ "Compression" ] not in CompressionPolicy.Modes:
+				raise KoboException( "The Compression parameter must be one of: %s." % ", ".join( CompressionPolicy.Modes ) )
+
+			compressionLevel = parameters[ "CompressionLevel" ]
+			# range accepts 5.0 and True too.
+			if ( compressionLevel is not None ) and ( not isinstance( compressionLevel, int ) or isinstance( compressionLevel, bool ) or compressionLevel not in range( 0, 10 ) ):
+				raise KoboException( "The CompressionLevel parameter must be between 0 and 9." )
+		elif command == "list":
+			parameters[ "All" ] = JobServer.__GetParameter( jobJson, "All", bool, False )
+		elif command != "wishlist":
+			raise KoboException( "The Command parameter must be get, list or wishlist." )
+
+		return parameters
+
+	# A relative path is relative to the output root. The symbolic links are resolved, so they can't lead out of it either.
+	def __GetOutputPath( self, outputPath: str ) -> str:
+		outputPath = os.path.realpath( os.path.join( self.OutputRoot, outputPath ) )
+		if os.path.commonpath( [ self.OutputRoot, outputPath ] ) != self.OutputRoot:
+			raise KoboException( "The OutputPath parameter must be inside '%s'." % self.OutputRoot )
+
+		return outputPath
+
+	def Submit( self, jobJson ) -> Job:
+		if not isinstance( jobJson, dict ):
+			raise KoboException( "The job must be a JSON object." )
+
+		parameters = JobServer.__GetParameters( jobJson )
+		if "OutputPath" in parameters:
+			parameters[ "OutputPath" ] = self.__GetOutputPath( parameters[ "OutputPath" ] )
+
+		with self.Lock:
+			job = Job( self.NextJobId, jobJson[ "Command" ], parameters )
+			self.NextJobId += 1
+			self.Jobs[ job.Id ] = job
+
+		self.Queue.put( job )
+		return job
+
+	# Returns False if the job has already been started.
+	def Cancel( self, job: Job ) -> bool:
+		with self.Lock:
+			if job.State != Job.Queued:
+				return False
+
+			job.State = Job.Cancelled
+			job.EndTime = time.time()
+			self.__ForgetFinishedJobs()
+			return True
+
+	# Must be called with the lock held.
+	def __ForgetFinishedJobs( self ) -> None:
+		finishedJobIds = [ jobId for jobId, job in self.Jobs.items() if job.IsFinished() ]
+		for jobId in finishedJobIds[ : max( 0, len( finishedJobIds ) - JobServer.FinishedJobCount ) ]:
+			del self.Jobs[ jobId ]
+
+	@staticmethod
+	def __RunCommand( job: Job ) -> None:
+		parameters = job.Parameters
+
+		if parameters[ "FullSync" ]:
+			Globals.Kobo.ResetLibrary()
+
+		if job.Command == "get":
+			compressionPolicy = CompressionPolicy( parameters[ "Compression" ], parameters[ "CompressionLevel" ] )
+			Commands.GetBookOrBooks( parameters[ "RevisionId" ], parameters[ "OutputPath" ], parameters[ "All" ], parameters[ "Jobs" ], parameters[ "SkipDownloaded" ],
+				parameters[ "DecryptWorkers" ], parameters[ "KeepEncrypted" ], compressionPolicy, runReport = job.RunReport, output = job.Output )
+		elif job.Command == "list":
+			job.Result = [ { "Author": author, "IsArchived": archived, "RevisionId": revisionId, "Title": title }
+				for revisionId, title, author, archived in Commands.GetBookList( parameters[ "All" ] ) ]
+		elif job.Command == "wishlist":
+			job.Result = [ { "Author": author, "ISBN": isbn, "Title": title } for title, author, isbn in Commands.GetWishList() ]
+
+	def __RunJob( self, job: Job ) -> None:
+		with self.Lock:
+			if job.State != Job.Queued:
+				return
+
+			job.State = Job.Running
+			job.StartTime = time.time()
+			if job.Command == "get":
+				job.RunReport = RunReport()
+
+		print( "Job %d (%s) has started." % ( job.Id, job.Command ), flush = True )
+
+		state = Job.Succeeded
+		error = ""
+		try:
+			JobServer.__RunCommand( job )
+		except KoboException as e:
+			state = Job.Failed
+			error = str( e )
+		except Exception as e:
+			state = Job.Failed
+			error = "%s: %s" % ( type( e ).__name__, e )
+			Globals.Logger.debug( traceback.format_exc() )
+
+		with self.Lock:
+			job.State = state
+			job.Error = error
+			job.EndTime = time.time()
+			self.__ForgetFinishedJobs()
+
+		print( "Job %d has %s%s" % ( job.Id, state, ": " + error if len( error ) > 0 else "." ), flush = True )
+
+	def __RunJobs( self ) -> None:
+		while True:
+			self.__RunJob( self.Queue.get() )
+
+	@staticmethod
+	def __RemoveStaleSocket( socketPath: str ) -> None:
+		try:
+			mode = os.lstat( socketPath ).st_mode
+		except FileNotFoundError:
+			return
+
+		if not stat.S_ISSOCK( mode ):
+			raise KoboException( "'%s' exists and it is not a socket." % socketPath )
+
+		# Don't take over the socket of a running server.
+		with socket.socket( socket.AF_UNIX, socket.SOCK_STREAM ) as client:
+			try:
+				client.connect( socketPath )
+			except OSError:
+				os.remove( socketPath )
+				return
+
+		raise KoboException( "Another server is listening on '%s'." % socketPath )
+
+	# Only the user can read the file. It is created with that mode, and an existing file is truncated and has its mode fixed
+	# before the new token is written into it.
+	def __WriteToken( self, token: str ) -> None:
+		fileDescriptor = os.open( self.TokenFilePath, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600 )
+		with os.fdopen( fileDescriptor, "w" ) as f:
+			if hasattr( os, "fchmod" ):
+				os.fchmod( f.fileno(), 0o600 )
+			f.write( token + "\n" )
+
+	# Runs until it is interrupted. If socketPath is set then the API listens on that Unix socket, otherwise on the port.
+	def Serve( self, port: int, socketPath: str ) -> None:
+		if not os.path.isdir( self.OutputRoot ):
+			raise KoboException( "The output root '%s' is not a directory." % self.OutputRoot )
+
+		if len( socketPath ) > 0:
+			if not hasattr( socketserver, "UnixStreamServer" ):
+				raise KoboException( "Unix sockets are not supported on this system, use --port instead." )
+
+			JobServer.__RemoveStaleSocket( socketPath )
+			server = JobUnixServer( socketPath, self )
+			address = socketPath
+		else:
+			token = secrets.token_urlsafe( 32 )
+			server = JobHttpServer( port, self, token )
+			self.__WriteToken( token )
+			address = "http://127.0.0.1:%d/jobs (the token is in '%s')" % ( server.server_address[ 1 ], self.TokenFilePath )
+
+		threading.Thread( target = self.__RunJobs, name = "JobServer", daemon = True ).start()
+
+		print( "Listening on %s. Downloading into '%s'. Press Ctrl+C to stop." % ( address, self.OutputRoot ), flush = True )
+
+		try:
+			server.serve_forever()
+		except KeyboardInterrupt:
+			pass
+		finally:
+			server.server_close()
+			if len( socketPath ) > 0:
+				os.remove( socketPath )
+			else:
+				os.remove( self.TokenFilePath )
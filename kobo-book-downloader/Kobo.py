@@ -1,18 +1,35 @@
+from CompressionPolicy import CompressionPolicy
 from Globals import Globals
 from KoboDrmRemover import KoboDrmRemover
+from KoboException import KoboException
+from LibraryStore import LibraryBook, LibraryStore
+from RequestScheduler import RequestScheduler
+from RunReport import BookStatistics
 
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
-from typing import Dict, Tuple
+from typing import BinaryIO, Dict, Iterator, List, Optional, Tuple, TYPE_CHECKING
 import base64
+import concurrent.futures
 import html
+import json
 import os
 import re
 import secrets
 import string
+import tempfile
+import threading
 import time
 import urllib
 
+if TYPE_CHECKING:
+	from ContentAccessResolver import ContentAccessResolver
+	from DecryptionPool import DecryptionPool
+	from MetadataCache import MetadataCache
+	from RunReport import RunReport
+
 # It was not possible to enter the entire captcha response on MacOS.
 # Importing readline changes the implementation of input() and solves the issue.
 # See https://stackoverflow.com/q/65735885 and https://stackoverflow.com/q/7357007.
@@ -22,8 +39,14 @@ try:
 except ImportError:
 	pass
 
-class KoboException( Exception ):
-	pass
+# The encrypted book is downloaded into memory, and into an anonymous temporary file when it gets big. zipfile needs
+# readable and seekable to read from it, but SpooledTemporaryFile has them only since Python 3.11.
+class DownloadSpool( tempfile.SpooledTemporaryFile ):
+	def readable( self ) -> bool:
+		return True
+
+	def seekable( self ) -> bool:
+		return True
 
 # The hook's workflow is based on this:
 # https://github.com/requests/toolbelt/blob/master/requests_toolbelt/auth/http_proxy_digest.py
@@ -31,8 +54,6 @@ def ReauthenticationHook( r, *args, **kwargs ):
 	if r.status_code != requests.codes.unauthorized: # 401
 		return
 
-	Globals.Logger.debug( "Refreshing expired authentication token" )
-
 	# Consume content and release the original connection to allow our new request to reuse the same one.
 	r.content
 	r.close()
@@ -40,7 +61,7 @@ def ReauthenticationHook( r, *args, **kwargs ):
 	prep = r.request.copy()
 
 	# Refresh the authentication token and use it.
-	Globals.Kobo.RefreshAuthentication()
+	Globals.Kobo.RefreshAuthenticationIfNeeded( prep.headers.get( "Authorization", "" ) )
 	headers = Kobo.GetHeaderWithAccessToken()
 	prep.headers[ "Authorization" ] = headers[ "Authorization" ]
 
@@ -54,10 +75,124 @@ def ReauthenticationHook( r, *args, **kwargs ):
 
 	return _r
 
-class SessionWithTimeOut( requests.Session ):
+# Every request goes through the scheduler of its host, so parallel requests don't trip the rate limits of the servers.
+# The scheduler is consulted here instead of in the session, because the response hooks (like the reauthentication hook)
+# send requests too, and they must not wait for the slot of the request they are called from.
+#
+# The slot is held until the headers of the response arrive, including the retries of urllib3. The body of a streamed
+# download is read after that.
+#
+# Throttled (429 and 503) requests are retried here instead of in urllib3, so the scheduler learns about the throttling
+# right away, and the retry waits for the Retry-After and the lowered rate like every other request to the host.
+class ScheduledHTTPAdapter( HTTPAdapter ):
+	ThrottlingRetryCount = 5
+	ThrottlingRetryMethods = [ "GET", "HEAD" ]
+
+	def __init__( self, scheduler: RequestScheduler, **kwargs ):
+		self.Scheduler = scheduler
+		super().__init__( **kwargs )
+
+	def send( self, request, **kwargs ):
+		hostScheduler = self.Scheduler.GetHostScheduler( request.url )
+
+		for retry in range( ScheduledHTTPAdapter.ThrottlingRetryCount + 1 ):
+			hostScheduler.Acquire()
+
+			try:
+				response = super().send( request, **kwargs )
+			except requests.exceptions.RequestException:
+				hostScheduler.Release( None, False, True, 0.0 )
+				raise
+			except BaseException:
+				hostScheduler.Release( None, False, False, 0.0 )
+				raise
+
+			# The retries of urllib3 are only visible in the history of the response, see Kobo.__CountRetries.
+			statusCodes = [ response.status_code ]
+			retries = getattr( response.raw, "retries", None )
+			if retries is not None:
+				statusCodes += [ history.status for history in retries.history ]
+
+			throttled = any( statusCode in RequestScheduler.ThrottlingStatusCodes for statusCode in statusCodes )
+			failed = response.status_code >= 500
+			retryAfter = RequestScheduler.GetRetryAfter( response.headers ) if response.status_code in RequestScheduler.ThrottlingStatusCodes else 0.0
+			hostScheduler.Release( response.elapsed.total_seconds(), throttled, failed, retryAfter )
+
+			if response.status_code not in RequestScheduler.ThrottlingStatusCodes or request.method not in ScheduledHTTPAdapter.ThrottlingRetryMethods or \
+				retry == ScheduledHTTPAdapter.ThrottlingRetryCount:
+				response.ThrottlingRetryCount = retry
+				return response
+
+			response.close()
+
+# The store API and the download CDN get separate connection pools, timeouts and retries. The pools must be at least as
+# big as the number of parallel downloads, otherwise the connections that don't fit would be closed after each request.
+#
+# ApiUrl can be changed before the session is created to use another server, like the mock server of the benchmark. The
+# rest of the URLs come from the initialization settings.
+class KoboSession( requests.Session ):
+	ApiUrl = "https://storeapi.kobo.com/"
+	ApiTimeout = ( 10, 30 ) # Connection and read timeout in seconds.
+	DownloadTimeout = ( 10, 120 ) # The read timeout is for the time between two chunks, not for the whole download.
+	MinimumPoolSize = 10
+	RetryCount = 5
+	RetryBackoffFactor = 0.5 # Waits 0.5, 1, 2, 4... seconds between the retries.
+	RetryJitter = 1.0 # Up to one extra second, so parallel downloads don't retry at the same moment.
+
+	def __init__( self ):
+		super().__init__()
+		self.Scheduler = RequestScheduler()
+		self.PoolSize = 0
+		self.SetConcurrency( 1 )
+
+	@staticmethod
+	def __MakeRetry() -> Retry:
+		# Only idempotent requests are retried (POST is not in the default allowed_methods), and the last response is
+		# returned instead of raising an exception, so raise_for_status works as before.
+		retryArguments = {
+			"total": KoboSession.RetryCount,
+			"backoff_factor": KoboSession.RetryBackoffFactor,
+			# The throttling responses (429 and 503) are retried by ScheduledHTTPAdapter. urllib3 would retry them if they
+			# had a Retry-After header.
+			"status_forcelist": [ 500, 502, 504 ],
+			"respect_retry_after_header": False,
+			"raise_on_status": False,
+		}
+
+		try:
+			return Retry( backoff_jitter = KoboSession.RetryJitter, **retryArguments )
+		except TypeError:
+			# urllib3 1.x doesn't support jitter.
+			return Retry( **retryArguments )
+
+	def __Mount( self, prefix: str, adapter: HTTPAdapter ) -> None:
+		oldAdapter = self.adapters.get( prefix )
+		self.mount( prefix, adapter )
+		if oldAdapter is not None:
+			oldAdapter.close()
+
+	# The pools only grow. Replacing them closes their kept-alive connections, and the serve command calls this for every job.
+	def SetConcurrency( self, concurrency: int ) -> None:
+		poolSize = max( KoboSession.MinimumPoolSize, concurrency )
+		if poolSize <= self.PoolSize:
+			return
+
+		self.PoolSize = poolSize
+		self.__Mount( KoboSession.ApiUrl, ScheduledHTTPAdapter( self.Scheduler, pool_connections = 1, pool_maxsize = poolSize, max_retries = KoboSession.__MakeRetry() ) )
+		self.__Mount( "https://", ScheduledHTTPAdapter( self.Scheduler, pool_connections = 10, pool_maxsize = poolSize, max_retries = KoboSession.__MakeRetry() ) )
+
 	def request( self, method, url, **kwargs ):
 		if "timeout" not in kwargs:
-			kwargs[ "timeout" ] = 30 # 30 seconds
+			kwargs[ "timeout" ] = KoboSession.DownloadTimeout if kwargs.get( "stream" ) else KoboSession.ApiTimeout
+
+		# requests replaces the session's response hooks with the request's ones instead of running both.
+		requestHooks = kwargs.get( "hooks" )
+		if ( requestHooks is not None ) and len( self.hooks[ "response" ] ) > 0:
+			responseHooks = requestHooks.get( "response", [] )
+			if callable( responseHooks ):
+				responseHooks = [ responseHooks ]
+			kwargs[ "hooks" ] = dict( requestHooks, response = responseHooks + self.hooks[ "response" ] )
+
 		return super().request( method, url, **kwargs )
 
 class Kobo:
@@ -68,6 +203,17 @@ class Kobo:
 	DeviceModel = "Kobo Aura ONE"
 	DeviceOs = "3.0.35+"
 	DeviceOsVersion = "NA"
+	BookInfoTimeToLive = 60 * 60 * 24 * 7 # seconds
+	InitializationSettingsTimeToLive = 60 * 60 * 24 # seconds
+	DownloadResumeCount = 5 # How many times an interrupted download is continued with a range request.
+	DownloadSpoolSize = 1024 * 1024 * 16 # Encrypted books bigger than this are spooled to an anonymous temporary file.
+	WishListConcurrency = 8 # How many wish list pages are downloaded in parallel.
+	WishListDefaultPageSize = 100 # This is the default if PageSize is not specified.
+	WishListPageSize = 500 # Less pages means less requests. Falls back to the default if the server doesn't allow it.
+	TokenRefreshMargin = 5 * 60 # seconds, the access token is refreshed this long before it expires.
+	TokenRefreshCheckInterval = 60 # seconds, in case the clock jumps (for example after the computer has been sleeping).
+	TokenRefreshRetryInterval = 60 # seconds
+	MinimumTokenLifetime = 5 * 60 # seconds, shorter lifetimes seen are ignored, the token was probably revoked.
 
 	def __init__( self ):
 		headers = {
@@ -75,9 +221,29 @@ class Kobo:
 			"User-Agent": "Mozilla/5.0 (Linux; U; Android 2.0; en-us;) AppleWebKit/538.1 (KHTML, like Gecko) Version/4.0 Mobile Safari/538.1 (Kobo Touch 0373/4.38.23171)",
 		}
 
+		self.AuthenticationLock = threading.Lock()
+		self.CompressionPolicy = CompressionPolicy()
+		self.ContentAccessResolver = None # type: ContentAccessResolver | None
+		self.DecryptionPool = None # type: DecryptionPool | None
 		self.InitializationSettings = {}
-		self.Session = SessionWithTimeOut()
+		self.LibraryStore = None # type: LibraryStore | None
+		self.MetadataCache = None # type: MetadataCache | None
+		self.RunReport = None # type: RunReport | None
+		self.Session = KoboSession()
 		self.Session.headers.update( headers )
+		self.Session.hooks[ "response" ].append( self.__CountRetries )
+		self.TokenChanged = threading.Event()
+
+	# urllib3 retries the failed requests transparently, the retries are only visible in the history of the response.
+	# The retries of the throttled requests are counted by ScheduledHTTPAdapter.
+	def __CountRetries( self, r, *args, **kwargs ) -> None:
+		retryCount = getattr( r, "ThrottlingRetryCount", 0 )
+		retries = getattr( r.raw, "retries", None )
+		if retries is not None:
+			retryCount += len( retries.history )
+
+		if ( self.RunReport is not None ) and retryCount > 0:
+			self.RunReport.AddRetries( retryCount )
 
 	# This could be added to the session but then we would need to add { "Authorization": None } headers to all other
 	# functions that doesn't need authorization.
@@ -120,7 +286,7 @@ class Kobo:
 		if len( userKey ) > 0:
 			postData[ "UserKey" ] = userKey
 
-		response = self.Session.post( "https://storeapi.kobo.com/v1/auth/device", json = postData )
+		response = self.Session.post( KoboSession.ApiUrl + "v1/auth/device", json = postData )
 		response.raise_for_status()
 		jsonResponse = response.json()
 
@@ -135,7 +301,9 @@ class Kobo:
 		if len( userKey ) > 0:
 			Globals.Settings.UserKey = jsonResponse[ "UserKey" ]
 
+		Kobo.__SetAccessTokenExpiry()
 		Globals.Settings.Save()
+		self.TokenChanged.set()
 
 	def RefreshAuthentication( self ) -> None:
 		Globals.Logger.debug( "Kobo.RefreshAuthentication" )
@@ -150,7 +318,7 @@ class Kobo:
 		}
 
 		# The reauthentication hook is intentionally not set.
-		response = self.Session.post( "https://storeapi.kobo.com/v1/auth/refresh", json = postData, headers = headers )
+		response = self.Session.post( KoboSession.ApiUrl + "v1/auth/refresh", json = postData, headers = headers )
 		response.raise_for_status()
 		jsonResponse = response.json()
 
@@ -162,16 +330,176 @@ class Kobo:
 		if not Globals.Settings.AreAuthenticationSettingsSet():
 			raise KoboException( "Authentication settings are not set after authentication refresh." )
 
+		Kobo.__SetAccessTokenExpiry()
 		Globals.Settings.Save()
+		self.TokenChanged.set()
+
+	# The session is shared by the download workers, so several requests can fail with 401 at the same time. Only the first
+	# one refreshes the token, the others see that the token has changed since they sent their request and just use it.
+	#
+	# Other processes might use the same settings file too. The refresh is done under the lock of the settings, and the
+	# settings are read again first: if another process has already refreshed the token then its token is used. Refreshing
+	# again would invalidate the refresh token of the other process.
+	def RefreshAuthenticationIfNeeded( self, failedAuthorization: str ) -> None:
+		with self.AuthenticationLock:
+			if Kobo.GetHeaderWithAccessToken()[ "Authorization" ] != failedAuthorization:
+				return
+
+			with Globals.Settings.Lock():
+				Globals.Settings.Load()
+				if Kobo.GetHeaderWithAccessToken()[ "Authorization" ] != failedAuthorization:
+					Globals.Logger.debug( "Using the authentication token refreshed by another process" )
+					self.TokenChanged.set()
+					return
+
+				Globals.Logger.debug( "Refreshing expired authentication token" )
+				Kobo.__LearnAccessTokenLifetime()
+				self.RefreshAuthentication()
+
+			if self.RunReport is not None:
+				self.RunReport.AddTokenRefresh()
+
+	# Returns the expiry of the token from its "exp" claim if it is a JWT, otherwise None.
+	@staticmethod
+	def __GetTokenExpiryClaim( token: str ) -> Optional[ float ]:
+		parts = token.split( "." )
+		if len( parts ) != 3:
+			return None
 
-	def LoadInitializationSettings( self ) -> None:
-		Globals.Logger.debug( "Kobo.LoadInitializationSettings" )
+		try:
+			payload = base64.urlsafe_b64decode( parts[ 1 ] + "=" * ( -len( parts[ 1 ] ) % 4 ) )
+			expiry = json.loads( payload ).get( "exp" )
+		except ( ValueError, AttributeError ):
+			return None
+
+		if ( not isinstance( expiry, ( int, float ) ) ) or isinstance( expiry, bool ):
+			return None
 
+		return float( expiry )
+
+	# Must be called when a new access token has been received. If the token doesn't tell its expiry then it is estimated
+	# from the lifetime of the previous tokens.
+	@staticmethod
+	def __SetAccessTokenExpiry() -> None:
+		now = time.time()
+		Globals.Settings.AccessTokenIssueTime = now
+		Globals.Settings.AccessTokenExpiry = Kobo.__GetTokenExpiryClaim( Globals.Settings.AccessToken ) or 0.0
+		if Globals.Settings.AccessTokenExpiry == 0.0 and Globals.Settings.AccessTokenLifetime > 0:
+			Globals.Settings.AccessTokenExpiry = now + Globals.Settings.AccessTokenLifetime
+
+	# Called when the access token has been rejected. The token has expired at most this long after it was issued.
+	@staticmethod
+	def __LearnAccessTokenLifetime() -> None:
+		if Globals.Settings.AccessTokenIssueTime == 0.0 or Kobo.__GetTokenExpiryClaim( Globals.Settings.AccessToken ) is not None:
+			return
+
+		lifetime = time.time() - Globals.Settings.AccessTokenIssueTime
+		if lifetime >= Kobo.MinimumTokenLifetime and ( Globals.Settings.AccessTokenLifetime == 0 or lifetime < Globals.Settings.AccessTokenLifetime ):
+			Globals.Settings.AccessTokenLifetime = lifetime
+
+	# Returns when the access token should be refreshed, or None if its expiry is not known.
+	@staticmethod
+	def __GetTokenRefreshTime() -> Optional[ float ]:
+		expiry = Globals.Settings.AccessTokenExpiry or Kobo.__GetTokenExpiryClaim( Globals.Settings.AccessToken )
+		if not expiry:
+			return None
+
+		# Short lived tokens would be refreshed all the time with the whole margin.
+		margin = Kobo.TokenRefreshMargin
+		if Globals.Settings.AccessTokenIssueTime > 0:
+			margin = max( 0.0, min( margin, ( expiry - Globals.Settings.AccessTokenIssueTime ) / 10 ) )
+
+		return expiry - margin
+
+	# Refreshes the access token if it is about to expire. Another process might have refreshed it already, so the settings
+	# are read again under their lock first, like in RefreshAuthenticationIfNeeded.
+	def RefreshAuthenticationIfExpiring( self ) -> None:
+		with self.AuthenticationLock:
+			with Globals.Settings.Lock():
+				Globals.Settings.Load()
+				refreshTime = Kobo.__GetTokenRefreshTime()
+				if refreshTime is None or refreshTime > time.time():
+					self.TokenChanged.set()
+					return
+
+				Globals.Logger.debug( "Refreshing the authentication token before it expires" )
+				self.RefreshAuthentication()
+
+			if self.RunReport is not None:
+				self.RunReport.AddTokenRefresh()
+
+	def __RefreshAuthenticationBeforeExpiry( self ) -> None:
+		while True:
+			self.TokenChanged.clear()
+			refreshTime = Kobo.__GetTokenRefreshTime()
+			if refreshTime is None:
+				self.TokenChanged.wait()
+				continue
+
+			delay = refreshTime - time.time()
+			if delay > 0:
+				self.TokenChanged.wait( min( delay, Kobo.TokenRefreshCheckInterval ) )
+				continue
+
+			try:
+				self.RefreshAuthenticationIfExpiring()
+			except Exception as e:
+				Globals.Logger.debug( "Failed to refresh the authentication token: %s" % e )
+
+			# Don't try again and again if the refresh has failed or the clock is off. The request that gets a 401 will
+			# refresh the token anyway.
+			refreshTime = Kobo.__GetTokenRefreshTime()
+			if refreshTime is not None and refreshTime <= time.time():
+				time.sleep( Kobo.TokenRefreshRetryInterval )
+
+	# Refreshes the access token in the background shortly before it expires, so the requests don't have to fail with 401
+	# first (ReauthenticationHook remains for the tokens whose expiry is not known). A token that is about to expire is
+	# refreshed right away.
+	def StartTokenRefresher( self ) -> None:
+		refreshTime = Kobo.__GetTokenRefreshTime()
+		if refreshTime is not None and refreshTime <= time.time():
+			self.RefreshAuthenticationIfExpiring()
+
+		threading.Thread( target = self.__RefreshAuthenticationBeforeExpiry, name = "TokenRefresher", daemon = True ).start()
+
+	# Makes an authorized GET request, unless the response is in the metadata cache and it hasn't expired yet. Expired
+	# responses are revalidated with their ETag.
+	def __GetCachedJson( self, url: str, cacheKey: str, timeToLive: float ) -> dict:
 		headers = Kobo.GetHeaderWithAccessToken()
 		hooks = Kobo.__GetReauthenticationHook()
-		response = self.Session.get( "https://storeapi.kobo.com/v1/initialization", headers = headers, hooks = hooks )
+
+		if self.MetadataCache is None:
+			response = self.Session.get( url, headers = headers, hooks = hooks )
+			response.raise_for_status()
+			return response.json()
+
+		# The responses might depend on the user's account (country, etc.).
+		cacheKey = Globals.Settings.UserId + ":" + cacheKey
+		cachedJson, eTag, isFresh = self.MetadataCache.Get( cacheKey )
+		if cachedJson is not None:
+			if isFresh:
+				Globals.Logger.debug( "Using cached response for '%s'" % url )
+				return cachedJson
+
+			if len( eTag ) > 0:
+				headers[ "If-None-Match" ] = eTag
+
+		response = self.Session.get( url, headers = headers, hooks = hooks )
+		if response.status_code == requests.codes.not_modified and cachedJson is not None: # 304
+			Globals.Logger.debug( "Cached response for '%s' is still valid" % url )
+			self.MetadataCache.Put( cacheKey, cachedJson, eTag, timeToLive )
+			return cachedJson
+
 		response.raise_for_status()
 		jsonResponse = response.json()
+		self.MetadataCache.Put( cacheKey, jsonResponse, response.headers.get( "ETag", "" ), timeToLive )
+		return jsonResponse
+
+	def LoadInitializationSettings( self ) -> None:
+		Globals.Logger.debug( "Kobo.LoadInitializationSettings" )
+
+		url = KoboSession.ApiUrl + "v1/initialization"
+		jsonResponse = self.__GetCachedJson( url, "initialization", Kobo.InitializationSettingsTimeToLive )
 		self.InitializationSettings = jsonResponse[ "Resources" ]
 
 	def WaitTillActivation( self, activationCheckUrl: str ) -> Tuple[ str, str ]:
@@ -252,16 +580,12 @@ class Kobo:
 		Globals.Logger.debug( "Kobo.GetBookInfo" )
 
 		url = self.InitializationSettings[ "book" ].replace( "{ProductId}", productId )
-		headers = Kobo.GetHeaderWithAccessToken()
-		hooks = Kobo.__GetReauthenticationHook()
+		return self.__GetCachedJson( url, "book:" + productId, Kobo.BookInfoTimeToLive )
 
-		response = self.Session.get( url, headers = headers, hooks = hooks )
-		response.raise_for_status()
-		jsonResponse = response.json()
-		return jsonResponse
-
-	def __GetMyBookListPage( self, syncToken: str ) -> Tuple[ list, str ]:
-		Globals.Logger.debug( "Kobo.__GetMyBookListPage" )
+	# Returns as soon as the headers of the page have arrived. They contain the synchronization token of the next page, so
+	# the next page can be requested before the body of this one is read.
+	def __RequestMyBookListPage( self, syncToken: str ) -> requests.Response:
+		Globals.Logger.debug( "Kobo.__RequestMyBookListPage" )
 
 		url = self.InitializationSettings[ "library_sync" ]
 		headers = Kobo.GetHeaderWithAccessToken()
@@ -270,62 +594,161 @@ class Kobo:
 		if len( syncToken ) > 0:
 			headers[ "x-kobo-synctoken" ] = syncToken
 
-		response = Globals.Kobo.Session.get( url, headers = headers, hooks = hooks )
-		response.raise_for_status()
-		bookList = response.json()
+		response = self.Session.get( url, headers = headers, hooks = hooks, stream = True, timeout = KoboSession.ApiTimeout )
+		if not response.ok:
+			response.close()
+			response.raise_for_status()
+
+		return response
+
+	@staticmethod
+	def __CloseResponseOfFuture( future: concurrent.futures.Future ) -> None:
+		if ( not future.cancelled() ) and future.exception() is None:
+			future.result().close()
+
+	def __GetLibraryStore( self ) -> LibraryStore:
+		if self.LibraryStore is None:
+			self.LibraryStore = LibraryStore( Globals.Settings.LibraryFilePath )
 
-		syncToken = ""
-		syncResult = response.headers.get( "x-kobo-sync" )
-		if syncResult == "continue":
-			syncToken = response.headers.get( "x-kobo-synctoken", "" )
+			# The synchronization token belongs to the user, start from scratch if somebody else has logged in.
+			if self.LibraryStore.GetUserId() != Globals.Settings.UserId:
+				self.LibraryStore.Reset( Globals.Settings.UserId )
 
-		return bookList, syncToken
+		return self.LibraryStore
 
-	def GetMyBookList( self ) -> list:
+	# Makes the next synchronization download the whole library again.
+	def ResetLibrary( self ) -> None:
+		Globals.Logger.debug( "Kobo.ResetLibrary" )
+
+		self.__GetLibraryStore().Reset( Globals.Settings.UserId )
+
+	# Yields the identifiers of the entitlements that each page has changed, after the page has been applied to the local
+	# library store. Only the changes since the previous synchronization are downloaded.
+	#
+	# The next page is requested in the background as soon as the headers of the current one have arrived, so waiting for
+	# it overlaps with reading, parsing and applying the current page.
+	def __SynchronizeLibrary( self ) -> Iterator[ List[ str ] ]:
 		# The "library_sync" name and the synchronization tokens make it somewhat suspicious that we should use
 		# "library_items" instead to get the My Books list, but "library_items" gives back less info (even with the
 		# embed=ProductMetadata query parameter set).
 
-		fullBookList = []
-		syncToken = ""
-		while True:
-			bookList, syncToken = self.__GetMyBookListPage( syncToken )
-			fullBookList += bookList
-			if len( syncToken ) == 0:
-				break
+		libraryStore = self.__GetLibraryStore()
+		syncToken = libraryStore.GetSyncToken()
+		storedSyncToken = syncToken
 
-		return fullBookList
+		with concurrent.futures.ThreadPoolExecutor( max_workers = 1, thread_name_prefix = "LibrarySync" ) as executor:
+			nextPage = executor.submit( self.__RequestMyBookListPage, syncToken )
+			try:
+				while nextPage is not None:
+					try:
+						response = nextPage.result()
+					except requests.exceptions.HTTPError as e:
+						nextPage = None
+
+						# Unauthorized requests are handled by the reauthentication hook, and throttling is not the token's fault.
+						statusCode = e.response.status_code
+						if statusCode < 400 or statusCode >= 500 or statusCode == requests.codes.too_many_requests:
+							raise
+
+						# Only the token stored by a previous run can be stale, and the whole library is synchronized only once.
+						# The tokens of the pages are fresh from the server, so if one of them fails then starting again would
+						# fail the same way forever.
+						if len( syncToken ) == 0 or syncToken != storedSyncToken:
+							raise KoboException( "The library synchronization has failed (HTTP %d). Try again later, or with --full-sync." % statusCode ) from e
+
+						Globals.Logger.debug( "The synchronization token is not accepted (HTTP %d), synchronizing the whole library" % statusCode )
+						libraryStore.Reset( Globals.Settings.UserId )
+						syncToken = ""
+						storedSyncToken = ""
+						nextPage = executor.submit( self.__RequestMyBookListPage, syncToken )
+						continue
+
+					# The token of the last page is kept too, it is the starting point of the next incremental synchronization.
+					hasMorePages = response.headers.get( "x-kobo-sync" ) == "continue"
+					nextSyncToken = response.headers.get( "x-kobo-synctoken", syncToken )
+					nextPage = executor.submit( self.__RequestMyBookListPage, nextSyncToken ) if hasMorePages else None
+
+					with response:
+						bookList = response.json()
+
+					entitlementIds = libraryStore.ApplyPage( bookList, nextSyncToken )
+					syncToken = nextSyncToken
+					yield entitlementIds
+			finally:
+				# The prefetched page is not needed if the caller has stopped early or something has failed.
+				if nextPage is not None and not nextPage.cancel():
+					nextPage.add_done_callback( Kobo.__CloseResponseOfFuture )
+
+	# Returns the book from the local copy of the library, without synchronizing it. Returns None if the book is not there.
+	def GetLibraryBook( self, revisionId: str ) -> Optional[ LibraryBook ]:
+		return self.__GetLibraryStore().GetBook( revisionId )
+
+	# Returns compact records of the books one at a time, so the memory use doesn't depend on the size of the library.
+	#
+	# When the whole library is synchronized then the books are returned as soon as their page has been applied. An
+	# incremental synchronization can change any book, so then the books are returned from the store after it.
+	def GetMyBooks( self ) -> Iterator[ LibraryBook ]:
+		libraryStore = self.__GetLibraryStore()
+		if len( libraryStore.GetSyncToken() ) > 0:
+			for _ in self.__SynchronizeLibrary():
+				pass
+
+			yield from libraryStore.GetBooks()
+			return
+
+		# A later page can change a book again (and the synchronization might start again), but every book is returned
+		# only once.
+		returnedEntitlementIds = set()
+		for entitlementIds in self.__SynchronizeLibrary():
+			newEntitlementIds = [ entitlementId for entitlementId in entitlementIds if entitlementId not in returnedEntitlementIds ]
+			returnedEntitlementIds.update( newEntitlementIds )
+			yield from libraryStore.GetBooks( newEntitlementIds )
+
+	def __GetMyWishListPage( self, pageIndex: int, pageSize: int ) -> dict:
+		Globals.Logger.debug( "Kobo.__GetMyWishListPage" )
+
+		url = self.InitializationSettings[ "user_wishlist" ]
+		headers = Kobo.GetHeaderWithAccessToken()
+		hooks = Kobo.__GetReauthenticationHook()
 
-	def GetMyWishList( self ) -> list:
-		Globals.Logger.debug( "Kobo.GetMyWishList" )
+		params = {
+			"PageIndex": pageIndex,
+			"PageSize": pageSize,
+		}
 
-		items = []
-		currentPageIndex = 0
+		response = Globals.Kobo.Session.get( url, params = params, headers = headers, hooks = hooks )
+		response.raise_for_status()
+		return response.json()
 
-		while True:
-			url = self.InitializationSettings[ "user_wishlist" ]
-			headers = Kobo.GetHeaderWithAccessToken()
-			hooks = Kobo.__GetReauthenticationHook()
+	# The first page tells the number of pages, the rest of them are downloaded in parallel. The server returns the
+	# number of pages for the page size it actually uses, so it is safe to ask for a bigger page size than it allows.
+	def GetMyWishList( self ) -> list:
+		Globals.Logger.debug( "Kobo.GetMyWishList" )
 
-			params = {
-				"PageIndex": currentPageIndex,
-				"PageSize": 100, # 100 is the default if PageSize is not specified.
-			}
+		pageSize = Kobo.WishListPageSize
+		try:
+			firstPage = self.__GetMyWishListPage( 0, pageSize )
+		except requests.exceptions.HTTPError as e:
+			if e.response.status_code != requests.codes.bad_request or pageSize == Kobo.WishListDefaultPageSize:
+				raise
 
-			response = Globals.Kobo.Session.get( url, params = params, headers = headers, hooks = hooks )
-			response.raise_for_status()
-			wishList = response.json()
+			pageSize = Kobo.WishListDefaultPageSize
+			firstPage = self.__GetMyWishListPage( 0, pageSize )
 
-			items.extend( wishList[ "Items" ] )
+		pages = [ firstPage ]
+		pageCount = firstPage[ "TotalPageCount" ]
+		if pageCount > 1:
+			with concurrent.futures.ThreadPoolExecutor( max_workers = min( Kobo.WishListConcurrency, pageCount - 1 ) ) as executor:
+				pages += executor.map( lambda pageIndex: self.__GetMyWishListPage( pageIndex, pageSize ), range( 1, pageCount ) )
 
-			currentPageIndex += 1
-			if currentPageIndex >= wishList[ "TotalPageCount" ]:
-				break
+		items = []
+		for page in pages:
+			items.extend( page[ "Items" ] )
 
 		return items
 
-	def __GetContentAccessBook( self, productId: str, displayProfile: str ) -> dict:
-		Globals.Logger.debug( "Kobo.__GetContentAccessBook" )
+	def GetContentAccessBook( self, productId: str, displayProfile: str ) -> dict:
+		Globals.Logger.debug( "Kobo.GetContentAccessBook" )
 
 		url = self.InitializationSettings[ "content_access_book" ].replace( "{ProductId}", productId )
 		params = { "DisplayProfile": displayProfile }
@@ -377,39 +800,172 @@ class Kobo:
 
 		raise KoboException( message )
 
-	def __DownloadToFile( self, url, outputPath: str ) -> None:
+	# Returns with the response and whether it contains only the rest of the file. The server sends the whole file if it
+	# has changed or if it ignores the range.
+	def __ResumeDownload( self, url: str, downloadedSize: int, totalSize: int, eTag: str ) -> Tuple[ requests.Response, bool ]:
+		Globals.Logger.debug( "Kobo.__ResumeDownload" )
+
+		headers = {
+			"Accept-Encoding": "identity",
+			"Range": "bytes=%d-" % downloadedSize,
+		}
+
+		# If-Range only works with strong validators. Without it the total size is used to check that the file is still
+		# the same.
+		if len( eTag ) > 0 and not eTag.startswith( "W/" ):
+			headers[ "If-Range" ] = eTag
+
+		response = self.Session.get( url, stream = True, headers = headers )
+		response.raise_for_status()
+
+		if response.status_code != requests.codes.partial_content: # 206
+			return response, False
+
+		match = re.match( r"bytes (\d+)-\d+/(\d+|\*)", response.headers.get( "Content-Range", "" ) )
+		if ( match is None ) or int( match.group( 1 ) ) != downloadedSize or match.group( 2 ) != str( totalSize ):
+			response.close()
+			raise KoboException( "The server's response to the resumed download doesn't match the original file." )
+
+		return response, True
+
+	# If the connection breaks during the download then the download is continued from where it stopped with a range
+	# request, provided that the server supports them. Otherwise the download fails as before.
+	def __DownloadToFile( self, url, outputFile: BinaryIO, bookStatistics: BookStatistics ) -> None:
 		Globals.Logger.debug( "Kobo.__DownloadToFile" )
 
-		response = self.Session.get( url, stream = True )
+		# Ranges refer to the transferred bytes, so content encoding is not allowed. (Books are ZIP files anyway.)
+		headers = { "Accept-Encoding": "identity" }
+		startTime = time.perf_counter()
+		response = self.Session.get( url, stream = True, headers = headers )
 		response.raise_for_status()
-		with open( outputPath, "wb" ) as f:
-			for chunk in response.iter_content( chunk_size = 1024 * 256 ):
-				f.write( chunk )
+		transferStartTime = time.perf_counter()
+		bookStatistics.TimeToFirstByteSeconds = transferStartTime - startTime
+
+		eTag = response.headers.get( "ETag", "" )
+		totalSize = int( response.headers.get( "Content-Length", "-1" ) )
+		canResume = response.headers.get( "Accept-Ranges" ) == "bytes" and totalSize >= 0
+		startPosition = outputFile.tell()
+		resumeCount = 0
+
+		while True:
+			try:
+				with response:
+					for chunk in response.iter_content( chunk_size = 1024 * 256 ):
+						outputFile.write( chunk )
+				break
+			except ( requests.exceptions.ChunkedEncodingError, requests.exceptions.ConnectionError ):
+				if ( not canResume ) or resumeCount >= Kobo.DownloadResumeCount:
+					raise
+
+				resumeCount += 1
+				if self.RunReport is not None:
+					self.RunReport.AddDownloadResume()
+
+				downloadedSize = outputFile.tell() - startPosition
+				Globals.Logger.debug( "The download was interrupted at %d of %d bytes, resuming it (attempt %d)" % ( downloadedSize, totalSize, resumeCount ) )
+				time.sleep( resumeCount )
+
+				response, isPartial = self.__ResumeDownload( url, downloadedSize, totalSize, eTag )
+				if not isPartial:
+					# The file has changed or the server ignored the range, start from the beginning.
+					outputFile.seek( startPosition )
+					outputFile.truncate()
+					eTag = response.headers.get( "ETag", "" )
+					totalSize = int( response.headers.get( "Content-Length", "-1" ) )
+					canResume = response.headers.get( "Accept-Ranges" ) == "bytes" and totalSize >= 0
+
+		downloadedSize = outputFile.tell() - startPosition
+		bookStatistics.TransferSeconds = time.perf_counter() - transferStartTime
+		bookStatistics.BytesDownloaded = downloadedSize
+		if totalSize >= 0 and downloadedSize != totalSize:
+			raise KoboException( "The download is incomplete, got %d bytes instead of %d." % ( downloadedSize, totalSize ) )
 
 	# Downloading archived books is not possible, the "content_access_book" API endpoint returns with empty ContentKeys
 	# and ContentUrls for them.
-	def Download( self, productId: str, displayProfile: str, outputPath: str ) -> None:
+	#
+	# The encrypted book is never written to the output directory. It is kept in memory (or in an anonymous temporary file
+	# if it is big) only until its central directory, at the end of the ZIP, arrives, then the book is decrypted in a
+	# single pass. The result goes to a temporary file that is renamed to the output path only when everything succeeded.
+	#
+	# If keepEncrypted is set then DRM protected books are not decrypted. They are saved with the EncryptedBookExtension
+	# appended to the output path, together with their content keys, so the decrypt command can remove the DRM later.
+	#
+	# If ContentAccessResolver is set then the content access of the book is taken from it, it may be resolved already.
+	#
+	# Returns with the path of the saved file. The timings of the download go to the run report if it is set.
+	def Download( self, productId: str, displayProfile: str, outputPath: str, keepEncrypted: bool = False ) -> str:
 		Globals.Logger.debug( "Kobo.Download" )
 
-		jsonResponse = self.__GetContentAccessBook( productId, displayProfile )
+		bookStatistics = BookStatistics( productId )
+		startTime = time.perf_counter()
+
+		try:
+			outputPath = self.__Download( productId, displayProfile, outputPath, keepEncrypted, bookStatistics )
+			bookStatistics.OutputPath = outputPath
+			bookStatistics.BytesWritten = os.path.getsize( outputPath )
+		except BaseException as e:
+			bookStatistics.Error = str( e ) or type( e ).__name__
+			raise
+		finally:
+			bookStatistics.TotalSeconds = time.perf_counter() - startTime
+			if self.RunReport is not None:
+				self.RunReport.AddBook( bookStatistics )
+
+		return outputPath
+
+	def __Download( self, productId: str, displayProfile: str, outputPath: str, keepEncrypted: bool, bookStatistics: BookStatistics ) -> str:
+		startTime = time.perf_counter()
+		if self.ContentAccessResolver is None:
+			jsonResponse = self.GetContentAccessBook( productId, displayProfile )
+		else:
+			jsonResponse = self.ContentAccessResolver.Get( productId )
+		bookStatistics.ContentAccessSeconds = time.perf_counter() - startTime
 		contentKeys = Kobo.__GetContentKeys( jsonResponse )
 		downloadUrl, hasDrm = Kobo.__GetDownloadInfo( productId, jsonResponse )
 
+		keepEncrypted = keepEncrypted and hasDrm
+		if keepEncrypted:
+			outputPath += KoboDrmRemover.EncryptedBookExtension
+
 		temporaryOutputPath = outputPath + ".downloading"
 
 		try:
-			self.__DownloadToFile( downloadUrl, temporaryOutputPath )
-
-			if hasDrm:
-				drmRemover = KoboDrmRemover( Globals.Settings.DeviceId, Globals.Settings.UserId )
-				drmRemover.RemoveDrm( temporaryOutputPath, outputPath, contentKeys )
-				os.remove( temporaryOutputPath )
+			if keepEncrypted:
+				with open( temporaryOutputPath, "wb" ) as f:
+					self.__DownloadToFile( downloadUrl, f, bookStatistics )
+
+				# The content keys must be in place by the time the book appears.
+				KoboDrmRemover.SaveContentKeys( outputPath, productId, contentKeys )
+			elif hasDrm and self.DecryptionPool is not None:
+				# The decryption workers are separate processes, so they need the encrypted book in a named file.
+				encryptedFileHandle, encryptedFilePath = tempfile.mkstemp( suffix = ".epub" )
+				try:
+					with os.fdopen( encryptedFileHandle, "wb" ) as f:
+						self.__DownloadToFile( downloadUrl, f, bookStatistics )
+
+					decryptSeconds, removalSeconds = self.DecryptionPool.RemoveDrm( encryptedFilePath, temporaryOutputPath, contentKeys, self.CompressionPolicy )
+					bookStatistics.DecryptSeconds = decryptSeconds
+					bookStatistics.CompressSeconds = removalSeconds - decryptSeconds
+				finally:
+					os.remove( encryptedFilePath )
+			elif hasDrm:
+				with DownloadSpool( max_size = Kobo.DownloadSpoolSize ) as encryptedFile:
+					self.__DownloadToFile( downloadUrl, encryptedFile, bookStatistics )
+
+					startTime = time.perf_counter()
+					drmRemover = KoboDrmRemover.Get( Globals.Settings.DeviceId, Globals.Settings.UserId )
+					decryptSeconds = drmRemover.RemoveDrm( encryptedFile, temporaryOutputPath, contentKeys, self.CompressionPolicy )
+					bookStatistics.DecryptSeconds = decryptSeconds
+					bookStatistics.CompressSeconds = time.perf_counter() - startTime - decryptSeconds
 			else:
-				os.rename( temporaryOutputPath, outputPath )
+				with open( temporaryOutputPath, "wb" ) as f:
+					self.__DownloadToFile( downloadUrl, f, bookStatistics )
+
+			os.replace( temporaryOutputPath, outputPath )
 		except:
 			if os.path.isfile( temporaryOutputPath ):
 				os.remove( temporaryOutputPath )
-			if os.path.isfile( outputPath ):
-				os.remove( outputPath )
 
 			raise
+
+		return outputPath
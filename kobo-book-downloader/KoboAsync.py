@@ -0,0 +1,96 @@
+from Globals import Globals
+
+from typing import AsyncIterator, TYPE_CHECKING
+import asyncio
+import concurrent.futures
+import functools
+import itertools
+
+if TYPE_CHECKING:
+	from Kobo import Kobo
+	from LibraryStore import LibraryBook
+
+# Asynchronous version of the Kobo API calls, for fanning out many requests from one process (and for using the
+# downloader as a library from asyncio code).
+#
+# The calls run the methods of the synchronous Kobo instance on a bounded pool of threads, so they share its connection
+# pools, timeouts and retries, the metadata cache, the local copy of the library and the parallel wish list pages. Expired
+# tokens are refreshed by Kobo.RefreshAuthenticationIfNeeded under Kobo.AuthenticationLock: when several requests fail
+# with 401 at the same time (from here or from synchronous workers), only the first one refreshes the token, the rest
+# wait for it and then retry with the new token.
+#
+# The connection pools are not resized here. If maximumConcurrency is bigger than the concurrency the session has been
+# set up for, call kobo.Session.SetConcurrency with it first.
+class KoboAsync:
+	BookBatchSize = 100 # GetMyBooks takes this many books from the library on a thread at once.
+
+	def __init__( self, kobo: "Kobo", maximumConcurrency: int = 8 ):
+		self.Kobo = kobo
+		self.Executor = concurrent.futures.ThreadPoolExecutor( max_workers = maximumConcurrency, thread_name_prefix = "KoboAsync" )
+
+	async def __aenter__( self ):
+		return self
+
+	async def __aexit__( self, *args ):
+		self.Close()
+
+	def Close( self ) -> None:
+		self.Executor.shutdown( wait = False )
+
+	async def __Run( self, function, *args, **kwargs ):
+		loop = asyncio.get_running_loop()
+		return await loop.run_in_executor( self.Executor, functools.partial( function, *args, **kwargs ) )
+
+	async def GetBookInfo( self, productId: str ) -> dict:
+		return await self.__Run( self.Kobo.GetBookInfo, productId )
+
+	async def GetContentAccessBook( self, productId: str, displayProfile: str ) -> dict:
+		return await self.__Run( self.Kobo.GetContentAccessBook, productId, displayProfile )
+
+	# Resolves the content access of the books concurrently. The result is in the order of the product identifiers, with the
+	# exception in place of the books that failed.
+	async def GetContentAccessBooks( self, productIds: list, displayProfile: str ) -> list:
+		tasks = [ self.GetContentAccessBook( productId, displayProfile ) for productId in productIds ]
+		return await asyncio.gather( *tasks, return_exceptions = True )
+
+	# See Kobo.GetMyBooks. The pages of the library depend on each other through the synchronization tokens, so the
+	# synchronization runs in the background and the books are returned in batches while it goes on.
+	async def GetMyBooks( self ) -> AsyncIterator[ "LibraryBook" ]:
+		books = self.Kobo.GetMyBooks()
+		try:
+			while True:
+				batch = await self.__Run( list, itertools.islice( books, KoboAsync.BookBatchSize ) )
+				if len( batch ) == 0:
+					break
+
+				for book in batch:
+					yield book
+		finally:
+			await self.__Run( books.close )
+
+	# See Kobo.GetMyWishList.
+	async def GetMyWishList( self ) -> list:
+		return await self.__Run( self.Kobo.GetMyWishList )
+
+	# Yields the body of the response in chunks while it is being downloaded. The download URLs are presigned, so no
+	# authorization is needed.
+	async def StreamDownload( self, url: str, chunkSize: int = 1024 * 256 ) -> AsyncIterator[ bytes ]:
+		Globals.Logger.debug( "KoboAsync.StreamDownload" )
+
+		headers = { "Accept-Encoding": "identity" }
+		response = await self.__Run( self.Kobo.Session.get, url, stream = True, headers = headers )
+		try:
+			response.raise_for_status()
+			chunks = response.iter_content( chunk_size = chunkSize )
+			while True:
+				chunk = await self.__Run( next, chunks, None )
+				if chunk is None:
+					break
+
+				yield chunk
+		finally:
+			response.close()
+
+	# See Kobo.Download.
+	async def Download( self, productId: str, displayProfile: str, outputPath: str, keepEncrypted: bool = False ) -> str:
+		return await self.__Run( self.Kobo.Download, productId, displayProfile, outputPath, keepEncrypted )
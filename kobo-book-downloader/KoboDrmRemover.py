@@ -1,16 +1,60 @@
-from Crypto.Cipher import AES
-from Crypto.Util import Padding
+from CompressionPolicy import CompressionPolicy
 
-from typing import Dict
+from typing import BinaryIO, Callable, Dict, Optional, Tuple, Union
 import base64
 import binascii
+import collections
+import concurrent.futures
+import functools
 import hashlib
+import json
+import os
+import shutil
+import struct
+import threading
+import time
 import zipfile
 
 # Based on obok.py by Physisticated.
 class KoboDrmRemover:
+	# Books downloaded without removing the DRM get this extension, and their content keys are in a file beside them with
+	# the ContentKeysExtension appended.
+	EncryptedBookExtension = ".encrypted"
+	ContentKeysExtension = ".json"
+
+	AesBlockSize = 16
+	# Must be a multiple of the AES block size.
+	ChunkSize = 1024 * 256
+	# Entries at least this big are decrypted in parallel if RemoveDrm is given a way to do it.
+	ParallelEntrySize = 1024 * 1024 * 4
+	# At most this many bytes of encrypted entries are read into memory for the parallel decryption. Their decrypted
+	# contents come back in memory too, so the peak is about twice this. An entry bigger than this is decrypted alone.
+	ParallelByteCount = 1024 * 1024 * 64
+	# The number of decrypted content keys to remember.
+	ContentKeyCacheSize = 4096
+
+	__Instances = {} # type: dict[ Tuple[ str, str ], KoboDrmRemover ]
+	__InstancesLock = threading.Lock()
+
+	# pycryptodome is imported only where it is used, because it is slow to import and most commands don't need it.
 	def __init__( self, deviceId: str, userId: str ):
+		from Crypto.Cipher import AES
+
 		self.DeviceIdUserIdKey = KoboDrmRemover.__MakeDeviceIdUserIdKey( deviceId, userId )
+		self.KeyAes = AES.new( self.DeviceIdUserIdKey, AES.MODE_ECB )
+		self.__GetContentAes = functools.lru_cache( maxsize = KoboDrmRemover.ContentKeyCacheSize )( self.__MakeContentAes )
+
+	# Returns with a remover shared by the whole process, so its key derivation and the decrypted content keys are reused
+	# across books. (ECB ciphers don't have state between calls, so they can be used from several threads.)
+	@staticmethod
+	def Get( deviceId: str, userId: str ) -> "KoboDrmRemover":
+		with KoboDrmRemover.__InstancesLock:
+			drmRemover = KoboDrmRemover.__Instances.get( ( deviceId, userId ) )
+			if drmRemover is None:
+				drmRemover = KoboDrmRemover( deviceId, userId )
+				KoboDrmRemover.__Instances[ ( deviceId, userId ) ] = drmRemover
+
+			return drmRemover
 
 	@staticmethod
 	def __MakeDeviceIdUserIdKey( deviceId: str, userId: str ) -> bytes:
@@ -18,21 +62,191 @@ class KoboDrmRemover:
 		key = hashlib.sha256( deviceIdUserId ).hexdigest()
 		return binascii.a2b_hex( key[ 32: ] )
 
-	def __DecryptContents( self, contents: bytes, contentKeyBase64: str ) -> bytes:
+	@staticmethod
+	def SaveContentKeys( encryptedBookPath: str, revisionId: str, contentKeys: Dict[ str, str ] ) -> None:
+		contentKeysPath = encryptedBookPath + KoboDrmRemover.ContentKeysExtension
+		temporaryContentKeysPath = contentKeysPath + ".saving"
+		with open( temporaryContentKeysPath, "w" ) as f:
+			jsonObject = {
+				"ContentKeys": contentKeys,
+				"RevisionId": revisionId
+			}
+			f.write( json.dumps( jsonObject, indent = 4 ) )
+
+		os.replace( temporaryContentKeysPath, contentKeysPath )
+
+	@staticmethod
+	def LoadContentKeys( encryptedBookPath: str ) -> Dict[ str, str ]:
+		with open( encryptedBookPath + KoboDrmRemover.ContentKeysExtension, "r" ) as f:
+			jsonObject = json.loads( f.read() )
+			return jsonObject[ "ContentKeys" ]
+
+	# Memoized in __GetContentAes.
+	def __MakeContentAes( self, contentKeyBase64: str ):
+		from Crypto.Cipher import AES
+
 		contentKey = base64.b64decode( contentKeyBase64 )
-		keyAes = AES.new( self.DeviceIdUserIdKey, AES.MODE_ECB )
-		decryptedContentKey = keyAes.decrypt( contentKey )
+		decryptedContentKey = self.KeyAes.decrypt( contentKey )
+		return AES.new( decryptedContentKey, AES.MODE_ECB )
 
-		contentAes = AES.new( decryptedContentKey, AES.MODE_ECB )
+	def DecryptContents( self, contents: bytes, contentKeyBase64: str ) -> bytes:
+		from Crypto.Util import Padding
+
+		contentAes = self.__GetContentAes( contentKeyBase64 )
 		decryptedContents = contentAes.decrypt( contents )
-		return Padding.unpad( decryptedContents, AES.block_size, "pkcs7" )
+		return Padding.unpad( decryptedContents, KoboDrmRemover.AesBlockSize, "pkcs7" )
+
+	# Decrypts the contents chunk by chunk, so entries are never held in memory as a whole. The last block is always held
+	# back because only that one has to be unpadded.
+	#
+	# Returns with the time spent decrypting, without the time of reading and writing.
+	def __DecryptStream( self, inputFile: BinaryIO, outputFile: BinaryIO, contentKeyBase64: str ) -> float:
+		from Crypto.Util import Padding
+
+		contentAes = self.__GetContentAes( contentKeyBase64 )
+		pendingContents = b""
+		decryptSeconds = 0.0
+		while True:
+			chunk = inputFile.read( KoboDrmRemover.ChunkSize )
+			if len( chunk ) == 0:
+				break
+
+			pendingContents += chunk
+			length = ( ( len( pendingContents ) - 1 ) // KoboDrmRemover.AesBlockSize ) * KoboDrmRemover.AesBlockSize
+			startTime = time.perf_counter()
+			decryptedContents = contentAes.decrypt( pendingContents[ :length ] )
+			decryptSeconds += time.perf_counter() - startTime
+			outputFile.write( decryptedContents )
+			pendingContents = pendingContents[ length: ]
+
+		startTime = time.perf_counter()
+		decryptedContents = Padding.unpad( contentAes.decrypt( pendingContents ), KoboDrmRemover.AesBlockSize, "pkcs7" )
+		decryptSeconds += time.perf_counter() - startTime
+		outputFile.write( decryptedContents )
+		return decryptSeconds
+
+	# zipfile has no public API to copy an entry without decompressing and recompressing it, so the local file header and
+	# the compressed data are written directly and the entry is registered for the central directory.
+	@staticmethod
+	def __CopyEntry( inputZip: zipfile.ZipFile, outputZip: zipfile.ZipFile, zipInfo: zipfile.ZipInfo ) -> None:
+		inputFile = inputZip.fp
+		inputFile.seek( zipInfo.header_offset )
+		localFileHeader = struct.unpack( zipfile.structFileHeader, inputFile.read( zipfile.sizeFileHeader ) )
+		fileNameLength = localFileHeader[ 10 ]
+		extraFieldLength = localFileHeader[ 11 ]
+		inputFile.seek( fileNameLength + extraFieldLength, 1 )
+
+		outputInfo = zipfile.ZipInfo( zipInfo.filename, zipInfo.date_time )
+		outputInfo.compress_type = zipInfo.compress_type
+		outputInfo.flag_bits = zipInfo.flag_bits & 0x800 # Keep only the UTF-8 file name flag, the sizes and the CRC will be in the local header.
+		outputInfo.create_system = zipInfo.create_system
+		outputInfo.external_attr = zipInfo.external_attr
+		outputInfo.CRC = zipInfo.CRC
+		outputInfo.compress_size = zipInfo.compress_size
+		outputInfo.file_size = zipInfo.file_size
+
+		outputFile = outputZip.fp
+		outputInfo.header_offset = outputFile.tell()
+		outputFile.write( outputInfo.FileHeader() )
+
+		remainingSize = zipInfo.compress_size
+		while remainingSize > 0:
+			chunk = inputFile.read( min( remainingSize, KoboDrmRemover.ChunkSize ) )
+			if len( chunk ) == 0:
+				raise zipfile.BadZipFile( "Unexpected end of data in '%s'." % zipInfo.filename )
+
+			outputFile.write( chunk )
+			remainingSize -= len( chunk )
+
+		outputZip.filelist.append( outputInfo )
+		outputZip.NameToInfo[ outputInfo.filename ] = outputInfo
+		outputZip.start_dir = outputFile.tell()
+		outputZip._didModify = True
+
+	@staticmethod
+	def __MakeEntryInfo( zipInfo: zipfile.ZipInfo, compressType: int, compressLevel: Optional[ int ] ) -> zipfile.ZipInfo:
+		outputInfo = zipfile.ZipInfo( zipInfo.filename, zipInfo.date_time )
+		outputInfo.compress_type = compressType
+		outputInfo.external_attr = zipInfo.external_attr
+		outputInfo.file_size = zipInfo.file_size # The decrypted size is not known yet but it can't be bigger than this.
+
+		# ZipFile.open has no parameter for the compression level. The attribute became public in Python 3.13.
+		if hasattr( outputInfo, "compress_level" ):
+			outputInfo.compress_level = compressLevel
+		else:
+			outputInfo._compresslevel = compressLevel
+
+		return outputInfo
+
+	# Returns with the time spent decrypting (or waiting for the parallel decryption).
+	def __WriteEntry( self, inputZip: zipfile.ZipFile, outputZip: zipfile.ZipFile, compressionPolicy: CompressionPolicy, zipInfo: zipfile.ZipInfo,
+		contentKeyBase64: Optional[ str ], decryptedContents: Optional[ concurrent.futures.Future ] ) -> float:
+		compressType, compressLevel = compressionPolicy.GetCompression( zipInfo, contentKeyBase64 is not None )
+		decryptSeconds = 0.0
+
+		if contentKeyBase64 is None:
+			if compressType == zipInfo.compress_type:
+				KoboDrmRemover.__CopyEntry( inputZip, outputZip, zipInfo )
+			else:
+				with inputZip.open( zipInfo, "r" ) as inputFile:
+					with outputZip.open( KoboDrmRemover.__MakeEntryInfo( zipInfo, compressType, compressLevel ), "w" ) as outputFile:
+						shutil.copyfileobj( inputFile, outputFile, KoboDrmRemover.ChunkSize )
+		elif decryptedContents is not None:
+			startTime = time.perf_counter()
+			contents = decryptedContents.result()
+			decryptSeconds = time.perf_counter() - startTime
+			outputZip.writestr( KoboDrmRemover.__MakeEntryInfo( zipInfo, compressType, compressLevel ), contents )
+		else:
+			with inputZip.open( zipInfo, "r" ) as inputFile:
+				with outputZip.open( KoboDrmRemover.__MakeEntryInfo( zipInfo, compressType, compressLevel ), "w" ) as outputFile:
+					decryptSeconds = self.__DecryptStream( inputFile, outputFile, contentKeyBase64 )
+
+		return decryptSeconds
+
+	# The input can be a path or a seekable file object.
+	#
+	# Entries that are not encrypted and keep their compression type are copied without decompressing and recompressing
+	# them. The mimetype entry is always written first.
+	#
+	# If decryptInParallel is set then the big entries are decrypted with it. It gets the encrypted contents and the
+	# content key, and returns a future of the decrypted contents (see DecryptContents). The entries are still written in
+	# their original order.
+	#
+	# Returns with the time spent decrypting. The rest of the time goes to decompressing, compressing and writing.
+	def RemoveDrm( self, inputPath: Union[ str, BinaryIO ], outputPath: str, contentKeys: Dict[ str, str ], compressionPolicy: Optional[ CompressionPolicy ] = None,
+		decryptInParallel: Optional[ Callable[ [ bytes, str ], concurrent.futures.Future ] ] = None ) -> float:
+		if compressionPolicy is None:
+			compressionPolicy = CompressionPolicy()
+
+		decryptSeconds = 0.0
 
-	def RemoveDrm( self, inputPath: str, outputPath: str, contentKeys: Dict[ str, str ] ) -> None:
 		with zipfile.ZipFile( inputPath, "r" ) as inputZip:
 			with zipfile.ZipFile( outputPath, "w", zipfile.ZIP_DEFLATED ) as outputZip:
-				for filename in inputZip.namelist():
-					contents = inputZip.read( filename )
-					contentKeyBase64 = contentKeys.get( filename, None )
-					if contentKeyBase64 is not None:
-						contents = self.__DecryptContents( contents, contentKeyBase64 )
-					outputZip.writestr( filename, contents )
+				pendingEntries = collections.deque()
+				parallelByteCount = 0
+
+				zipInfos = sorted( inputZip.infolist(), key = lambda zipInfo: zipInfo.filename != "mimetype" )
+				for zipInfo in zipInfos:
+					contentKeyBase64 = contentKeys.get( zipInfo.filename, None )
+					decryptedContents = None
+					if ( contentKeyBase64 is not None ) and ( decryptInParallel is not None ) and zipInfo.file_size >= KoboDrmRemover.ParallelEntrySize:
+						# Wait for the oldest entries until this one fits in memory.
+						while parallelByteCount > 0 and parallelByteCount + zipInfo.file_size > KoboDrmRemover.ParallelByteCount:
+							entry = pendingEntries.popleft()
+							if entry[ 2 ] is not None:
+								parallelByteCount -= entry[ 0 ].file_size
+							decryptSeconds += self.__WriteEntry( inputZip, outputZip, compressionPolicy, *entry )
+
+						decryptedContents = decryptInParallel( inputZip.read( zipInfo ), contentKeyBase64 )
+						parallelByteCount += zipInfo.file_size
+
+					pendingEntries.append( ( zipInfo, contentKeyBase64, decryptedContents ) )
+
+					# Write the entries that are not waiting for parallel decryption.
+					while len( pendingEntries ) > 0 and pendingEntries[ 0 ][ 2 ] is None:
+						decryptSeconds += self.__WriteEntry( inputZip, outputZip, compressionPolicy, *pendingEntries.popleft() )
+
+				while len( pendingEntries ) > 0:
+					decryptSeconds += self.__WriteEntry( inputZip, outputZip, compressionPolicy, *pendingEntries.popleft() )
+
+		return decryptSeconds
@@ -0,0 +1,3 @@
+# It is in its own module, so raising and catching it doesn't import requests and the rest of the Kobo module.
+class KoboException( Exception ):
+	pass
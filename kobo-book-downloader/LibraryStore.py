@@ -0,0 +1,192 @@
+from typing import Iterator, List, Optional
+import json
+import sqlite3
+
+# A book of the library with only the fields that the commands use. The whole entitlements with the book metadata would
+# take much more memory for big libraries.
+class LibraryBook:
+	__slots__ = [ "RevisionId", "Title", "ContributorRoles", "IsArchived", "IsRead", "IsPreview", "IsLocked", "LastModified" ]
+
+	def __init__( self, revisionId: str, title: str, contributorRoles: list, isArchived: bool, isRead: bool, isPreview: bool, isLocked: bool, lastModified: str ):
+		self.RevisionId = revisionId
+		self.Title = title
+		self.ContributorRoles = contributorRoles # Only the Name and Role fields are kept.
+		self.IsArchived = isArchived
+		self.IsRead = isRead
+		self.IsPreview = isPreview
+		self.IsLocked = isLocked
+		self.LastModified = lastModified
+
+	# Returns None if the entitlement doesn't have book metadata.
+	@staticmethod
+	def FromEntitlement( newEntitlement: dict ) -> Optional[ "LibraryBook" ]:
+		bookMetadata = newEntitlement.get( "BookMetadata" )
+		if bookMetadata is None:
+			return None
+
+		contributorRoles = []
+		for contributor in bookMetadata.get( "ContributorRoles", [] ):
+			contributorRole = { "Name": contributor[ "Name" ] }
+			if "Role" in contributor:
+				contributorRole[ "Role" ] = contributor[ "Role" ]
+			contributorRoles.append( contributorRole )
+
+		bookEntitlement = newEntitlement.get( "BookEntitlement" ) or {}
+		readingState = newEntitlement.get( "ReadingState" ) or {}
+		statusInfo = readingState.get( "StatusInfo" ) or {}
+
+		return LibraryBook( bookMetadata[ "RevisionId" ],
+			bookMetadata[ "Title" ],
+			contributorRoles,
+			bool( bookEntitlement.get( "IsRemoved" ) ),
+			statusInfo.get( "Status" ) == "Finished",
+			bookEntitlement.get( "Accessibility" ) == "Preview", # Saved preview.
+			bool( bookEntitlement.get( "IsLocked" ) ), # Refunded book.
+			bookEntitlement.get( "LastModified", "" ) )
+
+# Local copy of the "library_sync" feed. It stores the last synchronization token too, so on the next run only the
+# changes since the previous synchronization have to be downloaded.
+#
+# The feed contains items like { "NewEntitlement": { "BookEntitlement": ..., "BookMetadata": ..., "ReadingState": ... } },
+# { "ChangedEntitlement": { ... } }, { "ChangedReadingState": { "ReadingState": ... } } and
+# { "ChangedProductMetadata": { "BookMetadata": ... } }. They are merged into a single entitlement per book. The fields of
+# LibraryBook are stored in their own columns too, so the books can be listed without parsing the entitlements.
+#
+# When the schema changes the old tables are dropped, so the library is synchronized from scratch.
+class LibraryStore:
+	QueryParameterCount = 500
+	SchemaVersion = 2
+
+	def __init__( self, filePath: str ):
+		self.FilePath = filePath
+		self.Connection = sqlite3.connect( filePath, check_same_thread = False )
+
+		with self.Connection:
+			if self.Connection.execute( "PRAGMA user_version" ).fetchone()[ 0 ] != LibraryStore.SchemaVersion:
+				self.Connection.execute( "DROP TABLE IF EXISTS State" )
+				self.Connection.execute( "DROP TABLE IF EXISTS Entitlements" )
+				self.Connection.execute( "PRAGMA user_version = %d" % LibraryStore.SchemaVersion )
+
+			self.Connection.execute( "CREATE TABLE IF NOT EXISTS State ( Name TEXT PRIMARY KEY, Value TEXT NOT NULL )" )
+			self.Connection.execute( "CREATE TABLE IF NOT EXISTS Entitlements ( Id TEXT PRIMARY KEY, Json TEXT NOT NULL, RevisionId TEXT, Title TEXT, "
+				"ContributorRoles TEXT, IsArchived INTEGER, IsRead INTEGER, IsPreview INTEGER, IsLocked INTEGER, LastModified TEXT )" )
+			self.Connection.execute( "CREATE INDEX IF NOT EXISTS EntitlementsRevisionId ON Entitlements ( RevisionId )" )
+
+	def Close( self ) -> None:
+		self.Connection.close()
+
+	def __GetState( self, name: str ) -> str:
+		row = self.Connection.execute( "SELECT Value FROM State WHERE Name = ?", ( name, ) ).fetchone()
+		if row is None:
+			return ""
+
+		return row[ 0 ]
+
+	def __SetState( self, name: str, value: str ) -> None:
+		self.Connection.execute( "INSERT OR REPLACE INTO State ( Name, Value ) VALUES ( ?, ? )", ( name, value ) )
+
+	def GetSyncToken( self ) -> str:
+		return self.__GetState( "SyncToken" )
+
+	def GetUserId( self ) -> str:
+		return self.__GetState( "UserId" )
+
+	# Forgets everything, the next synchronization will download the whole library.
+	def Reset( self, userId: str ) -> None:
+		with self.Connection:
+			self.Connection.execute( "DELETE FROM Entitlements" )
+			self.Connection.execute( "DELETE FROM State" )
+			self.__SetState( "UserId", userId )
+
+	@staticmethod
+	def __GetEntitlementId( entitlement: dict ) -> str:
+		bookEntitlement = entitlement.get( "BookEntitlement" )
+		if bookEntitlement is not None and "Id" in bookEntitlement:
+			return bookEntitlement[ "Id" ]
+
+		readingState = entitlement.get( "ReadingState" )
+		if readingState is not None and "EntitlementId" in readingState:
+			return readingState[ "EntitlementId" ]
+
+		bookMetadata = entitlement.get( "BookMetadata" )
+		if bookMetadata is not None:
+			if "EntitlementId" in bookMetadata:
+				return bookMetadata[ "EntitlementId" ]
+			if "RevisionId" in bookMetadata:
+				return bookMetadata[ "RevisionId" ]
+
+		return ""
+
+	# Returns with the identifier of the changed entitlement, or with an empty string if it couldn't be identified.
+	def __MergeEntitlement( self, changes: dict ) -> str:
+		entitlementId = LibraryStore.__GetEntitlementId( changes )
+		if len( entitlementId ) == 0:
+			return entitlementId
+
+		entitlement = {}
+		row = self.Connection.execute( "SELECT Json FROM Entitlements WHERE Id = ?", ( entitlementId, ) ).fetchone()
+		if row is not None:
+			entitlement = json.loads( row[ 0 ] )
+
+		entitlement.update( changes )
+
+		book = LibraryBook.FromEntitlement( entitlement )
+		if book is None:
+			self.Connection.execute( "INSERT OR REPLACE INTO Entitlements ( Id, Json ) VALUES ( ?, ? )", ( entitlementId, json.dumps( entitlement ) ) )
+		else:
+			self.Connection.execute( "INSERT OR REPLACE INTO Entitlements ( Id, Json, RevisionId, Title, ContributorRoles, IsArchived, IsRead, IsPreview, IsLocked, LastModified ) "
+				"VALUES ( ?, ?, ?, ?, ?, ?, ?, ?, ?, ? )", ( entitlementId, json.dumps( entitlement ), book.RevisionId, book.Title, json.dumps( book.ContributorRoles ),
+				book.IsArchived, book.IsRead, book.IsPreview, book.IsLocked, book.LastModified ) )
+
+		return entitlementId
+
+	# Applies a page of the feed and stores the synchronization token that continues from it. It is done in a single
+	# transaction, so an interrupted synchronization can continue where it was stopped.
+	#
+	# Returns with the identifiers of the changed entitlements.
+	def ApplyPage( self, bookList: list, syncToken: str ) -> List[ str ]:
+		entitlementIds = []
+
+		with self.Connection:
+			for item in bookList:
+				for itemType in [ "NewEntitlement", "ChangedEntitlement", "ChangedReadingState", "ChangedProductMetadata" ]:
+					changes = item.get( itemType )
+					if changes is not None:
+						entitlementId = self.__MergeEntitlement( changes )
+						if len( entitlementId ) > 0:
+							entitlementIds.append( entitlementId )
+
+			self.__SetState( "SyncToken", syncToken )
+
+		return list( dict.fromkeys( entitlementIds ) )
+
+	__BookQuery = "SELECT RevisionId, Title, ContributorRoles, IsArchived, IsRead, IsPreview, IsLocked, LastModified FROM Entitlements WHERE RevisionId IS NOT NULL"
+
+	@staticmethod
+	def __MakeBook( row: tuple ) -> LibraryBook:
+		revisionId, title, contributorRoles, isArchived, isRead, isPreview, isLocked, lastModified = row
+		return LibraryBook( revisionId, title, json.loads( contributorRoles ), bool( isArchived ), bool( isRead ), bool( isPreview ), bool( isLocked ), lastModified )
+
+	# Returns None if the book is not in the library.
+	def GetBook( self, revisionId: str ) -> Optional[ LibraryBook ]:
+		row = self.Connection.execute( LibraryStore.__BookQuery + " AND RevisionId = ?", ( revisionId, ) ).fetchone()
+		if row is None:
+			return None
+
+		return LibraryStore.__MakeBook( row )
+
+	# Returns the books one at a time, without the entitlements that don't have book metadata. If the entitlement
+	# identifiers are given then only their books are returned.
+	def GetBooks( self, entitlementIds: Optional[ List[ str ] ] = None ) -> Iterator[ LibraryBook ]:
+		query = LibraryStore.__BookQuery
+
+		if entitlementIds is None:
+			for row in self.Connection.execute( query ):
+				yield LibraryStore.__MakeBook( row )
+			return
+
+		# SQLite limits the number of parameters of a statement.
+		for start in range( 0, len( entitlementIds ), LibraryStore.QueryParameterCount ):
+			ids = entitlementIds[ start : start + LibraryStore.QueryParameterCount ]
+			for row in self.Connection.execute( query + " AND Id IN ( %s )" % ", ".join( "?" * len( ids ) ), ids ).fetchall():
+				yield LibraryStore.__MakeBook( row )
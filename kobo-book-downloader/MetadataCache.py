@@ -0,0 +1,49 @@
+from typing import Optional, Tuple
+import json
+import sqlite3
+import threading
+import time
+
+# On-disk cache for API responses that rarely change, like the initialization settings and the book metadata.
+#
+# Every entry has its own expiration time. Expired entries are kept, so they can be revalidated with their ETag. When
+# there are too many entries then the least recently used ones are removed.
+class MetadataCache:
+	MaximumEntryCount = 10000
+
+	def __init__( self, filePath: str ):
+		self.FilePath = filePath
+		self.Lock = threading.Lock()
+		self.Connection = sqlite3.connect( filePath, check_same_thread = False )
+
+		with self.Connection:
+			self.Connection.execute( "CREATE TABLE IF NOT EXISTS Entries ( Key TEXT PRIMARY KEY, Json TEXT NOT NULL, ETag TEXT NOT NULL, ExpirationTime REAL NOT NULL, LastUsedTime REAL NOT NULL )" )
+			self.Connection.execute( "CREATE INDEX IF NOT EXISTS EntriesByLastUsedTime ON Entries ( LastUsedTime )" )
+
+	def Close( self ) -> None:
+		self.Connection.close()
+
+	# Returns with the cached value (None if there is none), its ETag and whether it hasn't expired yet.
+	def Get( self, key: str ) -> Tuple[ Optional[ dict ], str, bool ]:
+		with self.Lock, self.Connection:
+			row = self.Connection.execute( "SELECT Json, ETag, ExpirationTime FROM Entries WHERE Key = ?", ( key, ) ).fetchone()
+			if row is None:
+				return None, "", False
+
+			now = time.time()
+			self.Connection.execute( "UPDATE Entries SET LastUsedTime = ? WHERE Key = ?", ( now, key ) )
+
+		jsonText, eTag, expirationTime = row
+		return json.loads( jsonText ), eTag, now < expirationTime
+
+	def Put( self, key: str, value: dict, eTag: str, timeToLive: float ) -> None:
+		now = time.time()
+
+		with self.Lock, self.Connection:
+			self.Connection.execute( "INSERT OR REPLACE INTO Entries ( Key, Json, ETag, ExpirationTime, LastUsedTime ) VALUES ( ?, ?, ?, ?, ? )",
+				( key, json.dumps( value ), eTag, now + timeToLive, now ) )
+
+			entryCount = self.Connection.execute( "SELECT COUNT(*) FROM Entries" ).fetchone()[ 0 ]
+			if entryCount > MetadataCache.MaximumEntryCount:
+				self.Connection.execute( "DELETE FROM Entries WHERE Key IN ( SELECT Key FROM Entries ORDER BY LastUsedTime LIMIT ? )",
+					( entryCount - MetadataCache.MaximumEntryCount, ) )
@@ -0,0 +1,186 @@
+from Globals import Globals
+
+from typing import Dict, Optional
+import email.utils
+import threading
+import time
+import urllib.parse
+
+# Paces the requests that go to a single host.
+#
+# The requests in flight are limited by a concurrency limit, and after the host has throttled us the requests per second
+# are limited by a token bucket too. The rate starts from the rate that got throttled. Both limits adapt to the host
+# (additive increase, multiplicative decrease): they grow slowly while they hold back the requests and the responses are
+# healthy. The rate is decreased when the host throttles us, and the concurrency limit when the host is failing or its
+# latency grows much higher than usual. After a Retry-After header no request is sent to the host until the given time.
+class HostScheduler:
+	def __init__( self, host: str ):
+		self.Host = host
+		self.Condition = threading.Condition()
+		self.ConcurrencyLimit = float( RequestScheduler.InitialConcurrency )
+		# The rate is not limited until the first throttling.
+		self.RequestsPerSecond = None # type: float | None
+		self.Tokens = float( RequestScheduler.Burst )
+		self.LastRefillTime = time.monotonic()
+		self.RequestCount = 0
+		self.RateWindowStartTime = self.LastRefillTime
+		self.MeasuredRequestsPerSecond = 0.0
+		self.InFlight = 0
+		self.WaitedForToken = False
+		self.SlowStart = True
+		self.BlockedUntil = 0.0
+		self.NextDecreaseTime = 0.0
+		self.ShortLatency = None # type: float | None
+		self.LongLatency = None # type: float | None
+
+	def __RefillTokens( self, now: float ) -> None:
+		# The tokens don't pile up while the host has told us to wait, otherwise they would be spent in a burst after it.
+		if now < self.BlockedUntil:
+			self.Tokens = 0.0
+		elif self.RequestsPerSecond is not None:
+			self.Tokens = min( float( RequestScheduler.Burst ), self.Tokens + ( now - self.LastRefillTime ) * self.RequestsPerSecond )
+		self.LastRefillTime = now
+
+	def __CountRequest( self, now: float ) -> None:
+		self.RequestCount += 1
+		elapsedTime = now - self.RateWindowStartTime
+		if elapsedTime >= 1.0:
+			self.MeasuredRequestsPerSecond = self.RequestCount / elapsedTime
+			self.RequestCount = 0
+			self.RateWindowStartTime = now
+
+	def __GetSentRequestsPerSecond( self, now: float ) -> float:
+		return max( self.MeasuredRequestsPerSecond, self.RequestCount / max( 1.0, now - self.RateWindowStartTime ) )
+
+	# Waits until the request can be sent.
+	def Acquire( self ) -> None:
+		with self.Condition:
+			while True:
+				now = time.monotonic()
+				self.__RefillTokens( now )
+
+				if now < self.BlockedUntil:
+					timeout = self.BlockedUntil - now
+				elif self.InFlight >= int( self.ConcurrencyLimit ):
+					timeout = None # Release will wake us up.
+				elif self.RequestsPerSecond is not None and self.Tokens < 1.0:
+					self.WaitedForToken = True
+					timeout = ( 1.0 - self.Tokens ) / self.RequestsPerSecond
+				else:
+					if self.RequestsPerSecond is not None:
+						self.Tokens -= 1.0
+					self.InFlight += 1
+					self.__CountRequest( now )
+					return
+
+				self.Condition.wait( timeout )
+
+	# Returns True if the latency is much higher than the long term average. Comparing to the average instead of a fixed
+	# baseline works with endpoints that take different times to answer.
+	def __IsLatencyUnhealthy( self, latency: float ) -> bool:
+		if self.ShortLatency is None or self.LongLatency is None:
+			self.ShortLatency = latency
+			self.LongLatency = latency
+			return False
+
+		self.ShortLatency += ( latency - self.ShortLatency ) * RequestScheduler.ShortLatencyWeight
+		self.LongLatency += ( latency - self.LongLatency ) * RequestScheduler.LongLatencyWeight
+		return self.ShortLatency > self.LongLatency * RequestScheduler.LatencyTolerance
+
+	def __Decrease( self, now: float, throttled: bool ) -> None:
+		# Decrease only once per round trip, the responses of the requests that were already in flight don't count. Rate
+		# limits are usually counted per second, so after throttling a new rate gets at least a second (or until the
+		# Retry-After) to prove itself.
+		if now < self.NextDecreaseTime:
+			return
+
+		self.SlowStart = False
+
+		# Throttling is about the rate of the requests, the rest means that the host is overloaded.
+		if throttled:
+			requestsPerSecond = self.RequestsPerSecond
+			if requestsPerSecond is None:
+				requestsPerSecond = self.__GetSentRequestsPerSecond( now )
+				self.Tokens = 0.0
+
+			self.RequestsPerSecond = max( RequestScheduler.MinimumRequestsPerSecond, requestsPerSecond * RequestScheduler.RateDecreaseFactor )
+			self.NextDecreaseTime = max( now + 1.0, self.BlockedUntil )
+		else:
+			self.ConcurrencyLimit = max( float( RequestScheduler.MinimumConcurrency ), self.ConcurrencyLimit * RequestScheduler.DecreaseFactor )
+			self.NextDecreaseTime = now + ( self.ShortLatency or 1.0 )
+
+		Globals.Logger.debug( "Decreased the limits of '%s' to %d requests in flight and %s requests per second" % ( self.Host, self.ConcurrencyLimit, self.RequestsPerSecond ) )
+
+	# Must be called after each Acquire. latency is the time until the headers of the response have arrived, or None if
+	# the request has failed without a response. retryAfter is in seconds.
+	def Release( self, latency: Optional[ float ], throttled: bool, failed: bool, retryAfter: float ) -> None:
+		with self.Condition:
+			now = time.monotonic()
+			saturated = self.InFlight >= int( self.ConcurrencyLimit )
+			self.InFlight -= 1
+
+			if retryAfter > 0:
+				self.BlockedUntil = max( self.BlockedUntil, now + min( retryAfter, RequestScheduler.MaximumRetryAfter ) )
+
+			if throttled or failed or ( latency is not None and self.__IsLatencyUnhealthy( latency ) ):
+				self.__Decrease( now, throttled )
+			else:
+				# Raise the limits only if they have held back the requests, otherwise they would grow without limit. Until
+				# the first sign of trouble the concurrency limit roughly doubles in every round trip, like the slow start of
+				# TCP.
+				if saturated:
+					increase = 1.0 if self.SlowStart else 1.0 / self.ConcurrencyLimit
+					self.ConcurrencyLimit = min( float( RequestScheduler.MaximumConcurrency ), self.ConcurrencyLimit + increase )
+
+				if self.WaitedForToken:
+					self.WaitedForToken = False
+					# About one more request per second in every second.
+					self.RequestsPerSecond = min( RequestScheduler.MaximumRequestsPerSecond, self.RequestsPerSecond + 1.0 / self.RequestsPerSecond )
+
+			self.Condition.notify_all()
+
+# Shared by every request of the session, it has a HostScheduler for each host.
+class RequestScheduler:
+	InitialConcurrency = 8
+	MinimumConcurrency = 1
+	MaximumConcurrency = 64
+	MinimumRequestsPerSecond = 0.5
+	MaximumRequestsPerSecond = 1000.0
+	Burst = 5 # The size of the token bucket.
+	DecreaseFactor = 0.5
+	RateDecreaseFactor = 0.7
+	LatencyTolerance = 3.0 # The latency is unhealthy above this times the long term average.
+	ShortLatencyWeight = 0.2
+	LongLatencyWeight = 0.02
+	MaximumRetryAfter = 300 # seconds
+	ThrottlingStatusCodes = [ 429, 503 ]
+
+	def __init__( self ):
+		self.Lock = threading.Lock()
+		self.Hosts = {} # type: Dict[ str, HostScheduler ]
+
+	def GetHostScheduler( self, url: str ) -> HostScheduler:
+		host = urllib.parse.urlsplit( url ).netloc
+		with self.Lock:
+			hostScheduler = self.Hosts.get( host )
+			if hostScheduler is None:
+				hostScheduler = HostScheduler( host )
+				self.Hosts[ host ] = hostScheduler
+
+			return hostScheduler
+
+	# Returns the seconds to wait from the Retry-After header, that can be a number of seconds or an HTTP date.
+	@staticmethod
+	def GetRetryAfter( headers ) -> float:
+		value = headers.get( "Retry-After" )
+		if value is None:
+			return 0.0
+
+		value = value.strip()
+		if value.isdigit():
+			return float( value )
+
+		try:
+			return email.utils.parsedate_to_datetime( value ).timestamp() - time.time()
+		except ( TypeError, ValueError ):
+			return 0.0
@@ -0,0 +1,150 @@
+from typing import List, Optional
+import json
+import os
+import threading
+import time
+
+# Timings of the phases of downloading a single book. Times are in seconds, None means that the phase didn't happen.
+class BookStatistics:
+	def __init__( self, revisionId: str ):
+		self.RevisionId = revisionId
+		self.OutputPath = ""
+		self.Error = ""
+		self.ContentAccessSeconds = None # type: float | None
+		self.TimeToFirstByteSeconds = None # type: float | None
+		self.TransferSeconds = None # type: float | None
+		self.BytesDownloaded = 0
+		self.DecryptSeconds = None # type: float | None
+		self.CompressSeconds = None # type: float | None # Everything in the DRM removal except the decryption: decompressing, compressing and writing.
+		self.BytesWritten = 0
+		self.TotalSeconds = None # type: float | None
+
+	def GetTransferRate( self ) -> Optional[ float ]:
+		if not self.TransferSeconds:
+			return None
+
+		return self.BytesDownloaded / self.TransferSeconds
+
+	def ToJson( self ) -> dict:
+		return {
+			"BytesDownloaded": self.BytesDownloaded,
+			"BytesWritten": self.BytesWritten,
+			"CompressSeconds": self.CompressSeconds,
+			"ContentAccessSeconds": self.ContentAccessSeconds,
+			"DecryptSeconds": self.DecryptSeconds,
+			"Error": self.Error,
+			"OutputPath": self.OutputPath,
+			"RevisionId": self.RevisionId,
+			"TimeToFirstByteSeconds": self.TimeToFirstByteSeconds,
+			"TotalSeconds": self.TotalSeconds,
+			"TransferBytesPerSecond": self.GetTransferRate(),
+			"TransferSeconds": self.TransferSeconds
+		}
+
+# Collects the statistics of the books downloaded in a run, and writes them as JSON (or JSONL if the file name ends with
+# .jsonl) and as a Prometheus textfile (for node_exporter's textfile collector).
+class RunReport:
+	def __init__( self ):
+		self.StartTime = time.time()
+		self.StartCounter = time.perf_counter()
+		self.Lock = threading.Lock()
+		self.Books = [] # type: List[ BookStatistics ]
+		self.Retries = 0
+		self.TokenRefreshes = 0
+		self.DownloadResumes = 0
+
+	def AddBook( self, bookStatistics: BookStatistics ) -> None:
+		with self.Lock:
+			self.Books.append( bookStatistics )
+
+	def AddRetries( self, count: int ) -> None:
+		with self.Lock:
+			self.Retries += count
+
+	def AddTokenRefresh( self ) -> None:
+		with self.Lock:
+			self.TokenRefreshes += 1
+
+	def AddDownloadResume( self ) -> None:
+		with self.Lock:
+			self.DownloadResumes += 1
+
+	def __GetSummary( self ) -> dict:
+		downloadedBooks = [ book for book in self.Books if len( book.Error ) == 0 ]
+
+		def Sum( attributeName: str ):
+			return sum( getattr( book, attributeName ) or 0 for book in downloadedBooks )
+
+		return {
+			"BytesDownloaded": Sum( "BytesDownloaded" ),
+			"BytesWritten": Sum( "BytesWritten" ),
+			"CompressSeconds": Sum( "CompressSeconds" ),
+			"ContentAccessSeconds": Sum( "ContentAccessSeconds" ),
+			"DecryptSeconds": Sum( "DecryptSeconds" ),
+			"DownloadedBooks": len( downloadedBooks ),
+			"DownloadResumes": self.DownloadResumes,
+			"DurationSeconds": time.perf_counter() - self.StartCounter,
+			"FailedBooks": len( self.Books ) - len( downloadedBooks ),
+			"Retries": self.Retries,
+			"StartTime": self.StartTime,
+			"TimeToFirstByteSeconds": Sum( "TimeToFirstByteSeconds" ),
+			"TokenRefreshes": self.TokenRefreshes,
+			"TransferSeconds": Sum( "TransferSeconds" )
+		}
+
+	# Can be called while the books are being downloaded, for following the progress of the run.
+	def GetSummary( self ) -> dict:
+		with self.Lock:
+			return self.__GetSummary()
+
+	@staticmethod
+	def __WriteAtomically( filePath: str, text: str ) -> None:
+		temporaryFilePath = filePath + ".saving"
+		with open( temporaryFilePath, "w" ) as f:
+			f.write( text )
+
+		os.replace( temporaryFilePath, filePath )
+
+	def Write( self, filePath: str ) -> None:
+		with self.Lock:
+			summary = self.__GetSummary()
+			books = [ book.ToJson() for book in self.Books ]
+
+		if filePath.endswith( ".jsonl" ):
+			lines = [ json.dumps( dict( book, Type = "Book" ) ) for book in books ]
+			lines.append( json.dumps( dict( summary, Type = "Summary" ) ) )
+			text = "\n".join( lines ) + "\n"
+		else:
+			text = json.dumps( { "Books": books, "Summary": summary }, indent = 4 )
+
+		RunReport.__WriteAtomically( filePath, text )
+
+	def WritePrometheusTextfile( self, filePath: str ) -> None:
+		summary = self.GetSummary()
+
+		prefix = "kobo_book_downloader_"
+		metrics = [
+			( "books", "gauge", "Books processed in the last run.", [ ( '{status="downloaded"}', summary[ "DownloadedBooks" ] ), ( '{status="failed"}', summary[ "FailedBooks" ] ) ] ),
+			( "downloaded_bytes", "gauge", "Bytes downloaded in the last run.", [ ( "", summary[ "BytesDownloaded" ] ) ] ),
+			( "written_bytes", "gauge", "Bytes of books written in the last run.", [ ( "", summary[ "BytesWritten" ] ) ] ),
+			( "phase_seconds", "gauge", "Time spent in each phase in the last run, summed over the books.", [
+				( '{phase="content_access"}', summary[ "ContentAccessSeconds" ] ),
+				( '{phase="time_to_first_byte"}', summary[ "TimeToFirstByteSeconds" ] ),
+				( '{phase="transfer"}', summary[ "TransferSeconds" ] ),
+				( '{phase="decrypt"}', summary[ "DecryptSeconds" ] ),
+				( '{phase="compress"}', summary[ "CompressSeconds" ] ) ] ),
+			( "retries", "gauge", "Retried requests in the last run.", [ ( "", summary[ "Retries" ] ) ] ),
+			( "download_resumes", "gauge", "Resumed downloads in the last run.", [ ( "", summary[ "DownloadResumes" ] ) ] ),
+			( "token_refreshes", "gauge", "Authentication token refreshes in the last run.", [ ( "", summary[ "TokenRefreshes" ] ) ] ),
+			( "run_duration_seconds", "gauge", "Duration of the last run.", [ ( "", summary[ "DurationSeconds" ] ) ] ),
+			( "last_run_timestamp_seconds", "gauge", "Start time of the last run.", [ ( "", summary[ "StartTime" ] ) ] ),
+		]
+
+		lines = []
+		for name, metricType, help, samples in metrics:
+			lines.append( "# HELP %s%s %s" % ( prefix, name, help ) )
+			lines.append( "# TYPE %s%s %s" % ( prefix, name, metricType ) )
+			for labels, value in samples:
+				lines.append( "%s%s%s %s" % ( prefix, name, labels, repr( float( value ) ) ) )
+
+		RunReport.__WriteAtomically( filePath, "\n".join( lines ) + "\n" )
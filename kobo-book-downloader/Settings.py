@@ -1,15 +1,35 @@
+from typing import Iterator
+import contextlib
 import json
 import os
+import threading
 
+if os.name == "nt":
+	import msvcrt
+else:
+	import fcntl
+
+# The settings file is shared by all the processes that run at the same time (for example by parallel jobs of a scheduler),
+# so it is always saved under a lock, and it is replaced atomically: the other processes can read it any time without
+# seeing a half-written file.
 class Settings:
 	def __init__( self ):
 		self.DeviceId = ""
 		self.SerialNumber = ""
 		self.AccessToken = ""
+		self.AccessTokenIssueTime = 0.0 # Unix time, 0 if it is not known.
+		self.AccessTokenExpiry = 0.0 # Unix time, 0 if it is not known.
+		self.AccessTokenLifetime = 0.0 # The shortest lifetime seen for tokens that don't tell their expiry, 0 if it is not known.
 		self.RefreshToken = ""
 		self.UserId = ""
 		self.UserKey = ""
 		self.SettingsFilePath = Settings.__GetCacheFilePath()
+		self.LibraryFilePath = os.path.join( os.path.dirname( self.SettingsFilePath ), "kobo-book-downloader-library.sqlite" )
+		self.MetadataCacheFilePath = os.path.join( os.path.dirname( self.SettingsFilePath ), "kobo-book-downloader-cache.sqlite" )
+		self.LockFilePath = self.SettingsFilePath + ".lock"
+		self.ThreadLock = threading.RLock()
+		self.LockFile = None
+		self.LockDepth = 0
 
 		self.Load()
 
@@ -29,13 +49,61 @@ class Settings:
 			self.__LoadFromJson( jsonObject )
 
 	def Save( self ) -> None:
-		with open( self.SettingsFilePath, "w" ) as f:
-			jsonObject = self.__SaveToJson()
-			f.write( json.dumps( jsonObject, indent = 4 ) )
+		with self.Lock():
+			temporaryFilePath = self.SettingsFilePath + ".saving"
+			with open( temporaryFilePath, "w" ) as f:
+				jsonObject = self.__SaveToJson()
+				f.write( json.dumps( jsonObject, indent = 4 ) )
+
+			# The file has the tokens, so it keeps the permissions that the user might have restricted.
+			if os.path.isfile( self.SettingsFilePath ):
+				os.chmod( temporaryFilePath, os.stat( self.SettingsFilePath ).st_mode & 0o777 )
+
+			os.replace( temporaryFilePath, self.SettingsFilePath )
+
+	# Locks the settings against the other processes and threads. It can be nested. The lock is on a separate file, because
+	# the settings file itself is replaced when it is saved.
+	@contextlib.contextmanager
+	def Lock( self ) -> Iterator[ None ]:
+		with self.ThreadLock:
+			if self.LockDepth == 0:
+				self.LockFile = open( self.LockFilePath, "a+b" )
+				Settings.__LockFile( self.LockFile )
+
+			self.LockDepth += 1
+			try:
+				yield
+			finally:
+				self.LockDepth -= 1
+				if self.LockDepth == 0:
+					# Closing the file releases the lock, but Windows wants it to be unlocked first.
+					if os.name == "nt":
+						self.LockFile.seek( 0 )
+						msvcrt.locking( self.LockFile.fileno(), msvcrt.LK_UNLCK, 1 )
+					self.LockFile.close()
+					self.LockFile = None
+
+	@staticmethod
+	def __LockFile( lockFile ) -> None:
+		if os.name != "nt":
+			fcntl.flock( lockFile.fileno(), fcntl.LOCK_EX )
+			return
+
+		# msvcrt.locking gives up after ten seconds, but a refresh of the tokens might take longer than that.
+		lockFile.seek( 0 )
+		while True:
+			try:
+				msvcrt.locking( lockFile.fileno(), msvcrt.LK_LOCK, 1 )
+				return
+			except OSError:
+				pass
 
 	def __SaveToJson( self ) -> dict:
 		return {
 			"AccessToken": self.AccessToken,
+			"AccessTokenExpiry": self.AccessTokenExpiry,
+			"AccessTokenIssueTime": self.AccessTokenIssueTime,
+			"AccessTokenLifetime": self.AccessTokenLifetime,
 			"DeviceId": self.DeviceId,
 			"RefreshToken": self.RefreshToken,
 			"SerialNumber": self.SerialNumber,
@@ -45,6 +113,9 @@ class Settings:
 
 	def __LoadFromJson( self, jsonMap: dict ) -> None:
 		self.AccessToken = jsonMap.get( "AccessToken", self.AccessToken )
+		self.AccessTokenExpiry = jsonMap.get( "AccessTokenExpiry", self.AccessTokenExpiry )
+		self.AccessTokenIssueTime = jsonMap.get( "AccessTokenIssueTime", self.AccessTokenIssueTime )
+		self.AccessTokenLifetime = jsonMap.get( "AccessTokenLifetime", self.AccessTokenLifetime )
 		self.DeviceId = jsonMap.get( "DeviceId", self.DeviceId )
 		self.RefreshToken = jsonMap.get( "RefreshToken", self.RefreshToken )
 		self.SerialNumber = jsonMap.get( "SerialNumber", self.SerialNumber )
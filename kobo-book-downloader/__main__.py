@@ -1,33 +1,51 @@
 from Commands import Commands
+from CompressionPolicy import CompressionPolicy
 from Globals import Globals
-from Kobo import Kobo, KoboException
+from KoboException import KoboException
 from LogFormatter import LogFormatter
+from MetadataCache import MetadataCache
 from Settings import Settings
 
 import colorama
-import requests
 
 import argparse
 import logging
+import sys
 
+# The settings and the Kobo API are initialized only by the commands that need them (see InitializeSettings and
+# InitializeKoboApi), so the local commands and the help start fast.
 def InitializeGlobals() -> None:
 	streamHandler = logging.StreamHandler()
 	streamHandler.setFormatter( LogFormatter() )
 	Globals.Logger = logging.getLogger()
 	Globals.Logger.addHandler( streamHandler )
 
-	Globals.Kobo = Kobo()
+def InitializeSettings() -> None:
 	Globals.Settings = Settings()
 
-def InitializeKoboApi() -> None:
+# The Kobo module is imported here because importing requests takes longer than running the local commands.
+def InitializeKoboApi( useCache: bool ) -> None:
+	from Kobo import Kobo
+
+	Globals.Kobo = Kobo()
+
+	if useCache:
+		Globals.Kobo.MetadataCache = MetadataCache( Globals.Settings.MetadataCacheFilePath )
+
 	if not Globals.Settings.AreAuthenticationSettingsSet():
 		Globals.Kobo.AuthenticateDevice()
 
+	Globals.Kobo.StartTokenRefresher()
 	Globals.Kobo.LoadInitializationSettings()
 
 	if not Globals.Settings.IsLoggedIn():
 		Globals.Kobo.Login()
 
+def AddCompressionArguments( parser: argparse.ArgumentParser ) -> None:
+	parser.add_argument( "--compression", default = CompressionPolicy.Preserve, choices = CompressionPolicy.Modes, dest = "Compression",
+		help = "How to compress the entries of the DRM-free books: keep the original compression of the entries that were not encrypted and deflate the decrypted ones (default), store the already compressed media and deflate the rest, or deflate everything" )
+	parser.add_argument( "--compression-level", default = None, type = int, choices = range( 0, 10 ), dest = "CompressionLevel", help = "The deflate compression level (0-9)" )
+
 def Main() -> None:
 	InitializeGlobals()
 	colorama.init()
@@ -35,18 +53,38 @@ def Main() -> None:
 	argumentParser = argparse.ArgumentParser( add_help = False )
 	argumentParser.add_argument( "--help", "-h", default = False, action = "store_true" )
 	argumentParser.add_argument( "--verbose", default = False, action = "store_true", dest = "VerboseLogging" )
+	argumentParser.add_argument( "--full-sync", default = False, action = "store_true", dest = "FullSync" )
+	argumentParser.add_argument( "--no-cache", default = False, action = "store_true", dest = "NoCache" )
 	subparsers = argumentParser.add_subparsers( dest = "Command", title = "commands", metavar = "command" )
 	getParser = subparsers.add_parser( "get", help = "Download book" )
 	getParser.add_argument( "OutputPath", metavar = "output-path", help = "If the output path is a directory then the file will be named automatically." )
 	getParser.add_argument( "RevisionId", metavar = "book-id", nargs = "?", help = "The identifier of the book" )
 	getParser.add_argument( "--all", default = False, action = "store_true", help = "Download all my books" )
+	getParser.add_argument( "--jobs", "-j", default = 1, type = int, help = "The number of books to download in parallel when using --all" )
+	getParser.add_argument( "--skip-downloaded", default = False, action = "store_true", dest = "SkipDownloaded", help = "Only download new and changed books when using --all. The downloaded books are recorded in a manifest file in the output directory." )
+	getParser.add_argument( "--decrypt-workers", default = 0, type = int, dest = "DecryptWorkers", help = "The number of processes removing the DRM. By default it is done by the downloading threads." )
+	AddCompressionArguments( getParser )
+	getParser.add_argument( "--keep-encrypted", default = False, action = "store_true", dest = "KeepEncrypted", help = "Don't remove the DRM, save the encrypted books with their content keys instead. Use the decrypt command to remove the DRM later." )
+	getParser.add_argument( "--report", default = "", dest = "ReportPath", help = "Save the timings of each book and the retry and token refresh counts to this JSON file (or JSONL if the name ends with .jsonl)" )
+	getParser.add_argument( "--prometheus-textfile", default = "", dest = "PrometheusTextfilePath", help = "Save the summary of the run to this file in the Prometheus text format (for the textfile collector of node_exporter)" )
+	decryptParser = subparsers.add_parser( "decrypt", help = "Remove the DRM from books downloaded with get --keep-encrypted" )
+	decryptParser.add_argument( "InputPath", metavar = "input-path", help = "The directory of the encrypted books" )
+	decryptParser.add_argument( "OutputPath", metavar = "output-path", help = "The directory of the decrypted books" )
+	decryptParser.add_argument( "--decrypt-workers", default = 0, type = int, dest = "DecryptWorkers", help = "The number of processes removing the DRM" )
+	AddCompressionArguments( decryptParser )
 	infoParser = subparsers.add_parser( "info", help = "Show the location of the program's configuration file" )
 	listParser = subparsers.add_parser( "list", help = "List unread books" )
 	listParser.add_argument( "--all", default = False, action = "store_true", help = "List read books too" )
+	listParser.add_argument( "--unsorted", default = False, action = "store_true", dest = "Unsorted", help = "Print the books as soon as they arrive instead of sorting them by title" )
 	pickParser = subparsers.add_parser( "pick", help = "Download books using interactive selection" )
 	pickParser.add_argument( "OutputPath", metavar = "output-path", help = "Output path must be an existing directory" )
 	pickParser.add_argument( "--all", default = False, action = "store_true", help = "List read books too" )
 	wishListParser = subparsers.add_parser( "wishlist", help = "List your wish listed books" )
+	serveParser = subparsers.add_parser( "serve", help = "Keep running and accept download, list and wishlist jobs over a local HTTP API" )
+	serveParser.add_argument( "--port", default = 8090, type = int, dest = "Port",
+		help = "The port of the API on 127.0.0.1 (default: 8090, 0 picks a free port). The requests must have the token that is written next to the configuration file." )
+	serveParser.add_argument( "--socket", default = "", dest = "SocketPath", help = "Listen on this Unix socket instead of the port. Only your user can connect to it." )
+	serveParser.add_argument( "--output-root", default = ".", dest = "OutputRoot", help = "The jobs can only download into this directory (default: the current directory)" )
 	arguments = argumentParser.parse_args()
 
 	if arguments.VerboseLogging:
@@ -54,24 +92,44 @@ def Main() -> None:
 
 	if arguments.Command is None:
 		Commands.ShowUsage()
+		return
+
+	InitializeSettings()
+
+	if arguments.Command == "decrypt":
+		compressionPolicy = CompressionPolicy( arguments.Compression, arguments.CompressionLevel )
+		Commands.DecryptBooks( arguments.InputPath, arguments.OutputPath, arguments.DecryptWorkers, compressionPolicy )
 	elif arguments.Command == "info":
 		Commands.Info()
 	else:
-		InitializeKoboApi()
+		InitializeKoboApi( not arguments.NoCache )
+
+		if arguments.FullSync:
+			Globals.Kobo.ResetLibrary()
 
 		if arguments.Command == "get":
-			Commands.GetBookOrBooks( arguments.RevisionId, arguments.OutputPath, arguments.all )
+			compressionPolicy = CompressionPolicy( arguments.Compression, arguments.CompressionLevel )
+			Commands.GetBookOrBooks( arguments.RevisionId, arguments.OutputPath, arguments.all, arguments.jobs, arguments.SkipDownloaded, arguments.DecryptWorkers,
+				arguments.KeepEncrypted, compressionPolicy, arguments.ReportPath, arguments.PrometheusTextfilePath )
 		elif arguments.Command == "list":
-			Commands.ListBooks( arguments.all )
+			Commands.ListBooks( arguments.all, not arguments.Unsorted )
 		elif arguments.Command == "pick":
 			Commands.PickBooks( arguments.OutputPath, arguments.all )
 		elif arguments.Command == "wishlist":
 			Commands.ListWishListedBooks()
+		elif arguments.Command == "serve":
+			from JobServer import JobServer
+			JobServer( arguments.OutputRoot ).Serve( arguments.Port, arguments.SocketPath )
 
 if __name__ == '__main__':
 	try:
 		Main()
 	except KoboException as e:
 		Globals.Logger.error( e )
-	except requests.exceptions.Timeout as e:
+	except Exception as e:
+		# requests is imported only by the commands that use the network.
+		requests = sys.modules.get( "requests" )
+		if ( requests is None ) or ( not isinstance( e, requests.exceptions.Timeout ) ):
+			raise
+
 		Globals.Logger.error( "The request has timed out." )
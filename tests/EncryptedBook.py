@@ -0,0 +1,30 @@
+from Crypto.Cipher import AES
+from Crypto.Util import Padding
+
+from typing import Dict, List, Tuple
+import base64
+import binascii
+import hashlib
+import os
+import zipfile
+
+DeviceId = "test-device"
+UserId = "test-user"
+
+# Writes a KDRM encrypted EPUB like the ones downloaded from Kobo. Each entry is ( name, plaintext, compression type,
+# encrypted ). Returns with the content keys.
+def MakeEncryptedBook( path: str, entries: List[ Tuple[ str, bytes, int, bool ] ] ) -> Dict[ str, str ]:
+	deviceIdUserIdKey = binascii.a2b_hex( hashlib.sha256( ( DeviceId + UserId ).encode() ).hexdigest()[ 32: ] )
+	keyAes = AES.new( deviceIdUserIdKey, AES.MODE_ECB )
+	contentKeys = {}
+
+	with zipfile.ZipFile( path, "w" ) as outputZip:
+		for name, contents, compressType, encrypted in entries:
+			if encrypted:
+				contentKey = os.urandom( 16 )
+				contents = AES.new( contentKey, AES.MODE_ECB ).encrypt( Padding.pad( contents, AES.block_size, "pkcs7" ) )
+				contentKeys[ name ] = base64.b64encode( keyAes.encrypt( contentKey ) ).decode()
+
+			outputZip.writestr( zipfile.ZipInfo( name, ( 2024, 1, 1, 0, 0, 0 ) ), contents, compressType )
+
+	return contentKeys
@@ -0,0 +1,66 @@
+import os
+import sys
+
+sys.path.insert( 0, os.path.join( os.path.dirname( os.path.dirname( os.path.abspath( __file__ ) ) ), "kobo-book-downloader" ) )
+
+from CompressionPolicy import CompressionPolicy
+from EncryptedBook import DeviceId, MakeEncryptedBook, UserId
+from KoboDrmRemover import KoboDrmRemover
+
+import shutil
+import tempfile
+import unittest
+import zipfile
+
+class CompressionPolicyTest( unittest.TestCase ):
+	Chapter = b"<html><body>" + b"<p>The same sentence again and again.</p>" * 1000 + b"</body></html>"
+	Image = os.urandom( 4096 )
+
+	def setUp( self ) -> None:
+		self.WorkingDirectory = tempfile.mkdtemp()
+		self.InputPath = os.path.join( self.WorkingDirectory, "book.epub" )
+		self.OutputPath = os.path.join( self.WorkingDirectory, "book.drm-free.epub" )
+		# The encrypted chapter is stored, like Kobo does with the ciphertext that wouldn't compress.
+		self.ContentKeys = MakeEncryptedBook( self.InputPath, [
+			( "mimetype", b"application/epub+zip", zipfile.ZIP_STORED, False ),
+			( "OEBPS/chapter.xhtml", CompressionPolicyTest.Chapter, zipfile.ZIP_STORED, True ),
+			( "OEBPS/deflated-chapter.xhtml", CompressionPolicyTest.Chapter, zipfile.ZIP_DEFLATED, True ),
+			( "OEBPS/cover.jpg", CompressionPolicyTest.Image, zipfile.ZIP_STORED, False ),
+			( "OEBPS/content.opf", b"<package/>" * 100, zipfile.ZIP_DEFLATED, False )
+		] )
+
+	def tearDown( self ) -> None:
+		shutil.rmtree( self.WorkingDirectory, ignore_errors = True )
+
+	def __RemoveDrm( self, compressionPolicy: CompressionPolicy ) -> dict:
+		KoboDrmRemover( DeviceId, UserId ).RemoveDrm( self.InputPath, self.OutputPath, self.ContentKeys, compressionPolicy )
+
+		with zipfile.ZipFile( self.OutputPath ) as outputZip:
+			self.assertIsNone( outputZip.testzip() )
+			self.assertEqual( outputZip.read( "OEBPS/chapter.xhtml" ), CompressionPolicyTest.Chapter )
+			self.assertEqual( outputZip.read( "OEBPS/cover.jpg" ), CompressionPolicyTest.Image )
+			return { zipInfo.filename: zipInfo.compress_type for zipInfo in outputZip.infolist() }
+
+	def testPreserveDeflatesTheDecryptedEntries( self ) -> None:
+		compressTypes = self.__RemoveDrm( CompressionPolicy( CompressionPolicy.Preserve ) )
+
+		self.assertEqual( compressTypes[ "mimetype" ], zipfile.ZIP_STORED )
+		self.assertEqual( compressTypes[ "OEBPS/chapter.xhtml" ], zipfile.ZIP_DEFLATED )
+		self.assertEqual( compressTypes[ "OEBPS/deflated-chapter.xhtml" ], zipfile.ZIP_DEFLATED )
+		self.assertEqual( compressTypes[ "OEBPS/cover.jpg" ], zipfile.ZIP_STORED )
+		self.assertEqual( compressTypes[ "OEBPS/content.opf" ], zipfile.ZIP_DEFLATED )
+
+	def testStoreMediaStoresOnlyTheMedia( self ) -> None:
+		compressTypes = self.__RemoveDrm( CompressionPolicy( CompressionPolicy.StoreMedia ) )
+
+		self.assertEqual( compressTypes[ "OEBPS/chapter.xhtml" ], zipfile.ZIP_DEFLATED )
+		self.assertEqual( compressTypes[ "OEBPS/cover.jpg" ], zipfile.ZIP_STORED )
+
+	def testDeflateDeflatesEverythingButTheMimetype( self ) -> None:
+		compressTypes = self.__RemoveDrm( CompressionPolicy( CompressionPolicy.Deflate ) )
+
+		self.assertEqual( compressTypes[ "mimetype" ], zipfile.ZIP_STORED )
+		self.assertEqual( compressTypes[ "OEBPS/cover.jpg" ], zipfile.ZIP_DEFLATED )
+
+if __name__ == "__main__":
+	unittest.main()
@@ -0,0 +1,88 @@
+import os
+import sys
+
+sys.path.insert( 0, os.path.join( os.path.dirname( os.path.dirname( os.path.abspath( __file__ ) ) ), "kobo-book-downloader" ) )
+
+from CompressionPolicy import CompressionPolicy
+from EncryptedBook import DeviceId, MakeEncryptedBook, UserId
+from KoboDrmRemover import KoboDrmRemover
+
+import io
+import shutil
+import tempfile
+import unittest
+import zipfile
+
+# zipfile writes the CRC and the sizes in a data descriptor after the data when it can't seek back to the local header.
+class UnseekableFile( io.RawIOBase ):
+	def __init__( self, outputFile: io.BytesIO ):
+		self.OutputFile = outputFile
+
+	def writable( self ) -> bool:
+		return True
+
+	def write( self, data ) -> int:
+		return self.OutputFile.write( data )
+
+	def tell( self ) -> int:
+		raise OSError( "The file is not seekable." )
+
+# The entries that are not encrypted are copied by KoboDrmRemover.__CopyEntry, which writes the local file headers itself
+# and registers the entries in zipfile's internal structures. This checks that the result is still a valid ZIP file, so a
+# change of zipfile can't silently corrupt the books.
+class CopyEntryTest( unittest.TestCase ):
+	Entries = [
+		( "mimetype", b"application/epub+zip", zipfile.ZIP_STORED ),
+		( "OEBPS/stored.jpg", os.urandom( 100000 ), zipfile.ZIP_STORED ),
+		( "OEBPS/deflated.xhtml", b"<p>Some text that compresses well.</p>" * 5000, zipfile.ZIP_DEFLATED ),
+		( "OEBPS/empty.css", b"", zipfile.ZIP_DEFLATED ),
+		( "OEBPS/été.xhtml", b"<p>UTF-8 file name.</p>" * 100, zipfile.ZIP_DEFLATED )
+	]
+
+	def setUp( self ) -> None:
+		self.WorkingDirectory = tempfile.mkdtemp()
+		self.InputPath = os.path.join( self.WorkingDirectory, "book.epub" )
+		self.OutputPath = os.path.join( self.WorkingDirectory, "book.drm-free.epub" )
+
+	def tearDown( self ) -> None:
+		shutil.rmtree( self.WorkingDirectory, ignore_errors = True )
+
+	def __CheckCopy( self, contentKeys: dict ) -> None:
+		KoboDrmRemover( DeviceId, UserId ).RemoveDrm( self.InputPath, self.OutputPath, contentKeys, CompressionPolicy( CompressionPolicy.Preserve ) )
+
+		with zipfile.ZipFile( self.InputPath ) as inputZip, zipfile.ZipFile( self.OutputPath ) as outputZip:
+			self.assertIsNone( outputZip.testzip() )
+			self.assertEqual( [ zipInfo.filename for zipInfo in outputZip.infolist() ], [ zipInfo.filename for zipInfo in inputZip.infolist() ] )
+
+			for name, contents, compressType in CopyEntryTest.Entries:
+				inputInfo = inputZip.getinfo( name )
+				outputInfo = outputZip.getinfo( name )
+				self.assertEqual( outputInfo.compress_type, compressType )
+				self.assertEqual( outputInfo.CRC, inputInfo.CRC )
+				self.assertEqual( outputInfo.compress_size, inputInfo.compress_size )
+				self.assertEqual( outputInfo.file_size, len( contents ) )
+				self.assertEqual( outputInfo.flag_bits & 0x08, 0 ) # No data descriptor.
+				self.assertEqual( outputZip.read( name ), contents )
+
+	def testCopyEntries( self ) -> None:
+		contentKeys = MakeEncryptedBook( self.InputPath, [ ( name, contents, compressType, False ) for name, contents, compressType in CopyEntryTest.Entries ]
+			+ [ ( "OEBPS/encrypted.xhtml", b"<p>Encrypted.</p>" * 100, zipfile.ZIP_DEFLATED, True ) ] )
+
+		self.__CheckCopy( contentKeys )
+
+	def testCopyEntriesWithDataDescriptors( self ) -> None:
+		output = io.BytesIO()
+		with zipfile.ZipFile( UnseekableFile( output ), "w" ) as inputZip:
+			for name, contents, compressType in CopyEntryTest.Entries:
+				inputZip.writestr( zipfile.ZipInfo( name, ( 2024, 1, 1, 0, 0, 0 ) ), contents, compressType )
+
+		with open( self.InputPath, "wb" ) as f:
+			f.write( output.getvalue() )
+
+		with zipfile.ZipFile( self.InputPath ) as inputZip:
+			self.assertTrue( all( zipInfo.flag_bits & 0x08 for zipInfo in inputZip.infolist() ) )
+
+		self.__CheckCopy( {} )
+
+if __name__ == "__main__":
+	unittest.main()
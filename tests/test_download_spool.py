@@ -0,0 +1,50 @@
+import os
+import sys
+
+sys.path.insert( 0, os.path.join( os.path.dirname( os.path.dirname( os.path.abspath( __file__ ) ) ), "kobo-book-downloader" ) )
+
+from EncryptedBook import DeviceId, MakeEncryptedBook, UserId
+from Kobo import DownloadSpool
+from KoboDrmRemover import KoboDrmRemover
+
+import shutil
+import tempfile
+import unittest
+import zipfile
+
+# Kobo.Download removes the DRM from the book while it is still in the spool, in memory or in the temporary file.
+class DownloadSpoolTest( unittest.TestCase ):
+	Chapter = os.urandom( 50000 )
+
+	def setUp( self ) -> None:
+		self.WorkingDirectory = tempfile.mkdtemp()
+		self.addCleanup( shutil.rmtree, self.WorkingDirectory, True )
+		self.InputPath = os.path.join( self.WorkingDirectory, "book.epub" )
+		self.OutputPath = os.path.join( self.WorkingDirectory, "book.drm-free.epub" )
+		self.ContentKeys = MakeEncryptedBook( self.InputPath, [
+			( "mimetype", b"application/epub+zip", zipfile.ZIP_STORED, False ),
+			( "OEBPS/chapter.xhtml", DownloadSpoolTest.Chapter, zipfile.ZIP_DEFLATED, True )
+		] )
+
+	def __RemoveDrm( self, maximumSize: int ) -> bool:
+		with DownloadSpool( max_size = maximumSize ) as encryptedFile:
+			with open( self.InputPath, "rb" ) as f:
+				shutil.copyfileobj( f, encryptedFile )
+
+			KoboDrmRemover( DeviceId, UserId ).RemoveDrm( encryptedFile, self.OutputPath, self.ContentKeys )
+			rolledOver = encryptedFile._rolled
+
+		with zipfile.ZipFile( self.OutputPath ) as outputZip:
+			self.assertIsNone( outputZip.testzip() )
+			self.assertEqual( outputZip.read( "OEBPS/chapter.xhtml" ), DownloadSpoolTest.Chapter )
+
+		return rolledOver
+
+	def testBookInMemory( self ) -> None:
+		self.assertFalse( self.__RemoveDrm( 1024 * 1024 ) )
+
+	def testBookInTemporaryFile( self ) -> None:
+		self.assertTrue( self.__RemoveDrm( 1024 ) )
+
+if __name__ == "__main__":
+	unittest.main()
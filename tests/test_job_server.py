@@ -0,0 +1,99 @@
+import os
+import sys
+
+sys.path.insert( 0, os.path.join( os.path.dirname( os.path.dirname( os.path.abspath( __file__ ) ) ), "kobo-book-downloader" ) )
+
+from Globals import Globals
+from JobServer import JobHttpServer, JobServer
+from Settings import Settings
+
+import http.client
+import json
+import logging
+import shutil
+import tempfile
+import threading
+import unittest
+import unittest.mock
+
+# The jobs are only queued, the worker thread of the server is not started.
+class JobServerTest( unittest.TestCase ):
+	Token = "test-token"
+
+	def setUp( self ) -> None:
+		self.WorkingDirectory = tempfile.mkdtemp()
+		environment = unittest.mock.patch.dict( os.environ, { "XDG_CONFIG_HOME": self.WorkingDirectory } )
+		environment.start()
+		self.addCleanup( environment.stop )
+		Globals.Logger = logging.getLogger()
+		Globals.Settings = Settings()
+
+		self.OutputRoot = os.path.join( self.WorkingDirectory, "books" )
+		os.mkdir( self.OutputRoot )
+		self.JobServer = JobServer( self.OutputRoot )
+		self.Server = JobHttpServer( 0, self.JobServer, JobServerTest.Token )
+		self.Port = self.Server.server_address[ 1 ]
+		threading.Thread( target = self.Server.serve_forever, daemon = True ).start()
+
+	def tearDown( self ) -> None:
+		self.Server.shutdown()
+		self.Server.server_close()
+		shutil.rmtree( self.WorkingDirectory, ignore_errors = True )
+
+	def __Request( self, method: str, body = None, headers: dict = {} ) -> int:
+		allHeaders = { "Authorization": "Bearer " + JobServerTest.Token, "Content-Type": "application/json" }
+		allHeaders.update( headers )
+		allHeaders = { name: value for name, value in allHeaders.items() if value is not None }
+
+		connection = http.client.HTTPConnection( "127.0.0.1", self.Port, timeout = 10 )
+		try:
+			connection.request( method, "/jobs", None if body is None else json.dumps( body ), allHeaders )
+			response = connection.getresponse()
+			response.read()
+			return response.status
+		finally:
+			connection.close()
+
+	def testJobIsQueued( self ) -> None:
+		self.assertEqual( self.__Request( "POST", { "Command": "get", "OutputPath": "new", "All": True } ), 202 )
+		self.assertEqual( self.JobServer.GetJob( 1 ).Parameters[ "OutputPath" ], os.path.join( os.path.realpath( self.OutputRoot ), "new" ) )
+		self.assertEqual( self.__Request( "GET", headers = { "Host": "localhost:%d" % self.Port } ), 200 )
+
+	def testTokenIsRequired( self ) -> None:
+		self.assertEqual( self.__Request( "GET", headers = { "Authorization": None } ), 401 )
+		self.assertEqual( self.__Request( "POST", { "Command": "list" }, { "Authorization": "Bearer wrong" } ), 401 )
+		self.assertIsNone( self.JobServer.GetJob( 1 ) )
+
+	def testOtherHostIsForbidden( self ) -> None:
+		self.assertEqual( self.__Request( "POST", { "Command": "list" }, { "Host": "rebound.example:%d" % self.Port } ), 403 )
+		self.assertIsNone( self.JobServer.GetJob( 1 ) )
+
+	def testJobMustBeJson( self ) -> None:
+		self.assertEqual( self.__Request( "POST", { "Command": "list" }, { "Content-Type": "text/plain" } ), 415 )
+		self.assertIsNone( self.JobServer.GetJob( 1 ) )
+
+	# A negative length used to block the handler until the client disconnected.
+	def testContentLengthMustBeValid( self ) -> None:
+		for contentLength in [ "-1", "many" ]:
+			self.assertEqual( self.__Request( "POST", { "Command": "list" }, { "Content-Length": contentLength } ), 400 )
+
+		self.assertEqual( self.__Request( "POST", { "Command": "list" }, { "Content-Length": str( 64 * 1024 + 1 ) } ), 413 )
+		self.assertIsNone( self.JobServer.GetJob( 1 ) )
+
+	def testCompressionLevelMustBeAnInteger( self ) -> None:
+		for compressionLevel in [ 5.0, True, 10, "5" ]:
+			self.assertEqual( self.__Request( "POST", { "Command": "get", "OutputPath": "new", "CompressionLevel": compressionLevel } ), 400 )
+
+		self.assertIsNone( self.JobServer.GetJob( 1 ) )
+		self.assertEqual( self.__Request( "POST", { "Command": "get", "OutputPath": "new", "CompressionLevel": 9 } ), 202 )
+
+	def testOutputPathMustBeInsideTheOutputRoot( self ) -> None:
+		os.symlink( self.WorkingDirectory, os.path.join( self.OutputRoot, "link" ) )
+
+		for outputPath in [ self.WorkingDirectory, "../", "link/" ]:
+			self.assertEqual( self.__Request( "POST", { "Command": "get", "OutputPath": outputPath, "All": True } ), 400 )
+
+		self.assertIsNone( self.JobServer.GetJob( 1 ) )
+
+if __name__ == "__main__":
+	unittest.main()
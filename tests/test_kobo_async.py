@@ -0,0 +1,189 @@
+import os
+import sys
+
+sys.path.insert( 0, os.path.join( os.path.dirname( os.path.dirname( os.path.abspath( __file__ ) ) ), "kobo-book-downloader" ) )
+
+from Globals import Globals
+from Kobo import Kobo
+from KoboAsync import KoboAsync
+from Settings import Settings
+
+import asyncio
+import http.server
+import json
+import logging
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+import unittest.mock
+import urllib.parse
+
+# Serves the book info, the content access, the wish list, the library and a download. The API requests are answered with
+# 401 unless they have the current access token, and the number of the requests that are served at the same time is
+# recorded.
+class KoboApiRequestHandler( http.server.BaseHTTPRequestHandler ):
+	protocol_version = "HTTP/1.1"
+
+	def log_message( self, *args ) -> None:
+		pass
+
+	def __SendJson( self, statusCode: int, jsonObject ) -> None:
+		body = json.dumps( jsonObject ).encode()
+		self.send_response( statusCode )
+		self.send_header( "Content-Type", "application/json" )
+		self.send_header( "Content-Length", str( len( body ) ) )
+		self.end_headers()
+		self.wfile.write( body )
+
+	def do_GET( self ) -> None:
+		url = urllib.parse.urlsplit( self.path )
+		parameters = dict( urllib.parse.parse_qsl( url.query ) )
+		server = self.server
+
+		if url.path == "/download":
+			self.send_response( 200 )
+			self.send_header( "Content-Length", str( len( server.Download ) ) )
+			self.end_headers()
+			self.wfile.write( server.Download )
+			return
+
+		with server.Lock:
+			server.Requests.append( url.path )
+			if self.headers.get( "Authorization" ) != "Bearer " + server.AccessToken:
+				server.UnauthorizedCount += 1
+				self.__SendJson( 401, {} )
+				return
+
+			server.InFlight += 1
+			server.MaximumInFlight = max( server.MaximumInFlight, server.InFlight )
+
+		try:
+			time.sleep( server.Delay )
+
+			if url.path.startswith( "/book/" ):
+				self.__SendJson( 200, { "Title": "Title of " + url.path[ len( "/book/" ): ] } )
+			elif url.path.startswith( "/content/" ):
+				self.__SendJson( 200, { "ProductId": url.path[ len( "/content/" ): ], "DisplayProfile": parameters[ "DisplayProfile" ] } )
+			elif url.path == "/wishlist":
+				pageIndex = int( parameters[ "PageIndex" ] )
+				self.__SendJson( 200, { "Items": [ "wish-%d" % pageIndex ], "TotalPageCount": 3 } )
+			elif url.path == "/sync":
+				books = [ { "NewEntitlement": {
+					"BookEntitlement": { "Id": "entitlement-%d" % index },
+					"BookMetadata": { "RevisionId": "revision-%d" % index, "Title": "Book %d" % index, "ContributorRoles": [] }
+				} } for index in range( 250 ) ]
+				body = json.dumps( books ).encode()
+				self.send_response( 200 )
+				self.send_header( "Content-Type", "application/json" )
+				self.send_header( "Content-Length", str( len( body ) ) )
+				self.send_header( "x-kobo-synctoken", "done" )
+				self.end_headers()
+				self.wfile.write( body )
+			else:
+				self.__SendJson( 404, {} )
+		finally:
+			with server.Lock:
+				server.InFlight -= 1
+
+class KoboAsyncTest( unittest.TestCase ):
+	def setUp( self ) -> None:
+		self.WorkingDirectory = tempfile.mkdtemp()
+		self.addCleanup( shutil.rmtree, self.WorkingDirectory, True )
+		environment = unittest.mock.patch.dict( os.environ, { "XDG_CONFIG_HOME": self.WorkingDirectory } )
+		environment.start()
+		self.addCleanup( environment.stop )
+
+		Globals.Logger = logging.getLogger()
+		Globals.Settings = Settings()
+		Globals.Settings.UserId = "user"
+		Globals.Settings.AccessToken = "token"
+
+		self.Server = http.server.ThreadingHTTPServer( ( "127.0.0.1", 0 ), KoboApiRequestHandler )
+		self.Server.daemon_threads = True
+		self.Server.Lock = threading.Lock()
+		self.Server.AccessToken = "token"
+		self.Server.Delay = 0
+		self.Server.Download = os.urandom( 100000 )
+		self.Server.InFlight = 0
+		self.Server.MaximumInFlight = 0
+		self.Server.Requests = []
+		self.Server.UnauthorizedCount = 0
+		threading.Thread( target = self.Server.serve_forever, daemon = True ).start()
+		self.addCleanup( self.Server.server_close )
+		self.addCleanup( self.Server.shutdown )
+
+		url = "http://127.0.0.1:%d/" % self.Server.server_address[ 1 ]
+		self.Kobo = Kobo()
+		self.Kobo.InitializationSettings = {
+			"book": url + "book/{ProductId}",
+			"content_access_book": url + "content/{ProductId}",
+			"library_sync": url + "sync",
+			"user_wishlist": url + "wishlist"
+		}
+		self.Kobo.Session.SetConcurrency( 4 )
+		Globals.Kobo = self.Kobo
+		self.addCleanup( setattr, Globals, "Kobo", None )
+		self.addCleanup( lambda: self.Kobo.LibraryStore is not None and self.Kobo.LibraryStore.Close() )
+
+		self.DownloadUrl = url + "download"
+
+	def testLookupsAreConcurrentButBounded( self ) -> None:
+		self.Server.Delay = 0.05
+
+		async def Run() -> tuple:
+			async with KoboAsync( self.Kobo, 4 ) as koboAsync:
+				bookInfos = await asyncio.gather( *[ koboAsync.GetBookInfo( "book-%d" % index ) for index in range( 12 ) ] )
+				contentAccess = await koboAsync.GetContentAccessBooks( [ "book-%d" % index for index in range( 12 ) ], "Android" )
+				return bookInfos, contentAccess
+
+		bookInfos, contentAccess = asyncio.run( Run() )
+
+		self.assertEqual( [ bookInfo[ "Title" ] for bookInfo in bookInfos ], [ "Title of book-%d" % index for index in range( 12 ) ] )
+		self.assertEqual( [ response[ "ProductId" ] for response in contentAccess ], [ "book-%d" % index for index in range( 12 ) ] )
+		self.assertEqual( contentAccess[ 0 ][ "DisplayProfile" ], "Android" )
+		self.assertGreater( self.Server.MaximumInFlight, 1 )
+		self.assertLessEqual( self.Server.MaximumInFlight, 4 )
+
+	def testExpiredTokenIsRefreshedOnce( self ) -> None:
+		self.Server.AccessToken = "new-token"
+		refreshCount = []
+
+		def RefreshAuthentication( kobo: Kobo ) -> None:
+			refreshCount.append( 1 )
+			Globals.Settings.AccessToken = "new-token"
+
+		async def Run() -> list:
+			async with KoboAsync( self.Kobo, 4 ) as koboAsync:
+				return await asyncio.gather( *[ koboAsync.GetBookInfo( "book-%d" % index ) for index in range( 8 ) ] )
+
+		with unittest.mock.patch.object( Kobo, "RefreshAuthentication", RefreshAuthentication ):
+			bookInfos = asyncio.run( Run() )
+
+		self.assertEqual( len( bookInfos ), 8 )
+		self.assertEqual( len( refreshCount ), 1 )
+		self.assertGreaterEqual( self.Server.UnauthorizedCount, 1 )
+
+	def testWishListAndLibrary( self ) -> None:
+		async def Run() -> tuple:
+			async with KoboAsync( self.Kobo ) as koboAsync:
+				wishList = await koboAsync.GetMyWishList()
+				books = [ book async for book in koboAsync.GetMyBooks() ]
+				return wishList, books
+
+		wishList, books = asyncio.run( Run() )
+
+		self.assertEqual( wishList, [ "wish-0", "wish-1", "wish-2" ] )
+		self.assertEqual( sorted( book.RevisionId for book in books ), sorted( "revision-%d" % index for index in range( 250 ) ) )
+		self.assertEqual( self.Kobo.LibraryStore.GetSyncToken(), "done" )
+
+	def testStreamDownload( self ) -> None:
+		async def Run() -> bytes:
+			async with KoboAsync( self.Kobo ) as koboAsync:
+				return b"".join( [ chunk async for chunk in koboAsync.StreamDownload( self.DownloadUrl, 16 * 1024 ) ] )
+
+		self.assertEqual( asyncio.run( Run() ), self.Server.Download )
+
+if __name__ == "__main__":
+	unittest.main()
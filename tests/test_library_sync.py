@@ -0,0 +1,119 @@
+import os
+import sys
+
+sys.path.insert( 0, os.path.join( os.path.dirname( os.path.dirname( os.path.abspath( __file__ ) ) ), "kobo-book-downloader" ) )
+
+from Globals import Globals
+from Kobo import Kobo
+from KoboException import KoboException
+from Settings import Settings
+
+import http.server
+import json
+import logging
+import shutil
+import tempfile
+import threading
+import unittest
+import unittest.mock
+
+def MakeEntitlement( index: int ) -> dict:
+	return { "NewEntitlement": {
+		"BookEntitlement": { "Id": "entitlement-%d" % index },
+		"BookMetadata": { "RevisionId": "revision-%d" % index, "Title": "Book %d" % index, "ContributorRoles": [] }
+	} }
+
+# Serves the pages of library_sync. The pages are given by their synchronization token, a page that is not there is
+# answered with 400 every time.
+class LibrarySyncRequestHandler( http.server.BaseHTTPRequestHandler ):
+	protocol_version = "HTTP/1.1"
+
+	def log_message( self, *args ) -> None:
+		pass
+
+	def do_GET( self ) -> None:
+		syncToken = self.headers.get( "x-kobo-synctoken", "" )
+		with self.server.Lock:
+			self.server.RequestedTokens.append( syncToken )
+
+		page = self.server.Pages.get( syncToken )
+		if page is None:
+			self.send_response( 400 )
+			self.send_header( "Content-Length", "0" )
+			self.end_headers()
+			return
+
+		books, nextSyncToken, hasMorePages = page
+		body = json.dumps( books ).encode()
+		self.send_response( 200 )
+		self.send_header( "Content-Type", "application/json" )
+		self.send_header( "Content-Length", str( len( body ) ) )
+		self.send_header( "x-kobo-synctoken", nextSyncToken )
+		if hasMorePages:
+			self.send_header( "x-kobo-sync", "continue" )
+		self.end_headers()
+		self.wfile.write( body )
+
+class LibrarySyncTest( unittest.TestCase ):
+	def setUp( self ) -> None:
+		self.WorkingDirectory = tempfile.mkdtemp()
+		environment = unittest.mock.patch.dict( os.environ, { "XDG_CONFIG_HOME": self.WorkingDirectory } )
+		environment.start()
+		self.addCleanup( environment.stop )
+		Globals.Logger = logging.getLogger()
+		Globals.Settings = Settings()
+		Globals.Settings.UserId = "user"
+
+		self.Server = http.server.ThreadingHTTPServer( ( "127.0.0.1", 0 ), LibrarySyncRequestHandler )
+		self.Server.daemon_threads = True
+		self.Server.Lock = threading.Lock()
+		self.Server.RequestedTokens = []
+		self.Server.Pages = {}
+		threading.Thread( target = self.Server.serve_forever, daemon = True ).start()
+
+		self.Kobo = Kobo()
+		self.Kobo.InitializationSettings = { "library_sync": "http://127.0.0.1:%d/sync" % self.Server.server_address[ 1 ] }
+		Globals.Kobo = self.Kobo
+
+	def tearDown( self ) -> None:
+		if self.Kobo.LibraryStore is not None:
+			self.Kobo.LibraryStore.Close()
+		self.Server.shutdown()
+		self.Server.server_close()
+		shutil.rmtree( self.WorkingDirectory, ignore_errors = True )
+
+	def __GetResetCount( self ) -> int:
+		return self.Server.RequestedTokens.count( "" )
+
+	def testFailingPageTokenIsNotRetried( self ) -> None:
+		self.Server.Pages[ "" ] = ( [ MakeEntitlement( 0 ) ], "page-2", True )
+
+		with self.assertRaises( KoboException ):
+			list( self.Kobo.GetMyBooks() )
+
+		self.assertEqual( self.Server.RequestedTokens, [ "", "page-2" ] )
+
+	def testFailingPageTokenAfterStaleStoredTokenIsNotRetried( self ) -> None:
+		self.Server.Pages[ "" ] = ( [ MakeEntitlement( 0 ) ], "page-2", True )
+		self.Kobo.ResetLibrary()
+		self.Kobo.LibraryStore.ApplyPage( [], "stale" )
+
+		with self.assertRaises( KoboException ):
+			list( self.Kobo.GetMyBooks() )
+
+		self.assertEqual( self.Server.RequestedTokens, [ "stale", "", "page-2" ] )
+
+	def testStaleStoredTokenSynchronizesTheWholeLibraryOnce( self ) -> None:
+		self.Server.Pages[ "" ] = ( [ MakeEntitlement( 0 ) ], "page-2", True )
+		self.Server.Pages[ "page-2" ] = ( [ MakeEntitlement( 1 ) ], "done", False )
+		self.Kobo.ResetLibrary()
+		self.Kobo.LibraryStore.ApplyPage( [ MakeEntitlement( 2 ) ], "stale" )
+
+		books = list( self.Kobo.GetMyBooks() )
+
+		self.assertEqual( sorted( book.RevisionId for book in books ), [ "revision-0", "revision-1" ] )
+		self.assertEqual( self.__GetResetCount(), 1 )
+		self.assertEqual( self.Kobo.LibraryStore.GetSyncToken(), "done" )
+
+if __name__ == "__main__":
+	unittest.main()
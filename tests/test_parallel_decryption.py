@@ -0,0 +1,104 @@
+import os
+import sys
+
+sys.path.insert( 0, os.path.join( os.path.dirname( os.path.dirname( os.path.abspath( __file__ ) ) ), "kobo-book-downloader" ) )
+
+from CompressionPolicy import CompressionPolicy
+from DecryptionPool import DecryptionPool
+from EncryptedBook import DeviceId, MakeEncryptedBook, UserId
+from KoboDrmRemover import KoboDrmRemover
+
+import concurrent.futures
+import shutil
+import tempfile
+import threading
+import unittest
+import unittest.mock
+import zipfile
+
+class ParallelDecryptionTest( unittest.TestCase ):
+	def setUp( self ) -> None:
+		self.WorkingDirectory = tempfile.mkdtemp()
+		self.InputPath = os.path.join( self.WorkingDirectory, "book.epub" )
+		self.OutputPath = os.path.join( self.WorkingDirectory, "book.drm-free.epub" )
+
+		self.Chapters = {}
+		entries = [ ( "mimetype", b"application/epub+zip", zipfile.ZIP_STORED, False ) ]
+		for index in range( 20 ):
+			name = "OEBPS/chapter%02d.xhtml" % index
+			self.Chapters[ name ] = os.urandom( 1000 + index * 500 )
+			entries.append( ( name, self.Chapters[ name ], zipfile.ZIP_STORED, True ) )
+			entries.append( ( "OEBPS/page%02d.xhtml" % index, b"<html/>", zipfile.ZIP_DEFLATED, False ) )
+
+		self.ContentKeys = MakeEncryptedBook( self.InputPath, entries )
+
+	def tearDown( self ) -> None:
+		shutil.rmtree( self.WorkingDirectory, ignore_errors = True )
+
+	# The futures are completed only when they are waited for, like in a busy pool of workers, so the bytes in flight are
+	# limited only by RemoveDrm.
+	def testParallelEntriesAreLimitedByBytes( self ) -> None:
+		drmRemover = KoboDrmRemover( DeviceId, UserId )
+		inFlight = { "Bytes": 0, "MaximumBytes": 0 }
+
+		def DecryptInParallel( contents: bytes, contentKeyBase64: str ) -> concurrent.futures.Future:
+			inFlight[ "Bytes" ] += len( contents )
+			inFlight[ "MaximumBytes" ] = max( inFlight[ "MaximumBytes" ], inFlight[ "Bytes" ] )
+
+			future = unittest.mock.Mock()
+			def Result():
+				inFlight[ "Bytes" ] -= len( contents )
+				return drmRemover.DecryptContents( contents, contentKeyBase64 )
+			future.result = Result
+			return future
+
+		with unittest.mock.patch.object( KoboDrmRemover, "ParallelEntrySize", 1 ), unittest.mock.patch.object( KoboDrmRemover, "ParallelByteCount", 16 * 1024 ):
+			drmRemover.RemoveDrm( self.InputPath, self.OutputPath, self.ContentKeys, decryptInParallel = DecryptInParallel )
+
+		self.assertLessEqual( inFlight[ "MaximumBytes" ], 16 * 1024 )
+		self.assertGreater( inFlight[ "MaximumBytes" ], 10000 ) # Several entries were in flight at the same time.
+		self.assertEqual( inFlight[ "Bytes" ], 0 )
+
+		with zipfile.ZipFile( self.InputPath ) as inputZip:
+			names = [ zipInfo.filename for zipInfo in inputZip.infolist() ]
+
+		with zipfile.ZipFile( self.OutputPath ) as outputZip:
+			self.assertIsNone( outputZip.testzip() )
+			for name, contents in self.Chapters.items():
+				self.assertEqual( outputZip.read( name ), contents )
+
+			# The entries are written in their original order.
+			self.assertEqual( [ zipInfo.filename for zipInfo in outputZip.infolist() ], names )
+
+	# The workers are started while another thread holds the lock of KoboDrmRemover.Get, like a download thread can. A forked
+	# worker would inherit the held lock and never finish the book.
+	def testWorkersDontInheritHeldLocks( self ) -> None:
+		decryptionPool = DecryptionPool( 1, DeviceId, UserId )
+		finished = threading.Event()
+
+		# A stuck worker would stop the pool from closing.
+		def Close() -> None:
+			if not finished.is_set():
+				for process in list( decryptionPool.Executor._processes.values() ):
+					process.kill()
+
+			decryptionPool.Close()
+
+		self.addCleanup( Close )
+
+		def RemoveDrm() -> None:
+			decryptionPool.RemoveDrm( self.InputPath, self.OutputPath, self.ContentKeys, CompressionPolicy() )
+			finished.set()
+
+		with KoboDrmRemover._KoboDrmRemover__InstancesLock:
+			threading.Thread( target = RemoveDrm, daemon = True ).start()
+			finished.wait( 30 )
+
+		self.assertTrue( finished.is_set() )
+
+		with zipfile.ZipFile( self.OutputPath ) as outputZip:
+			for name, contents in self.Chapters.items():
+				self.assertEqual( outputZip.read( name ), contents )
+
+if __name__ == "__main__":
+	unittest.main()
@@ -0,0 +1,57 @@
+import os
+import sys
+
+sys.path.insert( 0, os.path.join( os.path.dirname( os.path.dirname( os.path.abspath( __file__ ) ) ), "kobo-book-downloader" ) )
+
+from Commands import Commands
+from Globals import Globals
+
+import contextlib
+import io
+import logging
+import shutil
+import tempfile
+import unittest
+import unittest.mock
+
+# Goes through the pick command from the picked numbers to the downloads. The Kobo API is a mock, only the paths of the
+# downloaded books are checked.
+class PickTest( unittest.TestCase ):
+	Rows = [
+		[ "revision-1", "Book 1", "Author 1", False ],
+		[ "revision-2", "Book 2", "", False ],
+		[ "revision-3", "Book 3", "Author 3", True ]
+	]
+
+	def setUp( self ) -> None:
+		self.WorkingDirectory = tempfile.mkdtemp()
+		self.addCleanup( shutil.rmtree, self.WorkingDirectory, True )
+
+		self.Kobo = unittest.mock.Mock()
+		self.Kobo.Download.side_effect = lambda revisionId, displayProfile, outputPath, keepEncrypted: outputPath
+		Globals.Logger = logging.getLogger()
+		Globals.Kobo = self.Kobo
+		self.addCleanup( setattr, Globals, "Kobo", None )
+
+	def __Pick( self, pickedBooks: str ) -> dict:
+		with unittest.mock.patch.object( Commands, "GetBookList", return_value = PickTest.Rows ), \
+			unittest.mock.patch( "builtins.input", return_value = pickedBooks ), contextlib.redirect_stdout( io.StringIO() ):
+			Commands.PickBooks( self.WorkingDirectory, False )
+
+		return { call.args[ 0 ]: call.args[ 2 ] for call in self.Kobo.Download.call_args_list }
+
+	def testPickedBooksAreDownloaded( self ) -> None:
+		downloads = self.__Pick( "1, 2" )
+
+		self.assertEqual( downloads, {
+			"revision-1": os.path.join( self.WorkingDirectory, "Author 1 - Book 1.epub" ),
+			"revision-2": os.path.join( self.WorkingDirectory, "Book 2.epub" )
+		} )
+
+	def testArchivedBooksAreSkipped( self ) -> None:
+		downloads = self.__Pick( "all" )
+
+		self.assertEqual( sorted( downloads ), [ "revision-1", "revision-2" ] )
+
+if __name__ == "__main__":
+	unittest.main()